@@ -0,0 +1,207 @@
+"""
+Struct based BOOTP/DHCP codec (RFC 2131, RFC 2132)
+
+Parses and builds the packets of the socket engine of dhcp_server without
+dissecting them with scapy. The options use the same names as scapy, so the
+lists made by DHCPUser.gen_options are encoded as they are.
+"""
+import struct
+import socket
+
+from red_casa.dhcp.models import DHCP_OPTIONS, SUBNET_MASK, TIME_ZONE, ROUTER, TIME_SERVER, NAME_SERVER, \
+    LOG_SERVER, COOKIE_SERVER, BROADCAST_ADDRESS, NTP_SERVER, NETBIOS_SERVER, NETBIOS_DIST_SERVER, \
+    REQUESTED_ADDR, LEASE_TIME, SERVER_ID, SMTP_SERVER, POP3_SERVER, NNTP_SERVER, WWW_SERVER
+
+BOOTP = struct.Struct('!BBBBIHH4s4s4s4s16s64s128s')
+MAGIC_COOKIE = b'\x63\x82\x53\x63'
+BOOTREQUEST = 1
+BOOTREPLY = 2
+BROADCAST_FLAG = 0x8000
+SERVER_PORT = 67
+CLIENT_PORT = 68
+ANY_ADDR = '0.0.0.0'
+BROADCAST_ADDR = '255.255.255.255'
+BROADCAST_MAC = 'ff:ff:ff:ff:ff:ff'
+
+PAD = 0
+MESSAGE_TYPE = 53
+PARAM_REQ_LIST = 55
+END = 255
+
+MESSAGE_TYPES = {
+    'discover': 1, 'offer': 2, 'request': 3, 'decline': 4, 'ack': 5, 'nak': 6, 'release': 7, 'inform': 8
+}
+DISCOVER = MESSAGE_TYPES['discover']
+REQUEST = MESSAGE_TYPES['request']
+
+OPTION_CODES = dict((key, num) for num, key in DHCP_OPTIONS)
+OPTION_CODES.update({'message-type': MESSAGE_TYPE, 'requested_addr': REQUESTED_ADDR, 'param_req_list': PARAM_REQ_LIST})
+
+IP_OPTIONS = [SUBNET_MASK, BROADCAST_ADDRESS, REQUESTED_ADDR, SERVER_ID]
+IP_LIST_OPTIONS = [ROUTER, TIME_SERVER, NAME_SERVER, LOG_SERVER, COOKIE_SERVER, NTP_SERVER, NETBIOS_SERVER,
+                   NETBIOS_DIST_SERVER, SMTP_SERVER, POP3_SERVER, NNTP_SERVER, WWW_SERVER]
+INT = struct.Struct('!i')
+UINT = struct.Struct('!I')
+
+
+def mac_to_str(chaddr, hlen=6):
+    return ':'.join('%02x' % byte for byte in bytearray(chaddr[:hlen]))
+
+
+def str_to_mac(mac):
+    return bytes(bytearray(int(part, 16) for part in mac.split(':')))
+
+
+def encode_value(code, value):
+    if code == MESSAGE_TYPE:
+        return struct.pack('!B', MESSAGE_TYPES.get(value, value))
+    elif code in IP_OPTIONS:
+        return socket.inet_aton(value)
+    elif code in IP_LIST_OPTIONS:
+        if isinstance(value, (list, tuple)):
+            return b''.join(socket.inet_aton(ip) for ip in value)
+        return socket.inet_aton(value)
+    elif code == TIME_ZONE:
+        return INT.pack(int(value))
+    elif code == LEASE_TIME:
+        return UINT.pack(int(value))
+    elif isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def encode_options(options):
+    """
+    :param options: Options like [('message-type', 'offer'), ('router', ['192.168.1.1']), 'end']
+    :return: Options field with the magic cookie
+    """
+    data = [MAGIC_COOKIE]
+    for option in options:
+        if not isinstance(option, tuple):
+            continue  # 'end' is always added
+        key, value = option
+        code = OPTION_CODES[key] if not isinstance(key, int) else key
+        value = encode_value(code, value)
+        for offset in range(0, len(value), 255):  # RFC 3396 long options
+            chunk = value[offset:offset + 255]
+            data.append(struct.pack('!BB', code, len(chunk)) + chunk)
+    data.append(struct.pack('!B', END))
+    return b''.join(data)
+
+
+def decode_options(data):
+    """
+    :return: {code: raw value}, the repeated options are concatenated
+    """
+    options = {}
+    i, size = 0, len(data)
+    while i < size:
+        code = ord(data[i:i + 1])
+        if code == END:
+            break
+        if code == PAD:
+            i += 1
+            continue
+        if i + 1 >= size:
+            break
+        length = ord(data[i + 1:i + 2])
+        options[code] = options.get(code, b'') + data[i + 2:i + 2 + length]
+        i += 2 + length
+    return options
+
+
+class DHCPMessage(object):
+    """
+    BOOTP/DHCP packet with the options kept raw, only decoded when asked for
+    """
+    __slots__ = ('op', 'htype', 'hlen', 'hops', 'xid', 'secs', 'flags', 'ciaddr', 'yiaddr', 'siaddr', 'giaddr',
+                 'chaddr', 'options')
+
+    def __init__(self, op=BOOTREPLY, xid=0, flags=0, ciaddr=ANY_ADDR, yiaddr=ANY_ADDR, siaddr=ANY_ADDR,
+                 giaddr=ANY_ADDR, chaddr=b'', options=None, htype=1, hlen=6, hops=0, secs=0):
+        self.op = op
+        self.htype = htype
+        self.hlen = hlen
+        self.hops = hops
+        self.xid = xid
+        self.secs = secs
+        self.flags = flags
+        self.ciaddr = ciaddr
+        self.yiaddr = yiaddr
+        self.siaddr = siaddr
+        self.giaddr = giaddr
+        self.chaddr = chaddr  # Raw bytes
+        self.options = options if options is not None else {}
+
+    @classmethod
+    def parse(cls, data):
+        """
+        :return: DHCPMessage or None if it's not a DHCP packet
+        """
+        if len(data) < BOOTP.size + len(MAGIC_COOKIE) or \
+                data[BOOTP.size:BOOTP.size + len(MAGIC_COOKIE)] != MAGIC_COOKIE:
+            return None
+        op, htype, hlen, hops, xid, secs, flags, ciaddr, yiaddr, siaddr, giaddr, chaddr, sname, file = \
+            BOOTP.unpack_from(data)
+        return cls(op, xid, flags, socket.inet_ntoa(ciaddr), socket.inet_ntoa(yiaddr), socket.inet_ntoa(siaddr),
+                   socket.inet_ntoa(giaddr), chaddr[:min(hlen, 16)], decode_options(data[BOOTP.size + 4:]),
+                   htype, hlen, hops, secs)
+
+    @property
+    def mac(self):
+        return mac_to_str(self.chaddr, self.hlen)
+
+    @property
+    def message_type(self):
+        value = self.options.get(MESSAGE_TYPE)
+        return ord(value[:1]) if value else None
+
+    def get_ip(self, code):
+        value = self.options.get(code)
+        if value and len(value) == 4:
+            return socket.inet_ntoa(value)
+        return None
+
+    @property
+    def requested_addr(self):
+        return self.get_ip(REQUESTED_ADDR)
+
+    @property
+    def server_id(self):
+        return self.get_ip(SERVER_ID)
+
+    def reply(self, yiaddr, siaddr, options):
+        """
+        :param options: Options as made by DHCPUser.gen_options
+        :return: Packed BOOTREPLY to this request
+        """
+        return BOOTP.pack(BOOTREPLY, self.htype, self.hlen, 0, self.xid, 0, self.flags,
+                          socket.inet_aton(self.ciaddr), socket.inet_aton(yiaddr or ANY_ADDR),
+                          socket.inet_aton(siaddr), socket.inet_aton(self.giaddr), self.chaddr,
+                          b'', b'') + encode_options(options)
+
+    def reply_address(self, yiaddr, nak=False):
+        """
+        Destination of the reply as RFC 2131 4.1, without ARP the not configured clients get a broadcast
+        """
+        if self.giaddr != ANY_ADDR:
+            return self.giaddr, SERVER_PORT
+        if nak:
+            return BROADCAST_ADDR, CLIENT_PORT
+        if self.ciaddr != ANY_ADDR:
+            return self.ciaddr, CLIENT_PORT
+        return BROADCAST_ADDR, CLIENT_PORT
+
+    def reply_mac(self, address, source):
+        """
+        Ethernet destination of the reply sent to address for the engines writing the frames
+        :param source: MAC the request came from, the relay agent one if it was relayed
+        """
+        if self.giaddr != ANY_ADDR:
+            return source
+        if address == BROADCAST_ADDR and self.flags & BROADCAST_FLAG:
+            return BROADCAST_MAC
+        return self.mac
+
+    def summary(self):
+        return "DHCP %s %s xid=%08x" % (self.message_type, self.mac, self.xid)
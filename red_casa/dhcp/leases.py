@@ -0,0 +1,575 @@
+"""
+In-memory lease table of dhcp_server
+
+Networks, static bindings and the active leases are loaded on start, then every
+DISCOVER/REQUEST is answered from memory. Each DHCPNetwork has a pool handing
+out addresses in O(1): a cursor over the never used addresses plus an ordered
+free list with the released ones. The database is still the durable store,
+every committed lease goes to a write-behind buffer saved in order by a
+background thread.
+
+The expiry of every lease is kept in a heap, a reaper thread releases the
+expired ones in batches so the pools never have to scan for them. The same
+thread reloads the networks and the static bindings, keeping the leases, when
+the signals mark them as changed or they are older than DHCP_POOLS_TTL, so
+the changes saved by the admin are applied as the options cache ones.
+"""
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from collections import OrderedDict
+from datetime import datetime
+import itertools
+import threading
+import calendar
+import logging
+import heapq
+import ipaddr
+import time
+
+from red_casa.dhcp.models import DHCPNetwork, DHCPIp, DHCPUser, DHCPHistory, DHCPOption, LEASE_TIME, \
+    DHCP_LEASE_DEFAULT, DHCP_IP_LIST_SEPARATOR
+from red_casa.dhcp.options import options_cache, DHCP_OPTIONS_CACHE_TTL
+
+logger = logging.getLogger('dhcp_server')
+
+DHCP_OFFER_TIME = 60  # Seconds an offered address is kept for the client
+if hasattr(settings, 'DHCP_OFFER_TIME'):
+    DHCP_OFFER_TIME = int(settings.DHCP_OFFER_TIME)
+
+DHCP_REAP_INTERVAL = 10  # Seconds between reaper runs
+if hasattr(settings, 'DHCP_REAP_INTERVAL'):
+    DHCP_REAP_INTERVAL = float(settings.DHCP_REAP_INTERVAL)
+
+DHCP_REAP_BATCH = 500  # Leases released while holding the lock
+if hasattr(settings, 'DHCP_REAP_BATCH'):
+    DHCP_REAP_BATCH = int(settings.DHCP_REAP_BATCH)
+
+DHCP_STATS_INTERVAL = 300  # Seconds between the log lines with the leases of every network, 0 for none
+if hasattr(settings, 'DHCP_STATS_INTERVAL'):
+    DHCP_STATS_INTERVAL = float(settings.DHCP_STATS_INTERVAL)
+
+DHCP_POOLS_TTL = DHCP_OPTIONS_CACHE_TTL  # Seconds before reloading the networks and static bindings
+if hasattr(settings, 'DHCP_POOLS_TTL'):
+    DHCP_POOLS_TTL = int(settings.DHCP_POOLS_TTL)
+
+
+def timestamp(date):
+    if timezone.is_aware(date):
+        return calendar.timegm(date.utctimetuple())
+    return time.mktime(date.timetuple())
+
+
+def from_timestamp(value):
+    if settings.USE_TZ:
+        return datetime.utcfromtimestamp(value).replace(tzinfo=timezone.utc)
+    return datetime.fromtimestamp(value)
+
+
+class Lease(object):
+    __slots__ = ('mac', 'pool', 'address', 'expires', 'static', 'offered')
+
+    def __init__(self, mac, pool, address, expires=None, static=False, offered=False):
+        self.mac = mac
+        self.pool = pool
+        self.address = address  # int
+        self.expires = expires  # Timestamp, None for static
+        self.static = static
+        self.offered = offered  # Only held for the client until it asks for it
+
+    @property
+    def ip(self):
+        return str(ipaddr.IPAddress(self.address))
+
+    def is_active(self, now):
+        return self.static or self.expires > now
+
+    def dhcp_ip(self):
+        """
+        :return: DHCPIp of the address, without a query
+        """
+        return DHCPIp(pk=self.pool.ips.get(self.address), network=self.pool.network, address=self.ip)
+
+
+class NetworkPool(object):
+    """
+    Addresses of a DHCPNetwork, without the network, broadcast and routers.
+
+    The cursor walks the addresses never handed out and the released ones
+    wait in the free list, so allocate, take and release are O(1).
+    """
+
+    def __init__(self, network, lease_time=DHCP_LEASE_DEFAULT):
+        routers = network.router.split(DHCP_IP_LIST_SEPARATOR)
+        self.network = network
+        self.net = ipaddr.IPNetwork("%s/%s" % (routers[0], network.subnet_mask))
+        self.lease_time = lease_time  # Of the network, for the leases saved without expiry
+        self.reserved = set(int(ipaddr.IPAddress(router)) for router in routers)
+        self.first = int(self.net.network)
+        self.last = int(self.net.broadcast)
+        if self.net.prefixlen < self.net.max_prefixlen - 1:
+            self.first += 1
+            self.last -= 1
+        self.cursor = self.first
+        self.free = OrderedDict()
+        self.leases = {}  # address -> Lease
+        self.ips = {}  # address -> DHCPIp pk
+        self.reaped = 0
+
+    def __contains__(self, address):
+        return self.first <= address <= self.last and address not in self.reserved
+
+    @property
+    def size(self):
+        return self.last - self.first + 1 - len([address for address in self.reserved
+                                                 if self.first <= address <= self.last])
+
+    def take(self, lease):
+        """
+        Assigns the lease address if it's free
+        """
+        if lease.address not in self or lease.address in self.leases:
+            return False
+        self.free.pop(lease.address, None)
+        self.leases[lease.address] = lease
+        return True
+
+    def allocate(self):
+        """
+        :return: A free address or None if the pool is exhausted
+        """
+        while self.free:
+            address = self.free.popitem(last=False)[0]
+            if address not in self.leases:
+                return address
+        while self.cursor <= self.last:
+            address = self.cursor
+            self.cursor += 1
+            if address not in self.leases and address not in self.reserved:
+                return address
+        return None
+
+    def release(self, lease):
+        if self.leases.get(lease.address) is lease:
+            del self.leases[lease.address]
+            if lease.address < self.cursor:
+                self.free[lease.address] = True
+
+    def stats(self, now):
+        expired = sum(1 for lease in self.leases.values() if not lease.is_active(now))
+        return {
+            'network': str(self.network),
+            'size': self.size,
+            'active': len(self.leases) - expired,
+            'expired': expired,  # Waiting for the reaper
+            'free': self.size - len(self.leases),
+            'reaped': self.reaped,
+        }
+
+
+class LeaseManager(object):
+    """
+    Leases of every client by MAC and of every address by pool.
+    """
+
+    def __init__(self, offer_time=DHCP_OFFER_TIME, reap_interval=DHCP_REAP_INTERVAL, reap_batch=DHCP_REAP_BATCH,
+                 pools_ttl=DHCP_POOLS_TTL, stats_interval=DHCP_STATS_INTERVAL):
+        self.offer_time = offer_time
+        self.reap_interval = reap_interval
+        self.reap_batch = reap_batch
+        self.pools_ttl = pools_ttl
+        self.stats_interval = stats_interval
+        self.logged = time.time()  # Timestamp of the last stats log line
+        self.pools = []
+        self.leases = {}  # mac -> Lease
+        self.expiry = []  # Heap of (expires, sequence, Lease), renewed leases leave stale entries
+        self.sequence = itertools.count()
+        self.preferred = {}  # mac -> (pool, address) of the last address assigned
+        self.defaults = []  # Pools for the new clients
+        self.server_ip = None
+        self.loaded = 0  # Timestamp of the pools
+        self.changed = threading.Event()  # Set by the signals
+        self.mutex = threading.RLock()
+        self.buffer = LeaseBuffer()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def load_pools():
+        """
+        :return: {DHCPNetwork pk: NetworkPool} with the pk of its DHCPIp rows
+        """
+        network_lease_times = dict(DHCPOption.objects.filter(option=LEASE_TIME, dhcpnetwork__isnull=False)
+                                   .values_list('dhcpnetwork__id', 'value'))
+        pools = {}
+        for network in DHCPNetwork.objects.order_by('pk'):
+            pools[network.pk] = NetworkPool(network, int(network_lease_times.get(network.pk, DHCP_LEASE_DEFAULT)))
+        for pk, network_id, address in DHCPIp.objects.values_list('pk', 'network_id', 'address').iterator():
+            pools[network_id].ips[int(ipaddr.IPAddress(address))] = pk
+        return pools
+
+    def set_pools(self, pools, server_ip):
+        """
+        Replaces the pools and binds the static users, the caller holds the mutex
+        """
+        self.changed.clear()
+        self.loaded = time.time()
+        self.pools = [pools[pk] for pk in sorted(pools)]
+        self.server_ip = server_ip
+        self.leases = {}
+        self.expiry = []
+        self.preferred = {}
+        self.defaults = []
+        if server_ip:
+            address = ipaddr.IPAddress(server_ip)
+            self.defaults = [pool for pool in self.pools if address in pool.net]
+
+        users = DHCPUser.objects.filter(ip__isnull=False).values_list('address', 'static', 'ip__network_id',
+                                                                      'ip__address')
+        for mac, static, network_id, address in users.iterator():
+            pool = pools[network_id]
+            address = int(ipaddr.IPAddress(address))
+            if static:
+                lease = Lease(mac, pool, address, static=True)
+                owner = pool.leases.get(address)
+                if owner is not None:
+                    pool.release(owner)
+                    self.leases.pop(owner.mac, None)
+                pool.take(lease)
+                self.leases[mac] = lease
+            else:
+                self.preferred[mac] = (pool, address)
+
+    def load(self, server_ip=None):
+        """
+        Loads the networks, the static bindings and the active leases
+        :param server_ip: The pools of the networks with this IP are used for the new clients
+        """
+        pools = self.load_pools()
+        lease_times = dict((mac, int(value)) for mac, value in
+                           DHCPOption.objects.filter(option=LEASE_TIME, dhcpuser__isnull=False)
+                           .values_list('dhcpuser__address', 'value'))
+
+        with self.mutex:
+            self.set_pools(pools, server_ip)
+            now = time.time()
+            history = DHCPHistory.objects.filter(Q(expires__gt=from_timestamp(now)) | Q(expires__isnull=True))
+            history = history.order_by('date').values_list('mac_id', 'ip__network_id', 'ip__address', 'date',
+                                                           'expires')
+            for mac, network_id, address, date, expires in history.iterator():  # The newest wins
+                pool = pools[network_id]
+                if expires is None:
+                    expires = timestamp(date) + lease_times.get(mac, pool.lease_time)
+                else:
+                    expires = timestamp(expires)
+                current = self.leases.get(mac)
+                if expires <= now or (current is not None and current.static):
+                    continue
+                lease = Lease(mac, pool, int(ipaddr.IPAddress(address)), expires)
+                owner = pool.leases.get(lease.address)
+                if owner is not None:
+                    if owner.static:
+                        continue
+                    pool.release(owner)
+                    self.leases.pop(owner.mac, None)
+                if current is not None:
+                    current.pool.release(current)
+                pool.take(lease)
+                self.leases[mac] = lease
+            for lease in self.leases.values():
+                self.schedule(lease)
+        logger.info("Loaded %d networks and %d leases" % (len(self.pools), len(self.leases)))
+        return self
+
+    def reload(self):
+        """
+        Loads again the networks and the static bindings keeping the leases of the dynamic clients
+        """
+        pools = self.load_pools()
+        with self.mutex:
+            leases, preferred = self.leases, self.preferred
+            self.set_pools(pools, self.server_ip)
+            for mac, lease in leases.items():
+                pool = pools.get(lease.pool.network.pk)
+                if lease.static or mac in self.leases or pool is None:
+                    continue
+                current = Lease(mac, pool, lease.address, lease.expires, offered=lease.offered)
+                if pool.take(current):
+                    self.leases[mac] = current
+                    self.schedule(current)
+            for mac, (pool, address) in preferred.items():
+                pool = pools.get(pool.network.pk)
+                if pool is not None and address in pool:
+                    self.preferred.setdefault(mac, (pool, address))
+        logger.info("Reloaded %d networks, %d leases" % (len(self.pools), len(self.leases)))
+
+    def start(self):
+        self.buffer.start()
+        if self.thread is None and self.reap_interval > 0:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='dhcp-reaper')
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.buffer.stop()
+
+    def run(self):
+        while not self.stopped.wait(self.reap_interval):
+            if self.changed.is_set() or 0 < self.pools_ttl < time.time() - self.loaded:
+                try:
+                    self.reload()
+                except Exception as ex:
+                    logger.error("Error reloading the networks: %s" % ex)
+            try:
+                reaped = 0
+                while True:
+                    released = self.expire(batch=self.reap_batch)
+                    reaped += released
+                    if released < self.reap_batch:
+                        break
+                if reaped:
+                    logger.info("Released %d expired leases" % reaped)
+            except Exception as ex:
+                logger.error("Error releasing the expired leases: %s" % ex)
+            if 0 < self.stats_interval <= time.time() - self.logged:
+                self.logged = time.time()
+                for line in self.stats_lines():
+                    logger.info(line)
+
+    def stats(self):
+        """
+        :return: Active, expired and free leases of every network
+        """
+        now = time.time()
+        with self.mutex:
+            return [pool.stats(now) for pool in self.pools]
+
+    def stats_lines(self):
+        return ["Network %(network)s: %(active)d active, %(expired)d expired, %(free)d free leases" % stats
+                for stats in self.stats()]
+
+    @staticmethod
+    def lease_time(mac, pool):
+        """
+        :return: Seconds from the resolved options of the client, the ones of the reply
+        """
+        user = DHCPUser(address=mac, ip=DHCPIp(network=pool.network))
+        return options_cache.get(mac, pool.network.pk, user.resolve_options).lease_time
+
+    def pool_of(self, address):
+        for pool in self.pools:
+            if address in pool:
+                return pool
+        return None
+
+    def assign(self, lease, pool, address):
+        """
+        Moves the lease to the address if it's free
+        """
+        current = Lease(lease.mac, pool, address, lease.expires, offered=lease.offered)
+        if not pool.take(current):
+            owner = pool.leases.get(address)
+            if owner is None or owner.is_active(time.time()):
+                return None
+            self.release(owner)
+            pool.take(current)
+        self.release(lease)
+        self.leases[lease.mac] = current
+        return current
+
+    def release(self, lease):
+        lease.pool.release(lease)
+        if self.leases.get(lease.mac) is lease:
+            del self.leases[lease.mac]
+
+    def schedule(self, lease):
+        if not lease.static:
+            heapq.heappush(self.expiry, (lease.expires, next(self.sequence), lease))
+
+    def expire(self, now=None, batch=None):
+        """
+        Releases the expired leases, the soonest first
+        :param batch: Max leases released
+        :return: Number of released leases
+        """
+        now = now or time.time()
+        released = 0
+        with self.mutex:
+            while self.expiry and self.expiry[0][0] <= now and (batch is None or released < batch):
+                expires, sequence, lease = heapq.heappop(self.expiry)
+                if lease.expires != expires or self.leases.get(lease.mac) is not lease:
+                    continue  # Renewed or already released
+                self.release(lease)
+                lease.pool.reaped += 1
+                released += 1
+        return released
+
+    def allocate(self, mac, now):
+        """
+        :return: New offered lease from the last address of the client or the default pools
+        """
+        preferred = self.preferred.get(mac)
+        pools = list(self.defaults)
+        if preferred is not None:
+            pool, address = preferred
+            lease = Lease(mac, pool, address, now + self.offer_time, offered=True)
+            owner = pool.leases.get(address)
+            if owner is not None and not owner.is_active(now):
+                self.release(owner)
+            if pool.take(lease):
+                self.schedule(lease)
+                return lease
+            pools.insert(0, pool)
+        for retry in (False, True):
+            for pool in pools:
+                address = pool.allocate()
+                if address is not None:
+                    lease = Lease(mac, pool, address, now + self.offer_time, offered=True)
+                    pool.take(lease)
+                    self.schedule(lease)
+                    return lease
+            if retry or not self.expire(now):
+                break
+        return None
+
+    def offer(self, mac):
+        """
+        :return: The lease offered to the client or None if there is not any address
+        """
+        now = time.time()
+        with self.mutex:
+            lease = self.leases.get(mac)
+            if lease is not None:
+                if lease.is_active(now):
+                    return lease
+                lease.expires = now + self.offer_time  # Nobody took it yet
+                lease.offered = True
+                self.schedule(lease)
+                return lease
+            lease = self.allocate(mac, now)
+            if lease is not None:
+                self.leases[mac] = lease
+            return lease
+
+    def request(self, mac, requested):
+        """
+        Commits the lease of the requested address, new or renewed
+        :param requested: Address the client asks for
+        :return: The lease or None if the client can not use the address
+        """
+        address = int(ipaddr.IPAddress(requested))
+        pool = self.pool_of(address)
+        lease_time = None
+        if pool is not None:
+            lease_time = self.lease_time(mac, pool)  # Out of the mutex, it can query the options
+        now = time.time()
+        with self.mutex:
+            lease = self.leases.get(mac)
+            if lease is None or lease.address != address:
+                if (lease is not None and lease.static) or pool is None:
+                    return None
+                lease = self.assign(lease or Lease(mac, pool, address, now), pool, address)
+                if lease is None:
+                    return None
+            if not lease.static:
+                lease.expires = now + (lease_time or self.lease_time(mac, lease.pool))
+                lease.offered = False
+                self.preferred[mac] = (lease.pool, lease.address)
+                self.schedule(lease)
+            self.buffer.append(lease, now)
+        return lease
+
+
+class LeaseBuffer(object):
+    """
+    Write-behind buffer of the committed leases, a background thread saves
+    them in order as DHCPUser and DHCPHistory rows
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+        self.written = 0
+
+    def append(self, lease, now):
+        with self.condition:
+            self.pending.append((lease.mac, lease.pool, lease.address, now, lease.expires))
+            self.condition.notify()
+        if self.thread is None:
+            self.flush()
+
+    def write(self, mac, pool, address, now, expires):
+        ip_id = pool.ips.get(address)
+        if ip_id is None:
+            ip = DHCPIp(network=pool.network, address=str(ipaddr.IPAddress(address)))
+            ip.save()
+            ip_id = pool.ips[address] = ip.pk
+        if not DHCPUser.objects.filter(address=mac).update(ip=ip_id):
+            DHCPUser.objects.create(address=mac, ip_id=ip_id)
+        date = from_timestamp(now)
+        expires = from_timestamp(expires) if expires is not None else None
+        if not DHCPHistory.objects.filter(mac_id=mac, ip_id=ip_id).update(date=date, expires=expires):
+            DHCPHistory.objects.create(mac_id=mac, ip_id=ip_id, expires=expires)
+
+    def flush(self):
+        with self.condition:
+            pending, self.pending = self.pending, []
+        for entry in pending:
+            try:
+                self.write(*entry)
+            except Exception as ex:
+                logger.error("Error saving the lease of %s: %s" % (entry[0], ex))
+        self.written += len(pending)
+        return len(pending)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped and not self.pending:
+                    return
+            self.flush()
+
+    def start(self):
+        if self.thread is None:
+            self.stopped = False
+            self.thread = threading.Thread(target=self.run, name='dhcp-leases')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.flush()
+
+
+lease_manager = LeaseManager()
+
+
+@receiver(post_save, sender=DHCPNetwork)
+@receiver(post_delete, sender=DHCPNetwork)
+@receiver(post_delete, sender=DHCPUser)
+def dhcp_network_changed(sender, **kwargs):
+    lease_manager.changed.set()
+
+
+@receiver(post_save, sender=DHCPUser)
+def dhcp_user_saved(sender, instance, created, **kwargs):
+    if instance.static or not created:  # The new dynamic clients are saved by LeaseBuffer
+        lease_manager.changed.set()
@@ -1,82 +1,106 @@
 from __future__ import absolute_import
 
 from red_casa.dhcp.models import *
+from red_casa.dhcp.leases import lease_manager
+from red_casa.dhcp.codec import DHCPMessage, BOOTREQUEST, DISCOVER, REQUEST, SERVER_PORT, ANY_ADDR, BROADCAST_MAC
+from red_casa.dns.pool import WorkerPool
 
 from django.utils import six
 from django.conf import settings
 from django.utils.encoding import get_system_encoding, force_text
 from django.core.management.base import BaseCommand, CommandError
 
-from scapy.all import *
 from datetime import datetime
-import threading
 import socket
+import signal
 import errno
 import sys
+import os
 
+DHCP_WORKERS = 8  # Threads answering the packets
+if hasattr(settings, 'DHCP_WORKERS'):
+    DHCP_WORKERS = int(settings.DHCP_WORKERS)
 
-def response(pkg, mac, ip, stdout=None, stderr=None):
-    if stdout:
-        stdout.write("%s\n" % pkg.summary())
-    dhcp = pkg.getlayer(DHCP)
-    if dhcp:
-        recv_ops = dict(filter(lambda x: type(x) == tuple, dhcp.options))
-        message_type = recv_ops.get('message-type', None)
+DHCP_QUEUE_SIZE = 256  # Packets waiting for a worker, the next ones are dropped and the clients retry
+if hasattr(settings, 'DHCP_QUEUE_SIZE'):
+    DHCP_QUEUE_SIZE = int(settings.DHCP_QUEUE_SIZE)
 
-        if message_type == 1:
-            client_ip, dhcp_options = get_dhcp_options(pkg.src, 'offer', ip)
-            if client_ip is None:
-                if stderr:
-                    stderr.write("There is not more IPs.\n")
-                return
-            if stdout:
-                stdout.write('New DHCP discovered %(mac)s\n' % {'mac': pkg.src})
-        elif message_type == 3:
-            recv_ip_cliente = recv_ops.get('requested_addr', None)
-            if recv_ip_cliente is None:
-                if stderr:
-                    stderr.write("There is not Requested Address.\n")
-                return
-            client_ip, dhcp_options = get_dhcp_options(pkg.src, 'ack', ip)
-            if client_ip != recv_ip_cliente:
-                dhcp_options = [('message-type', 'nak'), ('server_id', ip), 'end']
-                if stderr:
-                    stderr.write('DHCP Ack NOT match %(ip_db)s %(ip_recv)s\n' % {'ip_db': client_ip,
-                                                                                 'ip_recv': recv_ip_cliente})
-            if stdout:
-                stdout.write('New DHCP request %(mac)s\n' % {'mac': pkg.src})
-        else:
-            return
-        dhcp_pkg = Ether(src=mac, dst=pkg.src) / \
-                   IP(src=ip, dst=client_ip) / \
-                   UDP(sport=67, dport=68) / \
-                   BOOTP(op=2, yiaddr=client_ip, siaddr=ip, giaddr='0.0.0.0', xid=pkg[BOOTP].xid) / \
-                   DHCP(options=dhcp_options)
-        sendp(dhcp_pkg)
+
+def answer(message_type, client_mac, ip, requested=None, stdout=None, stderr=None):
+    """
+    :param requested: Address asked for in the REQUEST
+    :return: (client ip, DHCP options) of the reply, (None, None) if there is not reply
+    """
+    if message_type == 1:
+        client_ip, dhcp_options = get_dhcp_options('offer', client_mac, ip)
+        if client_ip is None:
+            if stderr:
+                stderr.write("There is not more IPs.\n")
+            return None, None
         if stdout:
-            stdout.write('Send DHCP pkg: %s\n' % dhcp_pkg.summary())
-
-
-def get_dhcp_options(dhcp_type, mac, ip):
-    ops = []
-    try:
-        user = DHCPUser.objects.get(address=mac)
-    except DHCPUser.DoesNotExist:
-        user = DHCPUser.objects.create(address=mac)
-        # TODO Buscar directamente una IP en la red por defecto
-    if user.has_ip_available():
-        ops = user.gen_options(dhcp_type, server_id=ip)
+            stdout.write('New DHCP discovered %(mac)s\n' % {'mac': client_mac})
+    elif message_type == 3:
+        if requested is None:
+            if stderr:
+                stderr.write("There is not Requested Address.\n")
+            return None, None
+        client_ip, dhcp_options = get_dhcp_options('ack', client_mac, ip, requested)
+        if client_ip != requested:
+            dhcp_options = [('message-type', 'nak'), ('server_id', ip), 'end']
+            if stderr:
+                stderr.write('DHCP Ack NOT match %(ip_db)s %(ip_recv)s\n' % {'ip_db': client_ip,
+                                                                             'ip_recv': requested})
+            client_ip = None
+        if stdout:
+            stdout.write('New DHCP request %(mac)s\n' % {'mac': client_mac})
     else:
-        if user.search_ip():
-            ops = user.gen_options(dhcp_type, server_id=ip)
-        else:
-            # TODO  buscar una red por defecto para generar las IPs de esa red
-            return None, ops
-    return user.ip.address, ops
+        return None, None
+    return client_ip, dhcp_options
+
+
+def is_request(message):
+    """
+    :type message: DHCPMessage
+    :return: If it's a DISCOVER or REQUEST from a client
+    """
+    return message is not None and message.op == BOOTREQUEST and message.message_type in (DISCOVER, REQUEST)
+
+
+def handle_message(message, ip, stdout=None, stderr=None):
+    """
+    :type message: DHCPMessage
+    :return: (packed reply, (addr, port)) or (None, None) if there is not reply
+    """
+    server_id = message.server_id
+    if server_id and server_id != ip:
+        return None, None  # The client chose other server
+    requested = message.requested_addr
+    if requested is None and message.ciaddr != ANY_ADDR:
+        requested = message.ciaddr  # Renewing, RFC 2131 4.3.2
+    client_ip, dhcp_options = answer(message.message_type, message.mac, ip, requested, stdout, stderr)
+    if dhcp_options is None:
+        return None, None
+    return message.reply(client_ip, ip, dhcp_options), message.reply_address(client_ip, nak=client_ip is None)
+
+
+def get_dhcp_options(dhcp_type, mac, ip, requested=None):
+    """
+    :param requested: Address asked for in the REQUEST
+    :return: (client ip, DHCP options) or (None, []) if there is not IP for the client
+    """
+    if dhcp_type == 'offer':
+        lease = lease_manager.offer(mac)
+    else:
+        lease = lease_manager.request(mac, requested)
+    if lease is None:
+        return None, []
+    user = DHCPUser(address=mac, ip=lease.dhcp_ip())  # Only its options are read, cached by MAC
+    return lease.ip, user.gen_options(dhcp_type, server_id=ip)
 
 
 class Command(BaseCommand):
     help = 'Create a debug dhcp server'
+    pool = None  # WorkerPool answering the packets, None for answering them in the reading thread
 
     def add_arguments(self, parser):
         parser.add_argument('--iface', action='store', dest='iface', default=None, help='Interface for DHCP server.')
@@ -86,6 +110,12 @@ class Command(BaseCommand):
         parser.add_argument('--ip', action='store', dest='ip', default=None, help='DHCP server ip.')
         parser.add_argument('--remote', action='store', dest='remote', default='github.com',
                             help='IP or host to connect for detect the own IP.')
+        parser.add_argument('--engine', action='store', dest='engine', default='socket', choices=['socket', 'scapy'],
+                            help='Server engine, scapy sniffs and sends raw frames.')
+        parser.add_argument('--workers', action='store', dest='workers', type=int, default=DHCP_WORKERS,
+                            help='Threads answering the packets.')
+        parser.add_argument('--queue-size', action='store', dest='queue_size', type=int, default=DHCP_QUEUE_SIZE,
+                            help='Packets waiting for a worker before dropping them.')
 
     def execute(self, *args, **options):
         if options.get('no_color'):
@@ -131,34 +161,112 @@ class Command(BaseCommand):
             # Need to use an OS exit because sys.exit doesn't work in a thread
             os._exit(1)
         except KeyboardInterrupt:
+            lease_manager.stop()
+            self.write_stats()
             if shutdown_message:
                 self.stdout.write(shutdown_message)
             sys.exit(0)
 
+    def write_stats(self, *args):
+        """
+        Writes the leases of every network, also on SIGUSR1
+        """
+        for line in lease_manager.stats_lines():
+            self.stdout.write("%s\n" % line)
+        if self.pool is not None:
+            self.stdout.write("Workers: %(processed)d packets answered, %(dropped)d dropped, %(depth)d waiting\n" %
+                              self.pool.stats())
+
     def server(self, **options):
         iface = options.get('iface', None)
-        fam, hw = get_if_raw_hwaddr(iface)
-        mac = options.get('mac', hw)
         ip = options.get('ip', None)
         if ip is None:
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             s.connect((options.get('remote', 'github.com'), 80))
             ip, port = s.getsockname()
             s.close()
+        lease_manager.load(ip).start()
+        if options.get('use_threading', True) and options.get('workers', DHCP_WORKERS) > 0:
+            self.pool = WorkerPool(options.get('workers', DHCP_WORKERS), options.get('queue_size', DHCP_QUEUE_SIZE),
+                                   name='dhcp-worker')
+            self.pool.start()
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.write_stats)
+            signal.siginterrupt(signal.SIGUSR1, False)  # Don't break the blocking reads on Python 2
+        if options.get('engine', 'socket') == 'socket':
+            self.server_socket(ip, iface)
+        else:
+            self.server_scapy(ip, **options)
+
+    def dispatch(self, func, *args):
+        """
+        Answers in a worker, when the queue is full the packet is dropped as the network would do
+        """
+        if self.pool is None:
+            func(*args)
+        else:
+            self.pool.submit(func, *args)
+
+    def server_socket(self, ip, iface=None):
+        """
+        Serves on the UDP port 67 with one socket for receiving and sending
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if iface:
+            sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_BINDTODEVICE', 25), iface.encode('utf-8'))
+        sock.bind(('', SERVER_PORT))
+
+        def reply(data):
+            try:
+                message = DHCPMessage.parse(data)
+                if not is_request(message):
+                    return
+                self.stdout.write("%s\n" % message.summary())
+                packed, address = handle_message(message, ip, self.stdout, self.stderr)
+                if packed:
+                    sock.sendto(packed, address)
+                    self.stdout.write('Send DHCP pkg to %s:%d\n' % address)
+            except Exception as ex:
+                self.stderr.write("Error answering DHCP packet: %s\n" % ex)
+
+        while True:
+            data, addr = sock.recvfrom(4096)
+            self.dispatch(reply, data)
+
+    def server_scapy(self, ip, **options):
+        """
+        Sniffs with a kernel filter for the client to server packets only. The UDP payload is not
+        dissected by scapy, it's parsed once to DHCPMessage and the replies are sent by one L2 socket.
+        """
+        try:
+            from scapy.all import Ether, IP, UDP, BOOTP, Raw, conf, get_if_hwaddr, split_layers, sniff
+        except ImportError:
+            raise CommandError('The scapy engine needs scapy installed.')
+        iface = options.get('iface', None) or conf.iface
+        mac = options.get('mac') or get_if_hwaddr(iface)
+        split_layers(UDP, BOOTP, dport=67, sport=68)
+        l2socket = conf.L2socket(iface=iface)
+
+        def reply(message, source):
+            try:
+                self.stdout.write("%s\n" % message.summary())
+                packed, address = handle_message(message, ip, self.stdout, self.stderr)
+                if packed:
+                    l2socket.send(Ether(src=mac, dst=message.reply_mac(address[0], source)) /
+                                  IP(src=ip, dst=address[0]) /
+                                  UDP(sport=SERVER_PORT, dport=address[1]) /
+                                  Raw(packed))
+                    self.stdout.write('Send DHCP pkg to %s:%d\n' % address)
+            except Exception as ex:
+                self.stderr.write("Error answering DHCP packet: %s\n" % ex)
 
         def prn(pkg):
-            if options.get('use_threading', True):
-                threading.Thread(target=response, args=(pkg, mac, ip, self.stdout, self.stderr)).start()
-            else:
-                response(pkg, mac, ip, self.stdout, self.stderr)
-
-        def lfilter(pkg):
-            if pkg.haslayer(DHCP):
-                dhcp = pkg.getlayer(DHCP)
-                if dhcp and pkg.sport == 68 and pkg.dport == 67:
-                    recv_ops = dict(filter(lambda x: type(x) == tuple, dhcp.options))
-                    message_type = recv_ops.get('message-type', None)
-                    if (message_type == 1 and pkg.dst == 'ff:ff:ff:ff:ff:ff') or message_type == 3:
-                        return True
-            return False
-        sniff(filter='port 67 or port 68', lfilter=lfilter, prn=prn, iface=iface)
+            message = DHCPMessage.parse(bytes(pkg[UDP].payload)) if UDP in pkg else None
+            if not is_request(message):
+                return
+            if message.message_type == DISCOVER and pkg.dst != BROADCAST_MAC:
+                return
+            self.dispatch(reply, message, pkg.src)
+        sniff(filter='udp and dst port 67', prn=prn, iface=iface, store=0)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dhcp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dhcphistory',
+            name='expires',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+        ),
+    ]
@@ -1,5 +1,9 @@
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from red_casa.dhcp.options import options_cache
 import ipaddr
 from datetime import datetime, timedelta
 import socket
@@ -266,45 +270,46 @@ class DHCPUser(models.Model):
             return True
         return DHCPHistory.has_available(self.ip)
 
+    def resolve_options(self):
+        """
+        Merges the user options over the network ones with two queries
+        :return: (subnet_mask, server_id, [(key, value)]) for the options cache
+        """
+        network = self.ip.network
+        network_values = dict((op.option, op.get_value()) for op in network.options.all())
+        user_values = dict((op.option, op.get_value()) for op in self.options.all())
+        values = dict(network_values)
+        values.update(user_values)
+        ops = [
+            ('lease_time', values.get(LEASE_TIME, DHCP_LEASE_DEFAULT)),
+            ('router', user_values.get(ROUTER, network.router.split(DHCP_IP_LIST_SEPARATOR))),
+            ('domain', user_values.get(DOMAIN, network.domain)),
+            ('name_server', user_values.get(NAME_SERVER, network.name_server.split(DHCP_IP_LIST_SEPARATOR))),
+        ]
+        for (num, key) in DHCP_OPTIONS:
+            if num not in [SUBNET_MASK, SERVER_ID, LEASE_TIME, ROUTER, DOMAIN, NAME_SERVER] and num in values:
+                ops.append((key, values[num]))
+        return user_values.get(SUBNET_MASK, network.subnet_mask), values.get(SERVER_ID), ops
+
     def gen_options(self, dhcp_type, server_id=None, host_discovery=None):
         ops = [('message-type', dhcp_type)]
         if not self.ip:
             raise RuntimeError('Ip is not assigned yet')
-        ops.append(('subnet_mask', self.subnet_mask))
-
-        if server_id:
-            ops.append(('server_id', server_id))
-        else:
-            try:
-                ops.append(('server_id', self.options.get(option=SERVER_ID).get_value()))
-            except DHCPOption.DoesNotExist:
-                try:
-                    ops.append(('server_id', self.ip.network.options.get(option=SERVER_ID).get_value()))
-                except DHCPOption.DoesNotExist:
-                    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    if host_discovery:
-                        s.connect((host_discovery, 80))
-                    else:
-                        s.connect((DHCP_IP_DISCOVER_HOST, 80))
-                    self_ip, port = s.getsockname()
-                    s.close()
-                    ops.append(('server_id', self_ip))
-
-        ops.append(('lease_time', self.lease_time))
-        ops.append(('router', self.router))
-        ops.append(('domain', self.domain))
-        ops.append(('name_server', self.name_server))
-
-        for (num, key) in DHCP_OPTIONS:
-            if num in [SUBNET_MASK, SERVER_ID, LEASE_TIME, ROUTER, DOMAIN, NAME_SERVER]:
-                continue
-            try:
-                ops.append((key, self.options.get(option=num).get_value()))
-            except DHCPOption.DoesNotExist:
-                try:
-                    ops.append((key, self.ip.network.options.get(option=num).get_value()))
-                except DHCPOption.DoesNotExist:
-                    continue
+        resolved = options_cache.get(self.address, self.ip.network_id, self.resolve_options)
+        ops.append(('subnet_mask', resolved.subnet_mask))
+
+        if not server_id:
+            server_id = resolved.server_id
+        if not server_id:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if host_discovery:
+                s.connect((host_discovery, 80))
+            else:
+                s.connect((DHCP_IP_DISCOVER_HOST, 80))
+            server_id, port = s.getsockname()
+            s.close()
+        ops.append(('server_id', server_id))
+        ops.extend(resolved.options)
         ops.append('end')
         return ops
 
@@ -366,6 +371,7 @@ class DHCPHistory(models.Model):
     ip = models.ForeignKey(DHCPIp)
     mac = models.ForeignKey(DHCPUser)
     date = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField(null=True, blank=True, db_index=True)
 
     class Meta:
         unique_together = ('mac', 'ip')
@@ -401,17 +407,42 @@ class DHCPHistory(models.Model):
         if not last_assign:
             return None
         old_user = last_assign.mac
-        lease = DHCP_LEASE_DEFAULT
-        try:
-            lease = old_user.options.get(option=LEASE_TIME)
-        except DHCPOption.DoesNotExist:
+        expire = last_assign.expires
+        if expire is None:  # Saved before the expiry was stored
+            lease = DHCP_LEASE_DEFAULT
             try:
-                lease = ip.network.options.get(option=LEASE_TIME)
+                lease = old_user.options.get(option=LEASE_TIME).get_value()
             except DHCPOption.DoesNotExist:
-                pass
-        expire = last_assign.date + timedelta(seconds=lease)
-        if expire < datetime.utcnow():
+                try:
+                    lease = ip.network.options.get(option=LEASE_TIME).get_value()
+                except DHCPOption.DoesNotExist:
+                    pass
+            expire = last_assign.date + timedelta(seconds=lease)
+        if expire < (timezone.now() if timezone.is_aware(expire) else datetime.now()):
             if last:
                 return old_user
             return None  # La asignacion ha cadudado se le puede volver a asignar
         return old_user
+
+
+@receiver(post_save, sender=DHCPOption)
+@receiver(post_delete, sender=DHCPOption)
+@receiver(post_save, sender=DHCPNetwork)
+@receiver(post_delete, sender=DHCPNetwork)
+@receiver(m2m_changed, sender=DHCPNetwork.options.through)
+def dhcp_options_changed(sender, **kwargs):
+    options_cache.clear()
+
+
+@receiver(post_save, sender=DHCPUser)
+@receiver(post_delete, sender=DHCPUser)
+def dhcp_user_changed(sender, instance, **kwargs):
+    options_cache.invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender=DHCPUser.options.through)
+def dhcp_user_options_changed(sender, instance, reverse, **kwargs):
+    if reverse:  # Changed from the DHCPOption side
+        options_cache.clear()
+    else:
+        options_cache.invalidate(instance.pk)
@@ -0,0 +1,72 @@
+"""
+Resolved DHCP options of every (user, network)
+
+The user options merged over the network ones are computed once and kept
+until the signals of DHCPOption, DHCPNetwork and DHCPUser drop them. Changes
+saved by other processes (the admin) are picked up when the entry gets
+older than DHCP_OPTIONS_CACHE_TTL.
+"""
+from django.conf import settings
+
+import threading
+import time
+
+DHCP_OPTIONS_CACHE_TTL = 60
+if hasattr(settings, 'DHCP_OPTIONS_CACHE_TTL'):
+    DHCP_OPTIONS_CACHE_TTL = int(settings.DHCP_OPTIONS_CACHE_TTL)
+
+
+class ResolvedOptions(object):
+    __slots__ = ('subnet_mask', 'server_id', 'options', 'expires')
+
+    def __init__(self, subnet_mask, server_id, options, expires):
+        self.subnet_mask = subnet_mask
+        self.server_id = server_id  # None if it must be discovered
+        self.options = options  # [(key, value)] after the server_id
+        self.expires = expires
+
+    @property
+    def lease_time(self):
+        for key, value in self.options:
+            if key == 'lease_time':
+                return int(value)
+        return None
+
+
+class OptionsCache(object):
+
+    def __init__(self, ttl=DHCP_OPTIONS_CACHE_TTL):
+        self.ttl = ttl
+        self.users = {}  # mac -> {network pk -> ResolvedOptions}
+        self.mutex = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, mac, network_id, resolve):
+        """
+        :param resolve: Function returning (subnet_mask, server_id, options) on a miss
+        :rtype: ResolvedOptions
+        """
+        now = time.time()
+        resolved = self.users.get(mac, {}).get(network_id)
+        if resolved is not None and resolved.expires > now:
+            self.hits += 1
+            return resolved
+        self.misses += 1
+        subnet_mask, server_id, options = resolve()
+        resolved = ResolvedOptions(subnet_mask, server_id, options, now + self.ttl)
+        if self.ttl > 0:
+            with self.mutex:
+                self.users.setdefault(mac, {})[network_id] = resolved
+        return resolved
+
+    def invalidate(self, mac):
+        with self.mutex:
+            self.users.pop(mac, None)
+
+    def clear(self):
+        with self.mutex:
+            self.users = {}
+
+
+options_cache = OptionsCache()
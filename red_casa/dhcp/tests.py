@@ -0,0 +1,420 @@
+from django.test import SimpleTestCase, TestCase
+
+import ipaddr
+import socket
+import struct
+import time
+
+from red_casa.dhcp.codec import DHCPMessage, BOOTP, MAGIC_COOKIE, BOOTREQUEST, BOOTREPLY, BROADCAST_FLAG, \
+    SERVER_PORT, CLIENT_PORT, BROADCAST_ADDR, BROADCAST_MAC, DISCOVER, REQUEST, MESSAGE_TYPE, PARAM_REQ_LIST, PAD, \
+    END, encode_options, decode_options, mac_to_str, str_to_mac
+from red_casa.dhcp.models import DHCPNetwork, DHCPIp, DHCPUser, DHCPHistory, DHCPOption, SUBNET_MASK, ROUTER, \
+    DOMAIN, REQUESTED_ADDR, LEASE_TIME, SERVER_ID, TIME_ZONE, DHCP_LEASE_DEFAULT
+from red_casa.dhcp.leases import NetworkPool, LeaseManager, Lease
+from red_casa.dhcp.options import OptionsCache, options_cache
+
+MAC = '00:11:22:aa:bb:cc'
+
+
+def bootp(op=BOOTREQUEST, hlen=6, xid=0x1234abcd, flags=0, ciaddr='0.0.0.0', giaddr='0.0.0.0', mac=MAC):
+    return BOOTP.pack(op, 1, hlen, 0, xid, 0, flags, socket.inet_aton(ciaddr), socket.inet_aton('0.0.0.0'),
+                      socket.inet_aton('0.0.0.0'), socket.inet_aton(giaddr), str_to_mac(mac), b'', b'')
+
+
+def option(code, value):
+    return struct.pack('!BB', code, len(value)) + value
+
+
+def request(message_type=DISCOVER, *options, **kwargs):
+    return bootp(**kwargs) + MAGIC_COOKIE + option(MESSAGE_TYPE, struct.pack('!B', message_type)) + \
+        b''.join(options) + struct.pack('!B', END)
+
+
+class DecodeOptionsTest(SimpleTestCase):
+
+    def test_table(self):
+        cases = [
+            ('empty', b'', {}),
+            ('only end', b'\xff', {}),
+            ('one option', option(MESSAGE_TYPE, b'\x01') + b'\xff', {MESSAGE_TYPE: b'\x01'}),
+            ('pads', b'\x00\x00' + option(MESSAGE_TYPE, b'\x03') + b'\x00\xff', {MESSAGE_TYPE: b'\x03'}),
+            ('no end', option(MESSAGE_TYPE, b'\x01'), {MESSAGE_TYPE: b'\x01'}),
+            ('after end', b'\xff' + option(MESSAGE_TYPE, b'\x01'), {}),
+            ('zero length', option(DOMAIN, b'') + b'\xff', {DOMAIN: b''}),
+            ('repeated option', option(DOMAIN, b'exam') + option(DOMAIN, b'ple') + b'\xff', {DOMAIN: b'example'}),
+            ('code without length', option(MESSAGE_TYPE, b'\x01') + struct.pack('!B', DOMAIN),
+             {MESSAGE_TYPE: b'\x01'}),
+            ('truncated value', struct.pack('!BB', DOMAIN, 10) + b'exa', {DOMAIN: b'exa'}),
+        ]
+        for description, data, expected in cases:
+            self.assertEqual(decode_options(data), expected, description)
+
+    def test_round_trip(self):
+        options = [('message-type', 'offer'), ('subnet_mask', '255.255.255.0'),
+                   ('router', ['192.168.1.1', '192.168.1.2']), ('domain', 'example.com'), ('lease_time', 3600),
+                   ('time_zone', -3600), (SERVER_ID, '192.168.1.1'), 'end']
+        data = encode_options(options)
+        self.assertEqual(data[:4], MAGIC_COOKIE)
+        self.assertEqual(data[-1:], struct.pack('!B', END))
+        self.assertEqual(decode_options(data[4:]), {
+            MESSAGE_TYPE: b'\x02', SUBNET_MASK: socket.inet_aton('255.255.255.0'),
+            ROUTER: socket.inet_aton('192.168.1.1') + socket.inet_aton('192.168.1.2'), DOMAIN: b'example.com',
+            LEASE_TIME: struct.pack('!I', 3600), TIME_ZONE: struct.pack('!i', -3600),
+            SERVER_ID: socket.inet_aton('192.168.1.1'),
+        })
+
+    def test_long_option(self):
+        data = encode_options([('domain', 'a' * 300)])
+        self.assertEqual(data[4:6], struct.pack('!BB', DOMAIN, 255))  # RFC 3396 split
+        self.assertEqual(decode_options(data[4:]), {DOMAIN: b'a' * 300})
+
+
+class DHCPMessageParseTest(SimpleTestCase):
+
+    def test_malformed(self):
+        packet = request()
+        cases = [
+            ('empty', b''),
+            ('short BOOTP', packet[:BOOTP.size - 1]),
+            ('without cookie', packet[:BOOTP.size]),
+            ('truncated cookie', packet[:BOOTP.size + 2]),
+            ('bad cookie', packet[:BOOTP.size] + b'\x63\x82\x53\x64' + packet[BOOTP.size + 4:]),
+        ]
+        for description, data in cases:
+            self.assertIsNone(DHCPMessage.parse(data), description)
+
+    def test_options_table(self):
+        cases = [  # description, data, message_type, requested_addr, server_id
+            ('discover', request(), DISCOVER, None, None),
+            ('request', request(REQUEST, option(REQUESTED_ADDR, socket.inet_aton('10.0.0.5')),
+                                option(SERVER_ID, socket.inet_aton('10.0.0.1'))), REQUEST, '10.0.0.5', '10.0.0.1'),
+            ('only cookie', bootp() + MAGIC_COOKIE, None, None, None),
+            ('empty message type', bootp() + MAGIC_COOKIE + option(MESSAGE_TYPE, b'') + b'\xff', None, None, None),
+            ('short address', request(REQUEST, option(REQUESTED_ADDR, b'\x0a\x00\x00')), REQUEST, None, None),
+            ('long address', request(REQUEST, option(REQUESTED_ADDR, b'\x0a\x00\x00\x05\x00')), REQUEST, None,
+             None),
+            ('truncated address', (request(REQUEST) + option(REQUESTED_ADDR, socket.inet_aton('10.0.0.5')))[:-2],
+             REQUEST, None, None),  # After the end option
+            ('truncated options', request(REQUEST, option(SERVER_ID, socket.inet_aton('10.0.0.1')))[:-3], REQUEST,
+             None, None),
+            ('pads', request(REQUEST, struct.pack('!BB', PAD, PAD), option(PARAM_REQ_LIST, b'\x01\x03\x06')),
+             REQUEST, None, None),
+        ]
+        for description, data, message_type, requested_addr, server_id in cases:
+            message = DHCPMessage.parse(data)
+            self.assertEqual((message.message_type, message.requested_addr, message.server_id),
+                             (message_type, requested_addr, server_id), description)
+            self.assertEqual(message.mac, MAC, description)
+
+    def test_fields(self):
+        message = DHCPMessage.parse(request(flags=BROADCAST_FLAG, ciaddr='10.0.0.7', giaddr='10.1.0.1'))
+        self.assertEqual((message.op, message.xid, message.flags, message.ciaddr, message.giaddr),
+                         (BOOTREQUEST, 0x1234abcd, BROADCAST_FLAG, '10.0.0.7', '10.1.0.1'))
+        self.assertEqual(len(message.chaddr), 6)
+
+    def test_hlen(self):
+        cases = [
+            ('short', 3, '00:11:22'),
+            ('too long', 200, '00:11:22:aa:bb:cc:00:00:00:00:00:00:00:00:00:00'),
+        ]
+        for description, hlen, mac in cases:
+            self.assertEqual(DHCPMessage.parse(request(hlen=hlen)).mac, mac, description)
+
+    def test_reply_address(self):
+        cases = [  # description, request kwargs, nak, destination
+            ('relay', {'giaddr': '10.1.0.1', 'ciaddr': '10.0.0.7'}, False, ('10.1.0.1', SERVER_PORT)),
+            ('relay nak', {'giaddr': '10.1.0.1'}, True, ('10.1.0.1', SERVER_PORT)),
+            ('renew', {'ciaddr': '10.0.0.7'}, False, ('10.0.0.7', CLIENT_PORT)),
+            ('renew nak', {'ciaddr': '10.0.0.7'}, True, (BROADCAST_ADDR, CLIENT_PORT)),
+            ('not configured', {}, False, (BROADCAST_ADDR, CLIENT_PORT)),
+        ]
+        for description, kwargs, nak, destination in cases:
+            message = DHCPMessage.parse(request(**kwargs))
+            self.assertEqual(message.reply_address('10.0.0.9', nak), destination, description)
+
+    def test_reply_mac(self):
+        relay = '00:aa:00:aa:00:aa'
+        cases = [  # description, request kwargs, address, mac
+            ('relay', {'giaddr': '10.1.0.1'}, '10.1.0.1', relay),
+            ('relay with broadcast flag', {'giaddr': '10.1.0.1', 'flags': BROADCAST_FLAG}, '10.1.0.1', relay),
+            ('renew', {'ciaddr': '10.0.0.7'}, '10.0.0.7', MAC),
+            ('broadcast flag', {'flags': BROADCAST_FLAG}, BROADCAST_ADDR, BROADCAST_MAC),
+            ('not configured', {}, BROADCAST_ADDR, MAC),
+        ]
+        for description, kwargs, address, mac in cases:
+            message = DHCPMessage.parse(request(**kwargs))
+            self.assertEqual(message.reply_mac(address, relay), mac, description)
+
+
+class DHCPMessageReplyTest(SimpleTestCase):
+
+    def test_reply(self):
+        message = DHCPMessage.parse(request(REQUEST, flags=BROADCAST_FLAG, giaddr='10.1.0.1'))
+        data = message.reply('10.0.0.9', '10.0.0.1', [('message-type', 'ack'), ('lease_time', 600), 'end'])
+        reply = DHCPMessage.parse(data)
+        self.assertEqual((reply.op, reply.xid, reply.flags, reply.yiaddr, reply.siaddr, reply.giaddr, reply.mac),
+                         (BOOTREPLY, 0x1234abcd, BROADCAST_FLAG, '10.0.0.9', '10.0.0.1', '10.1.0.1', MAC))
+        self.assertEqual(reply.options, {MESSAGE_TYPE: b'\x05', LEASE_TIME: struct.pack('!I', 600)})
+
+    def test_nak(self):
+        message = DHCPMessage.parse(request(REQUEST, ciaddr='10.0.0.7'))
+        reply = DHCPMessage.parse(message.reply(None, '10.0.0.1', [('message-type', 'nak'), 'end']))
+        self.assertEqual((reply.ciaddr, reply.yiaddr, reply.message_type), ('10.0.0.7', '0.0.0.0', 6))
+
+    def test_mac(self):
+        cases = [
+            ('lower', '00:11:22:aa:bb:cc'),
+            ('upper', '00:11:22:AA:BB:CC'),
+        ]
+        for description, mac in cases:
+            self.assertEqual(mac_to_str(str_to_mac(mac)), MAC, description)
+
+
+def address(ip):
+    return int(ipaddr.IPAddress(ip))
+
+
+class NetworkPoolTest(SimpleTestCase):
+
+    def pool(self, router='10.0.0.1', subnet_mask='255.255.255.248'):
+        return NetworkPool(DHCPNetwork(router=router, subnet_mask=subnet_mask, name_server='10.0.0.1'))
+
+    def test_size(self):
+        cases = [
+            ('/24', '192.168.1.1', '255.255.255.0', 253),
+            ('two routers', '192.168.1.1,192.168.1.254', '255.255.255.0', 252),
+            ('/29', '10.0.0.1', '255.255.255.248', 5),
+            ('/30', '10.0.0.1', '255.255.255.252', 1),
+            ('/31 without network and broadcast', '10.0.0.0', '255.255.255.254', 1),
+        ]
+        for description, router, subnet_mask, size in cases:
+            pool = self.pool(router, subnet_mask)
+            self.assertEqual(pool.size, size, description)
+            addresses = set()
+            while True:
+                allocated = pool.allocate()
+                if allocated is None:
+                    break
+                pool.take(Lease('00:00:00:00:00:01', pool, allocated))
+                addresses.add(allocated)
+            self.assertEqual(len(addresses), size, description)
+            self.assertFalse(pool.reserved & addresses, description)
+
+    def test_take(self):
+        pool = self.pool()
+        pool.take(Lease('00:00:00:00:00:01', pool, address('10.0.0.4')))
+        cases = [
+            ('free', '10.0.0.3', True),
+            ('taken', '10.0.0.4', False),
+            ('router', '10.0.0.1', False),
+            ('network', '10.0.0.0', False),
+            ('broadcast', '10.0.0.7', False),
+            ('outside', '10.0.1.3', False),
+        ]
+        for description, ip, taken in cases:
+            self.assertEqual(pool.take(Lease('00:00:00:00:00:02', pool, address(ip))), taken, description)
+
+    def test_allocate_and_release(self):
+        pool = self.pool()
+        pool.take(Lease('00:00:00:00:00:01', pool, address('10.0.0.3')))  # Ahead of the cursor
+        leases = []
+        for ip in ('10.0.0.2', '10.0.0.4', '10.0.0.5'):
+            lease = Lease('00:00:00:00:00:02', pool, pool.allocate())
+            self.assertEqual(lease.ip, ip)
+            pool.take(lease)
+            leases.append(lease)
+        pool.release(leases[1])
+        pool.release(leases[0])
+        pool.release(Lease('00:00:00:00:00:03', pool, address('10.0.0.5')))  # Not the owner
+        cases = ['10.0.0.4', '10.0.0.2', '10.0.0.6', None]  # Free list in release order, then the cursor
+        for ip in cases:
+            allocated = pool.allocate()
+            self.assertEqual(allocated and str(ipaddr.IPAddress(allocated)), ip)
+            if allocated is not None:
+                pool.take(Lease('00:00:00:00:00:04', pool, allocated))
+
+    def test_free_list_skips_taken(self):
+        pool = self.pool()
+        lease = Lease('00:00:00:00:00:01', pool, pool.allocate())
+        pool.take(lease)
+        pool.release(lease)
+        pool.take(Lease('00:00:00:00:00:02', pool, lease.address))  # Taken again by the client asking for it
+        self.assertEqual(str(ipaddr.IPAddress(pool.allocate())), '10.0.0.3')
+
+
+class LeaseManagerTest(TestCase):
+    SERVER = '192.168.1.1'
+    MACS = ['00:00:00:00:00:%02x' % i for i in range(1, 8)]
+
+    def setUp(self):
+        options_cache.clear()
+        self.network = DHCPNetwork.objects.create(router=self.SERVER, subnet_mask='255.255.255.248',
+                                                  name_server='8.8.8.8')
+        option = DHCPOption.objects.create(option=LEASE_TIME, value='600')
+        self.network.options.add(option)
+        self.manager = LeaseManager(reap_interval=0).load(self.SERVER)
+
+    def tearDown(self):
+        options_cache.clear()
+
+    def test_offer_and_request(self):
+        mac = self.MACS[0]
+        offered = self.manager.offer(mac)
+        self.assertEqual((offered.ip, offered.offered), ('192.168.1.2', True))
+        self.assertIs(self.manager.offer(mac), offered)
+        lease = self.manager.request(mac, '192.168.1.2')
+        self.assertFalse(lease.offered)
+        self.assertAlmostEqual(lease.expires, time.time() + 600, delta=5)
+        self.assertEqual(DHCPUser.objects.get(address=mac).ip.address, '192.168.1.2')  # Buffer without thread
+        self.assertTrue(DHCPHistory.objects.filter(mac_id=mac, ip__address='192.168.1.2').exists())
+
+    def test_request_table(self):
+        self.manager.request(self.MACS[1], '192.168.1.3')
+        cases = [
+            ('other free address', '192.168.1.4', '192.168.1.4'),
+            ('taken address', '192.168.1.3', None),
+            ('router', self.SERVER, None),
+            ('broadcast', '192.168.1.7', None),
+            ('other network', '10.0.0.2', None),
+        ]
+        for description, requested, ip in cases:
+            lease = self.manager.request(self.MACS[0], requested)
+            self.assertEqual(lease and lease.ip, ip, description)
+
+    def test_exhausted_and_expire(self):
+        offered = [self.manager.offer(mac).ip for mac in self.MACS[:5]]
+        self.assertEqual(offered, ['192.168.1.%d' % i for i in range(2, 7)])
+        self.assertIsNone(self.manager.offer(self.MACS[5]))
+        self.assertEqual(self.manager.expire(time.time() + self.manager.offer_time + 1, batch=2), 2)
+        self.assertEqual(self.manager.stats()[0]['free'], 2)
+        self.assertEqual(self.manager.offer(self.MACS[5]).ip, '192.168.1.2')
+        self.assertEqual(self.manager.expire(time.time() + self.manager.offer_time + 1), 4)
+        self.assertEqual(self.manager.stats()[0]['reaped'], 6)
+
+    def test_static(self):
+        ip = DHCPIp.objects.create(network=self.network, address='192.168.1.2')
+        DHCPUser.objects.create(address=self.MACS[0], static=True, ip=ip)
+        self.manager.load(self.SERVER)
+        self.assertEqual(self.manager.offer(self.MACS[1]).ip, '192.168.1.3')
+        self.assertIsNone(self.manager.request(self.MACS[1], '192.168.1.2'))
+        self.assertIsNone(self.manager.request(self.MACS[0], '192.168.1.4'))
+        lease = self.manager.request(self.MACS[0], '192.168.1.2')
+        self.assertTrue(lease.static)
+        self.assertIsNone(lease.expires)
+
+    def test_load_history(self):
+        self.manager.request(self.MACS[0], '192.168.1.5')
+        manager = LeaseManager(reap_interval=0).load(self.SERVER)
+        self.assertEqual(manager.leases[self.MACS[0]].ip, '192.168.1.5')
+        self.assertEqual(manager.offer(self.MACS[0]).ip, '192.168.1.5')
+        self.assertEqual(manager.offer(self.MACS[1]).ip, '192.168.1.2')
+
+    def test_reload(self):
+        lease = self.manager.request(self.MACS[0], '192.168.1.2')
+        self.manager.offer(self.MACS[1])  # 192.168.1.3
+        ip = DHCPIp.objects.create(network=self.network, address='192.168.1.3')
+        DHCPUser.objects.create(address=self.MACS[2], static=True, ip=ip)
+        self.manager.reload()
+        self.assertEqual(self.manager.leases[self.MACS[0]].ip, '192.168.1.2')
+        self.assertEqual(self.manager.leases[self.MACS[0]].expires, lease.expires)
+        self.assertTrue(self.manager.leases[self.MACS[2]].static)
+        self.assertNotIn(self.MACS[1], self.manager.leases)  # Its offer lost against the static binding
+        self.assertEqual(self.manager.offer(self.MACS[1]).ip, '192.168.1.4')
+        self.assertEqual(self.manager.preferred[self.MACS[0]][1], address('192.168.1.2'))
+
+    def test_reload_removed_network(self):
+        self.manager.request(self.MACS[0], '192.168.1.2')
+        DHCPHistory.objects.all().delete()
+        DHCPUser.objects.all().delete()
+        self.network.delete()
+        self.manager.reload()
+        self.assertEqual((self.manager.pools, self.manager.leases, self.manager.preferred), ([], {}, {}))
+        self.assertIsNone(self.manager.offer(self.MACS[0]))
+
+
+class OptionsCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.resolved = []
+
+    def resolve(self):
+        self.resolved.append(True)
+        return '255.255.255.0', None, [('lease_time', 600)]
+
+    def test_get_and_invalidate(self):
+        cache = OptionsCache(ttl=60)
+        cases = [  # description, action before the get, resolved
+            ('Miss', None, True),
+            ('Hit', None, False),
+            ('User invalidated', lambda: cache.invalidate(MAC), True),
+            ('Other user invalidated', lambda: cache.invalidate('00:00:00:00:00:01'), False),
+            ('Expired', lambda: setattr(cache.users[MAC][1], 'expires', time.time() - 1), True),
+            ('Cleared', cache.clear, True),
+        ]
+        for description, action, resolved in cases:
+            if action:
+                action()
+            del self.resolved[:]
+            options = cache.get(MAC, 1, self.resolve)
+            self.assertEqual(bool(self.resolved), resolved, description)
+            self.assertEqual((options.subnet_mask, options.server_id, options.lease_time), ('255.255.255.0', None, 600),
+                             description)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_disabled(self):
+        cache = OptionsCache(ttl=0)
+        cache.get(MAC, 1, self.resolve)
+        cache.get(MAC, 1, self.resolve)
+        self.assertEqual((len(self.resolved), cache.users), (2, {}))
+
+
+class ResolveOptionsTest(TestCase):
+
+    def setUp(self):
+        options_cache.clear()
+        self.network = DHCPNetwork.objects.create(router='192.168.1.1', subnet_mask='255.255.255.0',
+                                                  name_server='8.8.8.8', domain='local')
+        self.lease_time = DHCPOption.objects.create(option=LEASE_TIME, value='600')
+        self.network.options.add(self.lease_time, DHCPOption.objects.create(option=TIME_ZONE, value='3600'),
+                                 DHCPOption.objects.create(option=DOMAIN, value='network.example.com'))
+        ip = DHCPIp.objects.create(network=self.network, address='192.168.1.10')
+        self.user = DHCPUser.objects.create(address=MAC, ip=ip)
+
+    def tearDown(self):
+        options_cache.clear()
+
+    def options(self):
+        return options_cache.get(MAC, self.network.pk, self.user.resolve_options)
+
+    def test_order(self):
+        self.assertEqual(self.user.resolve_options(), ('255.255.255.0', None, [
+            ('lease_time', 600),
+            ('router', ['192.168.1.1']),
+            ('domain', 'local'),  # The network field, not its option
+            ('name_server', ['8.8.8.8']),
+            ('time_zone', 3600),
+        ]))
+        self.user.options.add(DHCPOption.objects.create(option=LEASE_TIME, value='300'),
+                              DHCPOption.objects.create(option=DOMAIN, value='user.example.com'),
+                              DHCPOption.objects.create(option=SUBNET_MASK, value='255.255.0.0'),
+                              DHCPOption.objects.create(option=SERVER_ID, value='192.168.1.1'))
+        self.assertEqual(self.user.resolve_options(), ('255.255.0.0', '192.168.1.1', [
+            ('lease_time', 300),  # The user options over the network ones
+            ('router', ['192.168.1.1']),
+            ('domain', 'user.example.com'),
+            ('name_server', ['8.8.8.8']),
+            ('time_zone', 3600),
+        ]))
+
+    def test_invalidation(self):
+        self.assertEqual(self.options().lease_time, 600)
+        self.lease_time.value = '900'
+        self.lease_time.save()
+        self.assertEqual(self.options().lease_time, 900, 'Network option saved')
+        user_lease_time = DHCPOption.objects.create(option=LEASE_TIME, value='300')
+        self.user.options.add(user_lease_time)
+        self.assertEqual(self.options().lease_time, 300, 'User option added')
+        self.user.options.remove(user_lease_time)
+        self.assertEqual(self.options().lease_time, 900, 'User option removed')
+        self.network.options.remove(self.lease_time)
+        self.assertEqual(self.options().lease_time, DHCP_LEASE_DEFAULT, 'Network option removed')
@@ -0,0 +1,180 @@
+"""
+asyncio engine for the dns_server command (Python 3.5+)
+
+All the queries are handled in one event loop, the database work is done in a
+bounded thread pool and the relayed queries are sent without blocking.
+"""
+from __future__ import absolute_import
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from concurrent.futures import ThreadPoolExecutor
+from dnslib import DNSRecord, QTYPE, CLASS
+import asyncio
+import logging
+import struct
+import time
+
+from red_casa.dns.cache import cache_key, add_record
+from red_casa.dns.policy import RELAY, LOCKED
+from red_casa.dns import metrics as dns_metrics
+from red_casa.dns.wire import edns_payload, udp_payload, DNS_TCP_IDLE_TIMEOUT
+from red_casa.dns.upstream import DNS_STALE_DEADLINE
+from red_casa.dns.singleflight import relay_flight
+from red_casa.dns.touch import touch_buffer
+
+logger = logging.getLogger('dns_server')
+
+DNS_DB_WORKERS = 8
+if hasattr(settings, 'DNS_DB_WORKERS'):
+    DNS_DB_WORKERS = int(settings.DNS_DB_WORKERS)
+
+
+class DNSServerProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self.server.response_udp(self.transport, data, addr))
+
+    def error_received(self, exc):
+        logger.error("UDP error: %s" % exc)
+
+
+class AsyncServer(object):
+    """
+    Uses the dns_server Command steps (cached_answers, local_answers,
+    relay_answers) but awaits the database and the reply DNS server.
+    """
+
+    def __init__(self, command, db_workers=DNS_DB_WORKERS, loop=None):
+        self.command = command
+        self.loop = loop or asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=db_workers or DNS_DB_WORKERS)
+
+    def in_db(self, func, *args):
+        return self.loop.run_in_executor(self.executor, self.db_call, func, args)
+
+    @staticmethod
+    def db_call(func, args):
+        close_old_connections()
+        return func(*args)
+
+    async def get_response(self, raw_query, addr):
+        received = self.command.parse_query(raw_query, addr)
+        if received is None:
+            return None
+        self.command.log_query(received, addr)
+        emitter = received.reply()
+        try:
+            for query in received.questions:
+                record = await self.resolve(query)
+                if record is None:
+                    return None
+                add_record(emitter, record)
+        except Exception as ex:
+            self.command.servfail(emitter, ex)
+        self.command.edns(received, emitter)
+        return emitter
+
+    async def resolve(self, query):
+        start = time.time()
+        key = cache_key(query.qname, query.qtype, query.qclass)
+        found, record = self.command.cached_answers(key)
+        if found:
+            self.command.measure(dns_metrics.CACHE if record is not None else dns_metrics.LOCKED, start)
+            return record
+        dbdata, action, record = await self.in_db(self.command.local_answers, query, key)
+        if action == RELAY:
+            record, stale = await self.relay_or_stale(query, key, dbdata)
+            self.command.measure(dns_metrics.STALE if stale else dns_metrics.UPSTREAM, start)
+        else:
+            self.command.measure(dns_metrics.LOCKED if action == LOCKED else dns_metrics.DB, start)
+        return record
+
+    async def relay_or_stale(self, query, key, dbdata):
+        """
+        :return: (record, stale)
+        """
+        future, leader = relay_flight.begin(key)
+        if leader:
+            self.loop.create_task(self.relay_and_store(query, key, dbdata, future))
+        answer = asyncio.wrap_future(future, loop=self.loop)
+        if not (self.command.serve_stale and (dbdata.rrset or dbdata.rdata)):
+            return await answer, False
+        try:
+            return await asyncio.wait_for(asyncio.shield(answer), DNS_STALE_DEADLINE), False
+        except Exception as ex:
+            logger.debug("No fresh answer for %s: %r" % (query.qname, ex))
+        record = self.command.stale_answers(query, key, dbdata)
+        if record is None:
+            return await answer, False
+        return record, True
+
+    async def relay_and_store(self, query, key, dbdata, future):
+        try:
+            raw_answer = await self.relay(query)
+            record = await self.in_db(self.command.relay_answers, query, key, dbdata, raw_answer)
+        except Exception as ex:
+            relay_flight.finish(key, future, exception=ex)
+        else:
+            relay_flight.finish(key, future, record)
+
+    async def relay(self, query):
+        logger.debug("Asking to %s" % self.command.dns_reply)
+        q = DNSRecord.question(query.qname, QTYPE.get(query.qtype), CLASS.get(query.qclass))
+        return await asyncio.wrap_future(self.command.upstreams.submit(q.pack()), loop=self.loop)
+
+    async def response_udp(self, transport, raw_query, addr):
+        try:
+            found, packed = self.command.wire_answer(raw_query, udp=True)
+            if not found:
+                emitter = await self.get_response(raw_query, addr)
+                packed = self.command.pack_udp(emitter, udp_payload(edns_payload(raw_query))) if emitter else None
+            if packed:
+                transport.sendto(packed, addr)
+        except Exception as ex:
+            logger.error("Error answering %s:%s %s" % (addr[0], addr[1], ex))
+
+    async def response_tcp(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    size = await asyncio.wait_for(reader.readexactly(2), DNS_TCP_IDLE_TIMEOUT)
+                    raw_query = await asyncio.wait_for(reader.readexactly(struct.unpack('!H', size)[0]),
+                                                       DNS_TCP_IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                found, packed = self.command.wire_answer(raw_query)
+                if not found:
+                    emitter = await self.get_response(raw_query, addr)
+                    packed = emitter.pack() if emitter else None
+                if packed:
+                    writer.write(struct.pack('!H', len(packed)) + packed)
+                    await writer.drain()
+        except Exception as ex:
+            logger.error("Error answering %s:%s %s" % (addr[0], addr[1], ex))
+        finally:
+            writer.close()
+
+    def serve(self, addr, port, tcp=False, reuse_port=False):
+        asyncio.set_event_loop(self.loop)
+        touch_buffer.executor = self.executor  # The cache hits must not flush on the event loop
+        reuse_port = reuse_port or None
+        self.loop.run_until_complete(self.loop.create_datagram_endpoint(
+            lambda: DNSServerProtocol(self), local_addr=(addr, port), reuse_port=reuse_port))
+        if tcp:
+            self.loop.run_until_complete(asyncio.start_server(self.response_tcp, addr, port, reuse_port=reuse_port))
+        try:
+            self.loop.run_forever()
+        finally:
+            touch_buffer.executor = None
+            self.executor.shutdown(wait=False)
+            self.loop.close()
@@ -0,0 +1,334 @@
+"""
+Load generation helpers for the dns_benchmark command
+
+A stand-in upstream resolver, a query generator (Zipf distributed names,
+qtype mix and random subdomain floods) and closed loop runners measuring
+the QPS and the latency percentiles. The upstream, the servers and the
+clients run in different processes so they don't compete for the GIL.
+"""
+from dnslib import DNSRecord, RR, QTYPE, RCODE, A, AAAA, TXT, SOA
+from django.utils.six.moves import cPickle as pickle
+
+from bisect import bisect_left
+import traceback
+import threading
+import hashlib
+import random
+import socket
+import struct
+import string
+import time
+import os
+
+from red_casa.dns.upstream import recv_exactly
+
+
+class StandInUpstream(object):
+    """
+    Local UDP and TCP resolver answering any name without network access:
+    A, AAAA and TXT derived from the name, NXDOMAIN with SOA for names starting with "nx".
+    """
+
+    def __init__(self, addr='127.0.0.1', port=0, ttl=300, delay=0):
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((addr, port))
+        self.address = self.udp.getsockname()
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(self.address)
+        self.tcp.listen(64)
+        self.ttl = ttl
+        self.delay = delay
+        self.answered = 0
+
+    def __str__(self):
+        return "%s:%d" % self.address
+
+    def start(self):
+        for target in (self.serve_udp, self.serve_tcp):
+            thread = threading.Thread(target=target, name='bench-upstream')
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def serve_forever(self):
+        self.start()
+        threading.Event().wait()
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+    def answer(self, raw_query):
+        query = DNSRecord.parse(raw_query)
+        reply = query.reply()
+        qname = str(query.q.qname)
+        if qname.startswith('nx'):
+            reply.header.rcode = RCODE.NXDOMAIN
+            reply.add_auth(RR(qname.split('.', 1)[-1] or '.', QTYPE.SOA, ttl=self.ttl,
+                              rdata=SOA('ns.bench.', 'admin.bench.', (1, 3600, 600, 86400, 60))))
+        else:
+            digest = bytearray(hashlib.md5(qname.lower().encode('utf-8')).digest())
+            if query.q.qtype == QTYPE.A:
+                reply.add_answer(RR(qname, QTYPE.A, ttl=self.ttl, rdata=A('10.%d.%d.%d' % tuple(digest[:3]))))
+            elif query.q.qtype == QTYPE.AAAA:
+                reply.add_answer(RR(qname, QTYPE.AAAA, ttl=self.ttl, rdata=AAAA(tuple(digest))))
+            elif query.q.qtype == QTYPE.TXT:
+                reply.add_answer(RR(qname, QTYPE.TXT, ttl=self.ttl, rdata=TXT(qname)))
+        self.answered += 1
+        return reply.pack()
+
+    def serve_udp(self):
+        while True:
+            data, addr = self.udp.recvfrom(4096)
+            if self.delay:
+                time.sleep(self.delay)
+            self.udp.sendto(self.answer(data), addr)
+
+    def serve_tcp(self):
+        while True:
+            conn, addr = self.tcp.accept()
+            thread = threading.Thread(target=self.answer_tcp, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    def answer_tcp(self, conn):
+        try:
+            while True:
+                size = struct.unpack('!H', recv_exactly(conn, 2))[0]
+                packed = self.answer(recv_exactly(conn, size))
+                conn.sendall(struct.pack('!H', len(packed)) + packed)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+
+def parse_mix(value):
+    """
+    :param value: "A:80,AAAA:15,TXT:5"
+    :return: [(qtype name, weight)]
+    """
+    mix = []
+    for item in value.split(','):
+        qtype, weight = (item.split(':') + ['1'])[:2]
+        mix.append((qtype.strip().upper(), float(weight)))
+    return mix
+
+
+class QueryGenerator(object):
+    """
+    Questions with Zipf distributed names, a qtype mix and a ratio of random subdomains
+    """
+
+    def __init__(self, names=1000, zipf=1.1, mix='A:80,AAAA:15,TXT:5', random_ratio=0.0,
+                 domain='bench.test', seed=1):
+        self.random = random.Random(seed)
+        self.names = ['n%d.%s.' % (i, domain) for i in range(names)]
+        self.domain = domain
+        self.random_ratio = random_ratio
+        self.name_weights = self.cumulative([1.0 / (rank ** zipf) for rank in range(1, names + 1)])
+        self.mix = parse_mix(mix)
+        self.mix_weights = self.cumulative([weight for qtype, weight in self.mix])
+        self.replay = None
+
+    @staticmethod
+    def cumulative(weights):
+        total = float(sum(weights))
+        cumulative, accumulated = [], 0
+        for weight in weights:
+            accumulated += weight
+            cumulative.append(accumulated / total)
+        return cumulative
+
+    def load_replay(self, lines):
+        """
+        :param lines: "qname [qtype]" per line, replayed in order instead of generating
+        """
+        self.replay = []
+        for line in lines:
+            parts = line.split()
+            if parts and not parts[0].startswith('#'):
+                self.replay.append((parts[0], parts[1].upper() if len(parts) > 1 else 'A'))
+
+    def pick(self, cumulative):
+        return min(bisect_left(cumulative, self.random.random()), len(cumulative) - 1)
+
+    def question(self, index=0):
+        """
+        :return: (qname, qtype name)
+        """
+        if self.replay:
+            return self.replay[index % len(self.replay)]
+        qtype = self.mix[self.pick(self.mix_weights)][0]
+        if self.random_ratio and self.random.random() < self.random_ratio:
+            label = ''.join(self.random.choice(string.ascii_lowercase + string.digits) for i in range(16))
+            return '%s.%s.' % (label, self.domain), qtype
+        return self.names[self.pick(self.name_weights)], qtype
+
+    def queries(self, count):
+        """
+        :return: List of packed queries
+        """
+        return [DNSRecord.question(*self.question(i)).pack() for i in range(count)]
+
+
+class Report(object):
+
+    def __init__(self, name, latencies, elapsed, errors=0):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.elapsed = elapsed
+        self.errors = errors
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0
+        return self.latencies[min(len(self.latencies) - 1, int(len(self.latencies) * percent / 100.0))]
+
+    @property
+    def qps(self):
+        return len(self.latencies) / self.elapsed if self.elapsed else 0
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'queries': len(self.latencies),
+            'errors': self.errors,
+            'qps': round(self.qps, 1),
+            'p50_ms': round(self.percentile(50) * 1000, 3),
+            'p99_ms': round(self.percentile(99) * 1000, 3),
+        }
+
+    def __str__(self):
+        return "%(name)-40s %(queries)8d queries %(errors)6d errors %(qps)10.1f qps " \
+               "p50 %(p50_ms)8.3fms p99 %(p99_ms)8.3fms" % self.as_dict()
+
+
+def run_closed_loop(name, queries, send, concurrency=1, on_exit=None):
+    """
+    Every client sends its next query when the previous one is answered
+    :param send: Function sending one packed query and waiting for the answer, False if it failed
+    :param on_exit: Function called by every client thread when it ends
+    """
+    latencies = []
+    errors = [0]
+    mutex = threading.Lock()
+
+    def client(chunk):
+        own, failed = [], 0
+        try:
+            for packed in chunk:
+                start = time.time()
+                if send(packed):
+                    own.append(time.time() - start)
+                else:
+                    failed += 1
+        finally:
+            if on_exit is not None:
+                on_exit()
+        with mutex:
+            latencies.extend(own)
+            errors[0] += failed
+
+    chunks = [queries[i::concurrency] for i in range(concurrency)]
+    threads = [threading.Thread(target=client, args=(chunk, )) for chunk in chunks]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return Report(name, latencies, time.time() - start, errors[0])
+
+
+def udp_sender(address, timeout=2):
+    local = threading.local()
+
+    def send(packed):
+        sock = getattr(local, 'sock', None)
+        if sock is None:
+            sock = local.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(timeout)
+        sock.sendto(packed, address)
+        try:
+            while True:
+                answer = sock.recv(65535)
+                if answer[:2] == packed[:2]:  # Skip the late answers of previous queries
+                    return True
+        except socket.timeout:
+            return False
+    return send
+
+
+def tcp_sender(address, timeout=2):
+    local = threading.local()
+
+    def send(packed):
+        conn = getattr(local, 'conn', None)
+        try:
+            if conn is None:
+                conn = local.conn = socket.create_connection(address, timeout)
+            conn.sendall(struct.pack('!H', len(packed)) + packed)
+            recv_exactly(conn, struct.unpack('!H', recv_exactly(conn, 2))[0])
+            return True
+        except socket.error:
+            local.conn = None
+            return False
+    return send
+
+
+class Child(object):
+    """
+    Runs target(*args, **kwargs) in a forked process, its result is pickled back through a pipe
+    """
+
+    def __init__(self, target, *args, **kwargs):
+        read_end, write_end = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(read_end)
+            code = 0
+            try:
+                result = target(*args, **kwargs)
+            except (SystemExit, KeyboardInterrupt):
+                result = None
+            except BaseException:
+                traceback.print_exc()
+                result, code = None, 1
+            with os.fdopen(write_end, 'wb') as output:
+                pickle.dump(result, output, -1)
+            os._exit(code)
+        os.close(write_end)
+        self.output = os.fdopen(read_end, 'rb')
+        self.status = None
+
+    def is_alive(self):
+        if self.status is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.status = status
+        return self.status is None
+
+    def stop(self, sig):
+        if self.is_alive():
+            os.kill(self.pid, sig)
+
+    def wait(self):
+        """
+        Waits for the end of the process
+        :return: The pickled result
+        """
+        data = self.output.read()
+        self.output.close()
+        if self.status is None:
+            self.status = os.waitpid(self.pid, 0)[1]
+        return data
+
+    def result(self):
+        """
+        :return: The value returned by target
+        """
+        data = self.wait()
+        if self.status or not data:
+            raise RuntimeError('Process %d failed with status %d' % (self.pid, self.status))
+        return pickle.loads(data)
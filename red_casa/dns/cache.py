@@ -0,0 +1,235 @@
+from django.conf import settings
+
+from dnslib import QTYPE
+from collections import OrderedDict
+import threading
+import struct
+import time
+
+from red_casa.dns.wire import parse_query, question_end, rr_ttls, udp_payload, opt_rr, HEADER_SIZE, TTL, OPT_RR
+
+DNS_CACHE_MAX_SIZE = 16 * 1024 * 1024  # Bytes
+if hasattr(settings, 'DNS_CACHE_MAX_SIZE'):
+    DNS_CACHE_MAX_SIZE = int(settings.DNS_CACHE_MAX_SIZE)
+
+DNS_CACHE_DEFAULT_TTL = 300  # TTL for the answers saved in DB
+if hasattr(settings, 'DNS_CACHE_DEFAULT_TTL'):
+    DNS_CACHE_DEFAULT_TTL = int(settings.DNS_CACHE_DEFAULT_TTL)
+
+DNS_CACHE_MAX_TTL = 86400
+if hasattr(settings, 'DNS_CACHE_MAX_TTL'):
+    DNS_CACHE_MAX_TTL = int(settings.DNS_CACHE_MAX_TTL)
+
+DNS_WIRE_CACHE = True  # Answer the cached queries without dnslib
+if hasattr(settings, 'DNS_WIRE_CACHE'):
+    DNS_WIRE_CACHE = bool(settings.DNS_WIRE_CACHE)
+
+DNS_NEGATIVE_CACHE_MAX_SIZE = 1024 * 1024  # Bytes for the NXDOMAIN/NODATA answers
+if hasattr(settings, 'DNS_NEGATIVE_CACHE_MAX_SIZE'):
+    DNS_NEGATIVE_CACHE_MAX_SIZE = int(settings.DNS_NEGATIVE_CACHE_MAX_SIZE)
+
+DNS_NEGATIVE_MAX_TTL = 3600  # RFC 2308 recommends 1 to 3 hours
+if hasattr(settings, 'DNS_NEGATIVE_MAX_TTL'):
+    DNS_NEGATIVE_MAX_TTL = int(settings.DNS_NEGATIVE_MAX_TTL)
+
+ENTRY_OVERHEAD = 128  # Aprox bytes used by the key and the entry itself
+FLAGS = struct.Struct('!HH')
+ARCOUNT = struct.Struct('!H')
+
+
+def add_record(emitter, record):
+    """
+    Adds the RRs and the rcode of the record of one question to the answer
+    """
+    emitter.add_answer(*record.rr)
+    emitter.add_auth(*record.auth)
+    emitter.add_ar(*record.ar)
+    if record.header.rcode:
+        emitter.header.rcode = record.header.rcode
+
+
+def record_ttl(record, default=DNS_CACHE_DEFAULT_TTL):
+    """
+    :return: Min TTL of the answer and authority RRs of the record or default if there is not RRs
+    """
+    ttls = [rr.ttl for rr in record.rr + record.auth if rr.rtype != QTYPE.OPT]
+    return min(ttls) if ttls else default
+
+
+def negative_ttl(record):
+    """
+    According RFC 2308 the TTL of a negative answer is the min of the SOA TTL and its MINIMUM field
+    :return: TTL or None if the record has not SOA in the authority section
+    """
+    ttls = [min(rr.ttl, rr.rdata.times[-1]) for rr in record.auth if rr.rtype == QTYPE.SOA]
+    if not ttls:
+        return None
+    return min(min(ttls), DNS_NEGATIVE_MAX_TTL)
+
+
+def cache_key(qname, qtype, qclass):
+    return str(qname).lower(), int(qtype), int(qclass)
+
+
+class CacheEntry(object):
+    __slots__ = ('packed', 'ttl', 'expires', 'size', 'ttls', 'hits', 'late_hits', 'refreshing', 'pk')
+
+    def __init__(self, packed, ttl, expires, pk=None):
+        self.packed = packed
+        self.ttl = ttl
+        self.expires = expires
+        self.size = ENTRY_OVERHEAD + (len(packed) if packed else 0)
+        self.ttls = rr_ttls(packed) if packed else []
+        self.hits = 0
+        self.late_hits = 0  # Hits near the expiration, updated by the prefetcher
+        self.refreshing = False
+        self.pk = pk  # DNSRecord of the answer, its last_query is touched on every hit
+
+    @property
+    def locked(self):
+        return self.packed is None
+
+    def remaining(self, now=None):
+        return max(0, int(self.expires - (now or time.time())))
+
+
+class AnswerCache(object):
+    """
+    LRU cache of packed answers keyed by (qname, qtype, qclass).
+
+    Entries expire with the TTL of the answer and the least recently used ones
+    are evicted when the packed data exceeds max_size bytes.
+    An entry without packed data means the query must not be answered.
+    on_hit(key, entry, now) is called, if set, after every hit.
+    """
+
+    def __init__(self, max_size=DNS_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self.on_hit = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.mutex = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, count_miss=True):
+        now = time.time()
+        with self.mutex:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry.expires > now:
+                    self.entries[key] = self.entries.pop(key)  # Most recently used
+                    self.hits += 1
+                    entry.hits += 1
+                else:
+                    self._pop(key)
+                    entry = None
+            if entry is None and count_miss:
+                self.misses += 1
+        if entry is not None and self.on_hit is not None:
+            self.on_hit(key, entry, now)
+        return entry
+
+    def wire_answer(self, raw_query, udp=False):
+        """
+        Builds the answer from the cached packed record patching only the header,
+        the question and the TTLs, without parsing the query with dnslib.
+        :param raw_query: Raw DNS query
+        :param udp: If the answer must fit in the UDP payload of the client
+        :return: (found, packed) where packed is None if the query must not be answered
+        """
+        question = parse_query(raw_query)
+        if question is None:
+            return False, None
+        qname, qtype, qclass, end, payload = question
+        entry = self.get((qname, qtype, qclass), count_miss=False)
+        if entry is None:
+            return False, None
+        if entry.locked:
+            return True, None
+        size = len(entry.packed) + (OPT_RR.size if payload is not None else 0)
+        if udp and size > udp_payload(payload):
+            return False, None  # Let the slow path truncate it
+        packed = bytearray(entry.packed)
+        if question_end(packed) != end:
+            return False, None
+        query_id, flags = FLAGS.unpack_from(raw_query)
+        rcode = FLAGS.unpack_from(packed)[1] & 0x000F
+        FLAGS.pack_into(packed, 0, query_id, (flags | 0x8480) & 0xFFF0 | rcode)  # QR, AA and RA as reply()
+        packed[HEADER_SIZE:end] = raw_query[HEADER_SIZE:end]  # Question with the case of the query
+        elapsed = entry.ttl - entry.remaining()
+        for offset, ttl in entry.ttls:
+            TTL.pack_into(packed, offset, max(0, ttl - elapsed))
+        if payload is not None:  # Echo EDNS
+            ARCOUNT.pack_into(packed, 10, ARCOUNT.unpack_from(packed, 10)[0] + 1)
+            packed += opt_rr()
+        return True, bytes(packed)
+
+    def put(self, key, packed, ttl, expires=None, pk=None):
+        """
+        :param expires: Expiration time, by default ttl seconds from now
+        :param pk: DNSRecord pk of the answer
+        """
+        ttl = min(int(ttl), DNS_CACHE_MAX_TTL)
+        if ttl <= 0 or self.max_size <= 0:
+            return None
+        entry = CacheEntry(packed, ttl, expires or time.time() + ttl, pk)
+        if entry.size > self.max_size:
+            return None
+        with self.mutex:
+            self._pop(key)
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                self._pop(next(iter(self.entries)))
+                self.evictions += 1
+        return entry
+
+    def items(self):
+        with self.mutex:
+            return list(self.entries.items())
+
+    def invalidate(self, key):
+        with self.mutex:
+            self._pop(key)
+
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+        return entry
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+answer_cache = AnswerCache()
+negative_cache = AnswerCache(DNS_NEGATIVE_CACHE_MAX_SIZE)  # Own budget so random names can not evict the answers
+
+
+def invalidate(key):
+    answer_cache.invalidate(key)
+    negative_cache.invalidate(key)
+
+
+def clear():
+    answer_cache.clear()
+    negative_cache.clear()
@@ -0,0 +1,152 @@
+"""
+Invalidation channel for the dns_server caches
+
+The RootFilter and DNSRecord changes made in other processes (the admin)
+are published as datagrams to a Unix socket where dns_server is listening.
+With several worker processes, the parent process listens and forwards
+every message to the workers.
+"""
+from django.conf import settings
+
+import threading
+import logging
+import socket
+import errno
+import stat
+import os
+
+from red_casa.dns import policy
+from red_casa.dns import cache
+
+logger = logging.getLogger('dns_server')
+
+DNS_INVALIDATION_DIR = '/var/run/red_casa'  # Private directory of the socket, created by dns_server
+if hasattr(settings, 'DNS_INVALIDATION_DIR'):
+    DNS_INVALIDATION_DIR = settings.DNS_INVALIDATION_DIR
+
+DNS_INVALIDATION_SOCKET = os.path.join(DNS_INVALIDATION_DIR, 'dns.sock')
+if hasattr(settings, 'DNS_INVALIDATION_SOCKET'):
+    DNS_INVALIDATION_SOCKET = settings.DNS_INVALIDATION_SOCKET
+
+DNS_INVALIDATION_GROUP = 'www-data'  # Group of the publishers (the admin), None for keep the owner group
+if hasattr(settings, 'DNS_INVALIDATION_GROUP'):
+    DNS_INVALIDATION_GROUP = settings.DNS_INVALIDATION_GROUP
+
+ROOT_FILTER = 'rootfilter'
+RECORD = 'record'
+
+serving = False  # True inside dns_server, its own changes are only applied locally
+
+
+def publish(*message):
+    """
+    Sends the message to the dns_server listening, if any
+    """
+    if serving or not DNS_INVALIDATION_SOCKET or not hasattr(socket, 'AF_UNIX'):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto('\t'.join(str(part) for part in message).encode('utf-8'), DNS_INVALIDATION_SOCKET)
+    except socket.error as ex:
+        if ex.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            logger.info("Invalidation not sent, dns_server is not listening on %s" % DNS_INVALIDATION_SOCKET)
+        else:
+            logger.error("Error sending the invalidation to %s: %s" % (DNS_INVALIDATION_SOCKET, ex))
+    finally:
+        sock.close()
+
+
+def apply(data):
+    parts = data.decode('utf-8').split('\t')
+    if parts[0] == ROOT_FILTER:
+        policy.rebuild()
+        cache.clear()
+    elif parts[0] == RECORD and len(parts) == 4:
+        cache.invalidate(cache.cache_key(parts[1], parts[2], parts[3]))
+    else:
+        logger.warn("Unknown invalidation %r" % data)
+
+
+def _receive(sock, followers=(), local=True):
+    while True:
+        try:
+            data = sock.recv(4096)
+        except socket.error as ex:
+            logger.error("Invalidation channel: %s" % ex)
+            break
+        if not data:
+            break
+        for follower in followers:
+            try:
+                follower.send(data)
+            except socket.error:
+                pass
+        if local:
+            try:
+                apply(data)
+            except Exception as ex:
+                logger.error("Error applying invalidation %r: %s" % (data, ex))
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args, name='dns-invalidation')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _group_id(group):
+    """
+    :return: gid of the group name or number, -1 for keep the owner group
+    """
+    if group is None or group == '':
+        return -1
+    try:
+        return int(group)
+    except ValueError:
+        import grp
+        return grp.getgrnam(group).gr_gid
+
+
+def _private_dir(path, gid):
+    """
+    Creates the directory of the socket only accessible by its owner and gid
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o750)
+    elif os.stat(path).st_mode & stat.S_IWOTH:  # As /tmp, anyone could replace the socket
+        raise OSError(errno.EPERM, "%s is world writable" % path)
+    os.chown(path, -1, gid)
+    os.chmod(path, 0o750)
+
+
+def listen(followers=(), local=True, path=DNS_INVALIDATION_SOCKET, group=DNS_INVALIDATION_GROUP):
+    """
+    Binds the invalidation socket and applies (local) or forwards (followers) the messages.
+    The socket and its directory are only accessible by the owner and the group of the publishers.
+    :return: The listening socket or None if it's not supported
+    """
+    if not path or not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        gid = _group_id(group)
+        _private_dir(os.path.dirname(os.path.abspath(path)), gid)
+        if os.path.exists(path):
+            os.unlink(path)
+        sock.bind(path)
+        os.chown(path, -1, gid)
+        os.chmod(path, 0o660)
+    except (socket.error, OSError, KeyError) as ex:
+        logger.warn("Invalidation channel %s not available: %s" % (path, ex))
+        sock.close()
+        return None
+    _start(_receive, sock, followers, local)
+    return sock
+
+
+def follow(sock):
+    """
+    Applies the messages forwarded by the parent process through sock
+    """
+    _start(_receive, sock)
@@ -0,0 +1,199 @@
+from __future__ import absolute_import
+
+from django.db import connection, connections
+from django.utils.six import StringIO
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from red_casa.dns import models
+from red_casa.dns import cache as dns_cache
+from red_casa.dns.bench import StandInUpstream, QueryGenerator, Child, run_closed_loop, udp_sender, tcp_sender, \
+    parse_mix
+from red_casa.dns.cache import answer_cache, DNS_CACHE_MAX_SIZE
+from red_casa.dns.touch import touch_buffer
+from red_casa.dns.upstream import UpstreamPool
+from red_casa.dns.management.commands.dns_server import Command as DNSServerCommand
+
+from dnslib import QTYPE, CLASS, DNSRecord
+import platform
+import socket
+import signal
+import json
+import time
+import io
+
+MODES = ['get_response', 'udp', 'tcp']
+ENGINES = ['threading', 'asyncio']
+PING = 'bench-ping.test.'  # Probe waiting for the server to start
+
+
+def free_port(addr):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((addr, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Command(BaseCommand):
+    help = 'Measure the QPS and latency of the DNS resolver against a local stand-in upstream'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', action='store', dest='queries', type=int, default=20000,
+                            help='Queries of every run.')
+        parser.add_argument('--names', action='store', dest='names', type=int, default=1000,
+                            help='Different names generated.')
+        parser.add_argument('--zipf', action='store', dest='zipf', type=float, default=1.1,
+                            help='Exponent of the Zipf distribution of the names.')
+        parser.add_argument('--qtypes', action='store', dest='qtypes', default='A:80,AAAA:15,TXT:5',
+                            help='Weighted qtype mix.')
+        parser.add_argument('--random-ratio', action='store', dest='random_ratio', type=float, default=0.0,
+                            help='Part of the queries for random subdomains.')
+        parser.add_argument('--replay', action='store', dest='replay', default=None,
+                            help='File with "qname [qtype]" lines to replay instead of generating.')
+        parser.add_argument('--seed', action='store', dest='seed', type=int, default=1)
+        parser.add_argument('--modes', action='store', dest='modes', default=','.join(MODES),
+                            help='Comma separated from %s.' % ', '.join(MODES))
+        parser.add_argument('--engines', action='store', dest='engines', default=','.join(ENGINES),
+                            help='Server engines for the udp and tcp modes.')
+        parser.add_argument('--cache-sizes', action='store', dest='cache_sizes', default='%d,0' % DNS_CACHE_MAX_SIZE,
+                            help='Comma separated answer cache sizes, 0 for disable it.')
+        parser.add_argument('--concurrency', action='store', dest='concurrency', type=int, default=8,
+                            help='Clients sending queries at the same time.')
+        parser.add_argument('--workers', action='store', dest='workers', type=int, default=8,
+                            help='Worker threads of the threading engine.')
+        parser.add_argument('--upstream-delay', action='store', dest='upstream_delay', type=float, default=0,
+                            help='Seconds the stand-in upstream waits before every answer.')
+        parser.add_argument('--json', action='store', dest='json', default=None,
+                            help='File where the report is saved.')
+        parser.add_argument('--keep', action='store_true', dest='keep', default=False,
+                            help='Keep the DNSRecord rows of the benchmark.')
+
+    def handle(self, *args, **options):
+        modes = [mode for mode in options.get('modes').split(',') if mode]
+        engines = [engine for engine in options.get('engines').split(',') if engine]
+        if set(modes) - set(MODES) or set(engines) - set(ENGINES):
+            raise CommandError('Unknown mode or engine.')
+        cache_sizes = [int(size) for size in options.get('cache_sizes').split(',')]
+        concurrency = max(1, options.get('concurrency'))
+        generator = QueryGenerator(options.get('names'), options.get('zipf'), options.get('qtypes'),
+                                   options.get('random_ratio'), seed=options.get('seed'))
+        if options.get('replay'):
+            with io.open(options.get('replay'), encoding='utf-8') as lines:
+                generator.load_replay(lines)
+        queries = generator.queries(options.get('queries'))
+        upstream = StandInUpstream(delay=options.get('upstream_delay'))
+        self.prepare(generator, options.get('qtypes'))
+        connections.close_all()  # The DB connections can not be shared with the child processes
+        upstream_process = Child(upstream.serve_forever)
+        upstream.close()
+        self.stdout.write("Database %s, Python %s, upstream %s, %d queries, %d clients\n" % (
+            connection.vendor, platform.python_version(), upstream, len(queries), concurrency))
+
+        reports = []
+        try:
+            for cache_size in cache_sizes:
+                if 'get_response' in modes:
+                    reports.append(self.bench_get_response(upstream, queries, cache_size, concurrency))
+                    self.stdout.write("%s\n" % reports[-1])
+                for engine in engines:
+                    for transport in [mode for mode in modes if mode in ('udp', 'tcp')]:
+                        reports.append(self.bench_server(upstream, queries, cache_size, concurrency, engine,
+                                                         transport, options.get('workers')))
+                        self.stdout.write("%s\n" % reports[-1])
+        finally:
+            upstream_process.stop(signal.SIGTERM)
+            upstream_process.wait()
+            if not options.get('keep'):
+                models.DNSRecord.objects.filter(qname__endswith='.%s.' % generator.domain).delete()
+        if options.get('json'):
+            with open(options.get('json'), 'w') as output:
+                json.dump({
+                    'database': connection.vendor,
+                    'python': platform.python_version(),
+                    'queries': len(queries),
+                    'concurrency': concurrency,
+                    'options': dict((name, options.get(name)) for name in (
+                        'names', 'zipf', 'qtypes', 'random_ratio', 'replay', 'seed', 'upstream_delay')),
+                    'reports': [report.as_dict() for report in reports],
+                }, output, indent=2)
+
+    def prepare(self, generator, qtypes):
+        """
+        Creates the relayed DNSRecord rows of the generated names
+        """
+        models.DNSRecord.objects.filter(qname__endswith='.%s.' % generator.domain).delete()
+        names = set(name for name, qtype in generator.replay or []) or set(generator.names)
+        types = set(getattr(QTYPE, qtype) for qtype, weight in parse_mix(qtypes))
+        types.update(getattr(QTYPE, qtype) for name, qtype in generator.replay or [])
+        models.DNSRecord.objects.bulk_create([
+            models.DNSRecord(qname=name, qtype=qtype, qclass=CLASS.IN, always_reply=True)
+            for name in names for qtype in types])
+
+    @staticmethod
+    def reset(cache_size):
+        dns_cache.clear()
+        answer_cache.max_size = cache_size
+
+    def bench_get_response(self, upstream, queries, cache_size, concurrency):
+        """
+        Calls get_response in a child process, apart from the stand-in upstream
+        """
+        self.reset(cache_size)
+        return Child(self.run_get_response, upstream, queries, cache_size, concurrency).result()
+
+    @staticmethod
+    def run_get_response(upstream, queries, cache_size, concurrency):
+        command = DNSServerCommand(stdout=StringIO())
+        command.log_sample = 0
+        command.dns_reply = str(upstream)
+        command.upstreams = UpstreamPool(command.dns_reply).start()
+        touch_buffer.start()
+        addr = ('127.0.0.1', 0)
+
+        def send(packed):
+            try:
+                command.get_response(packed, addr)
+            except Exception:
+                return False
+            return True
+        try:
+            return run_closed_loop('get_response cache=%d' % cache_size, queries, send, concurrency,
+                                   on_exit=connections.close_all)  # Once per client thread
+        finally:
+            touch_buffer.stop()
+
+    def bench_server(self, upstream, queries, cache_size, concurrency, engine, transport, workers):
+        """
+        Starts dns_server in a child process, sends the queries from this one and stops it
+        """
+        self.reset(cache_size)
+        port = free_port('127.0.0.1')
+        options = {
+            'dns_server': str(upstream),
+            'engine': engine,
+            'use_tcp': transport == 'tcp',
+            'workers': workers,
+            'cache_size': cache_size,
+            'log_sample': 0,
+            'snapshot': None,  # Don't load or overwrite the cache of the real server
+            'metrics_addr': None,
+            'invalidation_socket': None,
+            'stdout': StringIO(),
+        }
+        connections.close_all()
+        server = Child(call_command, 'dns_server', '127.0.0.1:%d' % port, **options)
+        try:
+            address = ('127.0.0.1', port)
+            probe = udp_sender(address, timeout=0.2)
+            ping = DNSRecord.question(PING).pack()
+            deadline = time.time() + 10
+            while not probe(ping):
+                if not server.is_alive() or time.time() > deadline:
+                    raise CommandError('dns_server %s %s did not start.' % (engine, transport))
+            send = udp_sender(address) if transport == 'udp' else tcp_sender(address)
+            return run_closed_loop('%s %s cache=%d' % (engine, transport, cache_size), queries, send, concurrency)
+        finally:
+            server.stop(signal.SIGINT)  # Shutdown as on CONTROL-C
+            server.result()
+            models.DNSRecord.objects.filter(qname=PING).delete()
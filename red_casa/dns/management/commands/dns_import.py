@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+
+from red_casa.dns import models
+from red_casa.dns import invalidation
+from red_casa.dns.policy import PolicyTrie
+
+from collections import OrderedDict
+from dnslib import RR
+import time
+import io
+import re
+
+NAME_RE = re.compile(r'^[a-z0-9_-]+(\.[a-z0-9_-]+)*$')
+IP_RE = re.compile(r'^(\d{1,3}(\.\d{1,3}){3}|[0-9a-fA-F:]*:[0-9a-fA-F:.%a-z]*)$')
+IGNORED_NAMES = ['localhost', 'localhost.localdomain', 'local', 'broadcasthost', 'ip6-localhost',
+                 'ip6-loopback', 'ip6-localnet', 'ip6-mcastprefix', 'ip6-allnodes', 'ip6-allrouters']
+LOOKUP_SIZE = 900  # Names per qname__in query, under the 999 variables of SQLite
+
+
+def normalize(name):
+    """
+    :return: Lower case name without the trailing dot or None if it's not a valid host name
+    """
+    name = name.strip().strip('.').lower()
+    if not NAME_RE.match(name) or name in IGNORED_NAMES or IP_RE.match(name):
+        return None
+    return name
+
+
+def blocklist_names(lines):
+    """
+    Reads hosts files ("0.0.0.0 name"), domain lists ("name") and the adblock "||name^" rules
+    """
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line or line.startswith('!') or line.startswith('['):
+            continue
+        if line.startswith('||'):
+            names = [line[2:].split('^', 1)[0]]
+        else:
+            names = line.split()
+            if IP_RE.match(names[0]):
+                names = names[1:]
+            elif len(names) > 1:
+                continue
+        for name in names:
+            name = normalize(name)
+            if name:
+                yield name
+
+
+class Command(BaseCommand):
+    help = 'Import blocklists as RootFilter and zone files as DNSRecord'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--blocklist', '-b', action='append', dest='blocklists', default=[],
+                            help='Hosts file, domain list or adblock list to import as RootFilter.')
+        parser.add_argument('--zone', '-z', action='append', dest='zones', default=[],
+                            help='RFC 1035 zone file to import as DNSRecord.')
+        parser.add_argument('--origin', action='store', dest='origin', default='',
+                            help='$ORIGIN of the zone files without it.')
+        parser.add_argument('--no-lock', action='store_false', dest='lock', default=True,
+                            help='Import the blocklist names without locking them.')
+        parser.add_argument('--always-reply', action='store_true', dest='always_reply', default=False,
+                            help='Import the blocklist names with always_reply.')
+        parser.add_argument('--batch-size', action='store', dest='batch_size', type=int, default=1000,
+                            help='Rows saved in every transaction.')
+
+    def handle(self, *args, **options):
+        blocklists = options.get('blocklists')
+        zones = options.get('zones')
+        if not blocklists and not zones:
+            raise CommandError('Nothing to import, use --blocklist or --zone.')
+        batch_size = max(1, options.get('batch_size'))
+        start = time.time()
+        try:
+            if blocklists:
+                self.import_blocklists(blocklists, options.get('lock'), options.get('always_reply'), batch_size)
+            for path in zones:
+                self.import_zone(path, options.get('origin'), batch_size)
+        except (IOError, OSError) as ex:
+            raise CommandError(str(ex))
+        invalidation.publish(invalidation.ROOT_FILTER)  # A running dns_server reloads the policy
+        self.stdout.write("Imported in %.2fs\n" % (time.time() - start))
+
+    def import_blocklists(self, paths, lock, always_reply, batch_size):
+        names = set()
+        for path in paths:
+            with io.open(path, encoding='utf-8', errors='ignore') as lines:
+                names.update(blocklist_names(lines))
+        trie = PolicyTrie()
+        trie.load(models.RootFilter.objects.values_list('pk', 'qname', 'lock', 'always_reply').iterator())
+        existing = set(qname.strip('.').lower() for qname in
+                       models.RootFilter.objects.values_list('qname', flat=True).iterator())
+        new = []
+        duplicated = covered = 0
+        for name in sorted(names, key=lambda name: name.count('.')):  # The parents first
+            if name in existing:
+                duplicated += 1
+            elif lock and trie.lookup(name)[0]:
+                covered += 1  # Already locked by a parent
+            else:
+                trie.add(('new', len(new)), name, lock, always_reply)
+                new.append(name)
+        for offset in range(0, len(new), batch_size):
+            with transaction.atomic():
+                models.RootFilter.objects.bulk_create([
+                    models.RootFilter(qname=name, lock=lock, always_reply=always_reply)
+                    for name in new[offset:offset + batch_size]])
+        self.stdout.write("Root filters: %d added, %d already present, %d covered by a locked parent\n" %
+                          (len(new), duplicated, covered))
+
+    def import_zone(self, path, origin, batch_size):
+        with io.open(path, encoding='utf-8') as zone:
+            rrs = RR.fromZone(zone.read(), origin=origin)
+        rrsets = OrderedDict()
+        for rr in rrs:
+            rrsets.setdefault((str(rr.rname).lower(), rr.rtype, rr.rclass), []).append(rr)
+        keys = list(rrsets)
+        added = updated = 0
+        for offset in range(0, len(keys), batch_size):
+            batch = keys[offset:offset + batch_size]
+            with transaction.atomic():
+                qnames = list(set(key[0] for key in batch))
+                existing = {}
+                for start in range(0, len(qnames), LOOKUP_SIZE):
+                    existing.update(((row.qname.lower(), row.qtype, row.qclass), row) for row in
+                                    models.DNSRecord.objects.filter(qname__in=qnames[start:start + LOOKUP_SIZE]))
+                new = []
+                for key in batch:
+                    rrset = '\n'.join(rr.toZone() for rr in rrsets[key])
+                    rdata = str(rrsets[key][0].rdata)
+                    row = existing.get(key)
+                    if row is None:
+                        new.append(models.DNSRecord(qname=key[0], qtype=key[1], qclass=key[2],
+                                                    rdata=rdata, rrset=rrset))
+                    else:
+                        models.DNSRecord.objects.filter(pk=row.pk).update(rdata=rdata, rrset=rrset, expires=None)
+                        updated += 1
+                models.DNSRecord.objects.bulk_create(new)
+                added += len(new)
+        self.stdout.write("Zone %s: %d records added, %d updated\n" % (path, added, updated))
@@ -2,18 +2,39 @@ from __future__ import absolute_import
 
 from django.utils import six
 from django.conf import settings
+from django.db import transaction, connections, connection as db_connection, IntegrityError, DatabaseError
+from django.utils import timezone
 from django.utils.encoding import get_system_encoding, force_text
 from django.core.management.base import BaseCommand, CommandError
 
 from red_casa.dns import models
+from red_casa.dns import invalidation
+from red_casa.dns.policy import get_policy, is_random_name, LOCKED, CACHE, RELAY
+from red_casa.dns.touch import touch_buffer
+from red_casa.dns.pool import WorkerPool, DNS_WORKERS, DNS_QUEUE_SIZE, DNS_OVERFLOW, SHED_MODES, SHED_DROP, \
+    SHED_REFUSED
+from red_casa.dns.wire import error_response, edns_payload, udp_payload, SERVFAIL, REFUSED, DNS_UDP_PAYLOAD, \
+    DNS_EDNS_MAX_PAYLOAD, DNS_TCP_IDLE_TIMEOUT
+from red_casa.dns.upstream import UpstreamPool, UpstreamTimeout, parse_upstreams, DNS_STALE_DEADLINE
+from red_casa.dns.singleflight import relay_flight
+from red_casa.dns.prefetch import Prefetcher, DNS_PREFETCH_HITS
+from red_casa.dns import snapshot
+from red_casa.dns import metrics as dns_metrics
+from red_casa.dns.metrics import metrics
+from red_casa.dns.cache import answer_cache, negative_cache, cache_key, add_record, record_ttl, negative_ttl, \
+    DNS_CACHE_DEFAULT_TTL, DNS_CACHE_MAX_SIZE, DNS_NEGATIVE_CACHE_MAX_SIZE, DNS_WIRE_CACHE
 
 from dnslib import *
-from datetime import datetime
+from datetime import datetime, timedelta
 import threading
 import logging
+import struct
 import socket
+import signal
 import errno
+import time
 import sys
+import os
 import re
 
 
@@ -50,6 +71,40 @@ if hasattr(settings, 'DEFAULT_DNS_PACKET_SIZE'):
     else:
         DEFAULT_DNS_PACKET_SIZE = int(size)
 
+UDP_RECV_SIZE = max(DEFAULT_DNS_PACKET_SIZE, DNS_EDNS_MAX_PAYLOAD)
+
+DNS_TCP_MAX_CONNECTIONS = 128
+if hasattr(settings, 'DNS_TCP_MAX_CONNECTIONS'):
+    DNS_TCP_MAX_CONNECTIONS = int(settings.DNS_TCP_MAX_CONNECTIONS)
+
+DNS_UDP_BATCH = 0  # Datagrams read per wakeup, 0 for one blocking recvfrom per query
+if hasattr(settings, 'DNS_UDP_BATCH'):
+    DNS_UDP_BATCH = int(settings.DNS_UDP_BATCH)
+
+DNS_SKIP_RANDOM_NAMES = False  # Don't save the new random looking names in DB
+if hasattr(settings, 'DNS_SKIP_RANDOM_NAMES'):
+    DNS_SKIP_RANDOM_NAMES = bool(settings.DNS_SKIP_RANDOM_NAMES)
+
+DNS_SERVE_STALE = False  # Answer with the expired RRs when the reply DNS server is slow or down
+if hasattr(settings, 'DNS_SERVE_STALE'):
+    DNS_SERVE_STALE = bool(settings.DNS_SERVE_STALE)
+
+DNS_STALE_TTL = 30  # According RFC 8767
+if hasattr(settings, 'DNS_STALE_TTL'):
+    DNS_STALE_TTL = int(settings.DNS_STALE_TTL)
+
+DNS_STALE_MAX_AGE = 86400  # Max seconds since the RRs expired
+if hasattr(settings, 'DNS_STALE_MAX_AGE'):
+    DNS_STALE_MAX_AGE = int(settings.DNS_STALE_MAX_AGE)
+
+DNS_LOG_SAMPLE = 1  # Log one of every N queries, 0 for none
+if hasattr(settings, 'DNS_LOG_SAMPLE'):
+    DNS_LOG_SAMPLE = int(settings.DNS_LOG_SAMPLE)
+
+DNS_PROCESSES = 1
+if hasattr(settings, 'DNS_PROCESSES'):
+    DNS_PROCESSES = int(settings.DNS_PROCESSES)
+
 
 class Command(BaseCommand):
     help = 'Create a debug dns server'
@@ -61,6 +116,27 @@ class Command(BaseCommand):
         self.use_ipv6 = False
         self._raw_ipv6 = bool(self.use_ipv6)
         self.dns_reply = DEFAULT_REPLY_DNS
+        self.engine = 'threading'
+        self.db_workers = None
+        self.pool = None
+        self.upstreams = None
+        self.wire_cache = DNS_WIRE_CACHE
+        self.overflow = DNS_OVERFLOW
+        self.processes = DNS_PROCESSES
+        self.reuse_port = False
+        self.batch = DNS_UDP_BATCH
+        self.skip_random = DNS_SKIP_RANDOM_NAMES
+        self.prefetch_hits = DNS_PREFETCH_HITS
+        self.prefetcher = None
+        self.serve_stale = DNS_SERVE_STALE
+        self.snapshot = snapshot.DNS_SNAPSHOT_FILE
+        self.snapshot_base = None
+        self.snapshotter = None
+        self.metrics_addr = dns_metrics.DNS_METRICS_ADDR
+        self.invalidation_socket = invalidation.DNS_INVALIDATION_SOCKET
+        self.log_sample = DNS_LOG_SAMPLE
+        self.logged = 0
+        self.worker = 0
 
     def add_arguments(self, parser):
         parser.add_argument('addrport', nargs='?',
@@ -70,9 +146,46 @@ class Command(BaseCommand):
         parser.add_argument('--nothreading', action='store_false', dest='use_threading', default=True,
                             help='Tells Django to NOT use threading.')
         parser.add_argument('--tcp', action='store_true', dest='use_tcp', default=False,
-                            help='Use TCP connections.')
+                            help='Also listen TCP connections in the same port.')
         parser.add_argument('--dns', action='store', dest='dns_server', default=DEFAULT_REPLY_DNS,
-                            help='DNS reply server.')
+                            help='Comma separated DNS reply servers, ip[:port] or [ipv6]:port.')
+        parser.add_argument('--engine', action='store', dest='engine', default='threading',
+                            choices=['threading', 'asyncio'], help='Server engine.')
+        parser.add_argument('--db-workers', action='store', dest='db_workers', type=int, default=None,
+                            help='Threads for the database queries with the asyncio engine.')
+        parser.add_argument('--workers', action='store', dest='workers', type=int, default=DNS_WORKERS,
+                            help='Threads answering the queries, 0 for one thread per query.')
+        parser.add_argument('--queue-size', action='store', dest='queue_size', type=int, default=DNS_QUEUE_SIZE,
+                            help='Queries waiting for a worker before shedding the load.')
+        parser.add_argument('--overflow', action='store', dest='overflow', default=DNS_OVERFLOW,
+                            choices=SHED_MODES, help='What to do with the queries when the queue is full.')
+        parser.add_argument('--no-wire-cache', action='store_false', dest='wire_cache', default=DNS_WIRE_CACHE,
+                            help='Parse with dnslib also the queries answered from the cache.')
+        parser.add_argument('--cache-size', action='store', dest='cache_size', type=int, default=DNS_CACHE_MAX_SIZE,
+                            help='Max bytes used by the answer cache, 0 for disable it.')
+        parser.add_argument('--negative-cache-size', action='store', dest='negative_cache_size', type=int,
+                            default=DNS_NEGATIVE_CACHE_MAX_SIZE,
+                            help='Max bytes used by the NXDOMAIN/NODATA cache, 0 for disable it.')
+        parser.add_argument('--skip-random-names', action='store_true', dest='skip_random',
+                            default=DNS_SKIP_RANDOM_NAMES, help='Do not save random looking new names in DB.')
+        parser.add_argument('--prefetch-hits', action='store', dest='prefetch_hits', type=int,
+                            default=DNS_PREFETCH_HITS,
+                            help='Hits near the TTL expiration to refresh a cached answer, 0 for disable it.')
+        parser.add_argument('--serve-stale', action='store_true', dest='serve_stale', default=DNS_SERVE_STALE,
+                            help='Answer with the expired RRs saved in DB when the reply DNS server is slow.')
+        parser.add_argument('--snapshot', action='store', dest='snapshot', default=snapshot.DNS_SNAPSHOT_FILE,
+                            help='File where the cache is saved periodically and on shutdown and loaded on start.')
+        parser.add_argument('--metrics', action='store', dest='metrics_addr', default=dns_metrics.DNS_METRICS_ADDR,
+                            help='[addr:]port of the HTTP endpoint with the metrics in Prometheus format.')
+        parser.add_argument('--invalidation', action='store', dest='invalidation_socket',
+                            default=invalidation.DNS_INVALIDATION_SOCKET,
+                            help='Unix socket receiving the changes made by the admin, empty for disable it.')
+        parser.add_argument('--log-sample', action='store', dest='log_sample', type=int, default=DNS_LOG_SAMPLE,
+                            help='Log one of every N queries, 0 for none.')
+        parser.add_argument('--batch', action='store', dest='batch', type=int, default=DNS_UDP_BATCH,
+                            help='Datagrams read per wakeup in reused buffers, 0 for one read per query.')
+        parser.add_argument('--processes', action='store', dest='processes', type=int, default=DNS_PROCESSES,
+                            help='Worker processes sharing the port with SO_REUSEPORT, each one with its cache.')
 
     def execute(self, *args, **options):
         if options.get('no_color'):
@@ -110,7 +223,35 @@ class Command(BaseCommand):
     def run(self, *args, **options):
         in_threading = options.get('use_threading')
         self.dns_reply = options.get('dns_server')
+        try:
+            parse_upstreams(self.dns_reply)
+        except ValueError as ex:
+            raise CommandError(str(ex))
         tcp = options.get('use_tcp')
+        self.engine = options.get('engine', 'threading')
+        if self.engine == 'asyncio' and sys.version_info < (3, 5):
+            raise CommandError('The asyncio engine needs Python 3.5 or later.')
+        self.db_workers = options.get('db_workers')
+        self.overflow = options.get('overflow', DNS_OVERFLOW)
+        workers = options.get('workers', DNS_WORKERS)
+        if in_threading and workers > 0 and self.engine == 'threading':  # asyncio has its own DB threads
+            self.pool = WorkerPool(workers, options.get('queue_size', DNS_QUEUE_SIZE))
+        answer_cache.max_size = options.get('cache_size', DNS_CACHE_MAX_SIZE)
+        negative_cache.max_size = options.get('negative_cache_size', DNS_NEGATIVE_CACHE_MAX_SIZE)
+        self.wire_cache = options.get('wire_cache', DNS_WIRE_CACHE)
+        self.skip_random = options.get('skip_random', DNS_SKIP_RANDOM_NAMES)
+        self.prefetch_hits = options.get('prefetch_hits', DNS_PREFETCH_HITS)
+        self.serve_stale = options.get('serve_stale', DNS_SERVE_STALE)
+        self.snapshot = options.get('snapshot', snapshot.DNS_SNAPSHOT_FILE)
+        self.metrics_addr = options.get('metrics_addr', dns_metrics.DNS_METRICS_ADDR)
+        self.invalidation_socket = options.get('invalidation_socket', invalidation.DNS_INVALIDATION_SOCKET)
+        self.log_sample = options.get('log_sample', DNS_LOG_SAMPLE)
+        self.processes = options.get('processes', DNS_PROCESSES)
+        if self.processes > 1 and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+            raise CommandError('Several processes need fork() and SO_REUSEPORT.')
+        self.batch = options.get('batch', DNS_UDP_BATCH)
+        if self.batch > 0 and not hasattr(socket, 'MSG_DONTWAIT'):
+            raise CommandError('The batched reads need MSG_DONTWAIT.')
 
         shutdown_message = options.get('shutdown_message', '')
         quit_command = 'CTRL-BREAK' if sys.platform == 'win32' else 'CONTROL-C'
@@ -133,8 +274,15 @@ class Command(BaseCommand):
             "quit_command": quit_command,
         })
 
+        self.stdout.write("Loaded %d root filters\n" % len(get_policy()))
+        invalidation.serving = True
         try:
-            self.server(in_threading, tcp)
+            if self.processes > 1:
+                self.server_processes(in_threading, tcp)
+            else:
+                invalidation.listen(path=self.invalidation_socket)
+                self.start_services()
+                self.server(in_threading, tcp)
         except socket.error as e:
             # Use helpful error messages instead of ugly tracebacks.
             ERRORS = {
@@ -150,96 +298,641 @@ class Command(BaseCommand):
             # Need to use an OS exit because sys.exit doesn't work in a thread
             os._exit(1)
         except KeyboardInterrupt:
+            self.stop_services()
             if shutdown_message:
                 self.stdout.write(shutdown_message)
             sys.exit(0)
 
+    def start_services(self):
+        """
+        Starts the threads of the serving process, after the fork if there are several
+        """
+        self.upstreams = UpstreamPool(self.dns_reply).start()
+        touch_buffer.start()
+        if self.pool:
+            self.pool.start()
+        if self.prefetch_hits > 0:
+            self.prefetcher = Prefetcher(self, self.prefetch_hits).start()
+        answer_cache.on_hit = self.cache_hit
+        negative_cache.on_hit = self.touch_hit
+        if self.snapshot:
+            paths = set(path for path in (self.snapshot_base, self.snapshot) if path and os.path.exists(path))
+            for path in sorted(paths, key=os.path.getmtime):  # The newest entries replace the oldest
+                try:
+                    self.stdout.write("Loaded %d cached answers from %s\n" % (snapshot.load(path), path))
+                except (IOError, ValueError, struct.error) as ex:
+                    self.stderr.write("Error loading the cache snapshot %s: %s" % (path, ex))
+            self.snapshotter = snapshot.Snapshotter(self.snapshot).start()
+        if self.metrics_addr:
+            self.serve_metrics()
+
+    def cache_hit(self, key, entry, now):
+        """
+        Hooked in answer_cache.on_hit, touches the record and counts the hit for the prefetcher
+        """
+        self.touch_hit(key, entry, now)
+        if self.prefetcher:
+            self.prefetcher.hit(key, entry, now)
+
+    @staticmethod
+    def touch_hit(key, entry, now):
+        """
+        The cache and wire hits update last_query as the queries answered from the DB
+        """
+        if entry.pk:
+            touch_buffer.touch(entry.pk)
+
+    def serve_metrics(self):
+        addr, port = '127.0.0.1', str(self.metrics_addr)
+        if ':' in port:
+            addr, port = port.rsplit(':', 1)
+        port = int(port) + self.worker  # Every worker process has its own metrics
+        dns_metrics.serve(addr, port)
+        metrics.register(self.collect_metrics)
+        self.stdout.write("Metrics at http://%s:%d/metrics\n" % (addr, port))
+
+    def collect_metrics(self):
+        gauges = []
+        for name, cache in (('answer', answer_cache), ('negative', negative_cache)):
+            stats = cache.stats()
+            for stat in ('entries', 'size', 'hits', 'misses', 'evictions'):
+                gauges.append(('dns_cache_%s' % stat, {'cache': name}, stats[stat]))
+        for upstream in self.upstreams.stats():
+            for stat in ('sent', 'answered', 'timeouts', 'srtt'):
+                gauges.append(('dns_upstream_%s' % stat, {'upstream': upstream['upstream']}, upstream[stat]))
+        gauges.append(('dns_relay_coalesced', {}, relay_flight.coalesced))
+        gauges.append(('dns_relay_in_flight', {}, len(relay_flight)))
+        if self.pool:
+            for stat, value in self.pool.stats().items():
+                gauges.append(('dns_workers_%s' % stat, {}, value))
+        if self.prefetcher:
+            gauges.append(('dns_prefetch_scheduled', {}, self.prefetcher.scheduled))
+        return gauges
+
+    def stop_services(self):
+        if self.upstreams is None:
+            return  # Parent of the worker processes
+        touch_buffer.stop()
+        if self.snapshotter:
+            self.snapshotter.stop()
+        prefix = "[%d] " % os.getpid() if self.reuse_port else ""
+        self.stdout.write(prefix + "Answer cache %(entries)d entries, %(hits)d hits, %(misses)d misses\n" %
+                          answer_cache.stats())
+        self.stdout.write(prefix + "Negative cache %(entries)d entries, %(hits)d hits\n" % negative_cache.stats())
+        for upstream in self.upstreams.stats():
+            self.stdout.write(prefix + "Upstream %(upstream)s %(sent)d sent, %(answered)d answered, "
+                              "%(timeouts)d timeouts, %(srtt).3fs RTT\n" % upstream)
+        if self.prefetcher:
+            self.stdout.write(prefix + "Prefetch %(scheduled)d scheduled, %(dropped)d dropped, %(errors)d errors\n" %
+                              self.prefetcher.stats())
+        if self.pool:
+            self.stdout.write(prefix + "Workers %(processed)d queries, %(dropped)d dropped, %(errors)d errors\n" %
+                              self.pool.stats())
+
+    def server_processes(self, in_threading, tcp):
+        """
+        Forks the worker processes, every one binds the port with SO_REUSEPORT and
+        the parent forwards them the invalidation messages.
+        """
+        connections.close_all()  # The DB connections can not be shared with the children
+        children = {}
+        for i in range(self.processes):
+            parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            pid = os.fork()
+            if pid == 0:
+                parent_end.close()
+                for sock in children.values():
+                    sock.close()
+                self.worker = i
+                if self.snapshot:
+                    self.snapshot_base = self.snapshot  # Written by dns_warmup
+                    self.snapshot = '%s.%d' % (self.snapshot, i)  # Every worker has its own cache
+                self.serve_process(child_end, in_threading, tcp)  # Never returns
+            child_end.close()
+            children[pid] = parent_end
+        self.stdout.write("Started %d worker processes\n" % len(children))
+        invalidation.listen(followers=list(children.values()), local=False, path=self.invalidation_socket)
+        try:
+            while children:
+                pid, status = os.wait()
+                children.pop(pid, None)
+                logger.error("Worker process %d exited with status %d" % (pid, status))
+        except KeyboardInterrupt:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGINT)
+                except OSError:
+                    pass
+            for pid in children:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            raise
+
+    def serve_process(self, channel, in_threading, tcp):
+        self.reuse_port = True
+        invalidation.follow(channel)
+        code = 0
+        try:
+            self.start_services()
+            self.server(in_threading, tcp)
+        except KeyboardInterrupt:
+            self.stop_services()
+        except socket.error as ex:
+            self.stderr.write("Error in worker process %d: %s" % (os.getpid(), force_text(ex)))
+            code = 1
+        finally:
+            self.stdout.flush()
+            os._exit(code)
+
     def server(self, in_threading, tcp):
-        sock_type = socket.SOCK_DGRAM
-        if tcp:
-            sock_type = socket.SOCK_STREAM
-        sock = socket.socket(socket.AF_INET, sock_type)
+        if self.engine == 'asyncio':
+            from red_casa.dns.aio import AsyncServer
+            AsyncServer(self, self.db_workers).serve(self.addr, int(self.port), tcp, self.reuse_port)
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind((self.addr, int(self.port)))
-        # TODO change permissions if it's running as root
         if tcp:
-            sock.listen(1)
+            tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            tcp_sock.bind((self.addr, int(self.port)))
+            tcp_sock.listen(DNS_TCP_MAX_CONNECTIONS)
+            listener = threading.Thread(target=self.server_tcp, args=(tcp_sock, in_threading), name='dns-tcp')
+            listener.daemon = True
+            listener.start()
+        # TODO change permissions if it's running as root
+        if self.batch > 0:
+            self.server_udp_batch(sock, in_threading)
+        while True:
+            raw_query, addr = sock.recvfrom(UDP_RECV_SIZE)
+            self.dispatch_udp(sock, raw_query, addr, in_threading)
+
+    def server_udp_batch(self, sock, in_threading):
+        """
+        Drains up to self.batch datagrams per wakeup into reused buffers. The answers from
+        the cache are sent together after the batch, the rest of queries are dispatched as usual.
+        """
+        buffers = [memoryview(bytearray(UDP_RECV_SIZE)) for i in range(self.batch)]
+        while True:
+            received = []
+            flags = 0  # Only wait for the first datagram
+            for buf in buffers:
+                try:
+                    size, addr = sock.recvfrom_into(buf, 0, flags)
+                except socket.error as ex:
+                    if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                received.append((buf[:size], addr))
+                flags = socket.MSG_DONTWAIT
+            answers = []
+            for raw_query, addr in received:
+                found, packed = self.wire_answer(raw_query, udp=True)
+                if not found:
+                    self.dispatch_udp(sock, raw_query.tobytes(), addr, in_threading)
+                elif packed:
+                    answers.append((packed, addr))
+            for packed, addr in answers:
+                sock.sendto(packed, addr)
+
+    def dispatch_udp(self, sock, raw_query, addr, in_threading):
+        if self.pool:
+            if not self.pool.submit(self.response_udp, sock, raw_query, addr):
+                self.shed_udp(sock, raw_query, addr)
+        elif in_threading:
+            threading.Thread(target=self.response_udp, args=(sock, raw_query, addr)).start()
+        else:
+            self.response_udp(sock, raw_query, addr)
+
+    def server_tcp(self, sock, in_threading):
+        connections = threading.BoundedSemaphore(DNS_TCP_MAX_CONNECTIONS)
+        while True:
             conn, addr = sock.accept()
-            if in_threading:
-                threading.Thread(target=self.response_tcp, args=(conn, addr)).start()
-            else:
+            if not in_threading:
                 self.response_tcp(conn, addr)
-        else:
-            while True:
-                raw_query, addr = sock.recvfrom(DEFAULT_DNS_PACKET_SIZE)
-                if in_threading:
-                    threading.Thread(target=self.response_udp, args=(sock, raw_query, addr)).start()
-                else:
-                    self.response_udp(sock, raw_query, addr)
+            elif connections.acquire(False):
+                thread = threading.Thread(target=self.response_tcp, args=(conn, addr, connections))
+                thread.daemon = True
+                thread.start()
+            else:
+                logger.warn("Too many TCP connections, closing %s:%s" % addr)
+                conn.close()
 
     def get_response(self, raw_query, addr):
-        self.stdout.write("Received query from %s:%s" % addr)
-        received = DNSRecord.parse(raw_query)
+        received = self.parse_query(raw_query, addr)
+        if received is None:
+            return None
+        self.log_query(received, addr)
         emitter = received.reply()
+        try:
+            for query in received.questions:
+                record = self.resolve(query)
+                if record is None:
+                    return None
+                add_record(emitter, record)
+        except Exception as ex:
+            self.servfail(emitter, ex)
+        self.edns(received, emitter)
+        return emitter
+
+    @staticmethod
+    def parse_query(raw_query, addr):
+        """
+        :return: DNSRecord or None if the query is malformed
+        """
+        try:
+            return DNSRecord.parse(raw_query)
+        except Exception as ex:  # DNSError, but dnslib lets some struct and index errors through
+            logger.warn("Malformed query from %s:%s %s" % (addr[0], addr[1], ex))
+            metrics.inc('dns_errors_total', kind='parse')
+            return None
+
+    @staticmethod
+    def servfail(emitter, ex):
+        """
+        Answers SERVFAIL counting the error by kind: upstream_timeout, db or handler
+        """
+        if isinstance(ex, UpstreamTimeout):
+            logger.warn("%s" % ex)
+            kind = 'upstream_timeout'
+        elif isinstance(ex, DatabaseError):
+            logger.error("Database error: %s" % ex)
+            kind = 'db'
+        else:
+            logger.error("Error resolving %s: %r" % (emitter.q.qname, ex))
+            kind = 'handler'
+        metrics.inc('dns_errors_total', kind=kind)
+        emitter.header.rcode = RCODE.SERVFAIL
+
+    def log_query(self, received, addr):
+        """
+        Writes the query in stdout and the log, only one of every log_sample queries
+        """
+        if self.log_sample <= 0:
+            return
+        self.logged = (self.logged + 1) % self.log_sample
+        if self.logged:
+            return
+        self.stdout.write("Received query from %s:%s" % addr[:2])
         for query in received.questions:
             logger.info("Query name=%s type=%s class=%s" %
                         (query.qname, dns.QTYPE.get(query.qtype), dns.CLASS.get(query.qclass)))
-            is_new = False
-            try:
-                dbdata = models.DNSRecord.objects.get(qname=query.qname, qtype=query.qtype, qclass=query.qclass)
-            except models.DNSRecord.DoesNotExist:
-                dbdata = models.DNSRecord.objects.create(qname=query.qname, qtype=query.qtype, qclass=query.qclass)
-                is_new = True
-            if dbdata.is_locked:
-                if is_new:
-                    dbdata.always_reply = dbdata.is_relay
-                    dbdata.lock = True
-                dbdata.save()  # Update last_query
-                return None
-            elif not dbdata.is_relay:
-                if is_new:
-                    dbdata.always_reply = False
-                if dbdata.rdata:
-                    if dns.QTYPE.get(query.qtype) == 'MX':
-                        preference, label = dbdata.rdata.split(' ', 1)
-                        emitter.add_answer(RR(query.qname, query.qtype,
-                                              rdata=MX(label, int(preference))))
-                    elif dns.QTYPE.get(query.qtype) in RDMAP:
-                        emitter.add_answer(RR(query.qname, query.qtype,
-                                              rdata=RDMAP[dns.QTYPE.get(query.qtype)](dbdata.rdata)))
-                        logger.debug("Data cached %s" % dbdata.rdata)
-                    else:
-                        logger.warn("Not supported type %s" % query.qtype)
-                else:
-                    logger.debug("No data in DB for %s" % dbdata.qname)
-                dbdata.save()  # Update last_query
+
+    @staticmethod
+    def measure(path, start):
+        metrics.inc('dns_queries_total', path=path)
+        metrics.observe('dns_query_seconds', time.time() - start, path=path)
+
+    @staticmethod
+    def edns(received, emitter):
+        """
+        Echoes the OPT RR of the query advertising our max UDP payload
+        """
+        for rr in received.ar:
+            if rr.rtype == QTYPE.OPT:
+                emitter.add_ar(EDNS0(udp_len=DNS_EDNS_MAX_PAYLOAD))
+                break
+
+    def resolve(self, query):
+        """
+        :param query: DNSQuestion
+        :return: DNSRecord with the answer, authority and additional RRs for the query
+            or None if the query must not be answered
+        """
+        start = time.time()
+        key = cache_key(query.qname, query.qtype, query.qclass)
+        found, record = self.cached_answers(key)
+        if found:
+            self.measure(dns_metrics.CACHE if record is not None else dns_metrics.LOCKED, start)
+            return record
+        dbdata, action, record = self.local_answers(query, key)
+        if action == RELAY:
+            stale = False
+            if self.serve_stale and (dbdata.rrset or dbdata.rdata):
+                record, stale = self.relay_or_stale(query, key, dbdata)
             else:
-                logger.debug("Asking to %s" % self.dns_reply)
-                q = DNSRecord.question(query.qname, dns.QTYPE.get(query.qtype), dns.CLASS.get(query.qclass))
-                query_answer = DNSRecord.parse(q.send(self.dns_reply))
-                for response in query_answer.rr:
-                    logger.info("Caching name=%s query=%s class=%s rdata=%s" %
-                                (response.rname, dns.QTYPE.get(response.rtype),
-                                 dns.CLASS.get(response.rtype), response.rdata))
-                    if response.rname == query.qname and response.rtype == query.qtype:
-                        emitter.add_answer(RR(response.rname,  response.rtype, response.rclass, rdata=response.rdata))
-                        if response.rdata:
-                            dbdata.rdata = response.rdata
-                            dbdata.save()
-                        # break
-        return emitter
+                record = relay_flight.do(key, self.relay_and_store, query, key, dbdata)
+            self.measure(dns_metrics.STALE if stale else dns_metrics.UPSTREAM, start)
+        else:
+            self.measure(dns_metrics.LOCKED if action == LOCKED else dns_metrics.DB, start)
+        return record
+
+    def relay_or_stale(self, query, key, dbdata):
+        """
+        Waits for the relayed answer up to DNS_STALE_DEADLINE and then answers with the stale RRs,
+        the relayed query keeps going in background and updates the cache when it's answered.
+        :return: (record, stale)
+        """
+        future, leader = relay_flight.begin(key)
+        if leader:
+            thread = threading.Thread(target=self.relay_in_background, args=(query, key, dbdata, future))
+            thread.daemon = True
+            thread.start()
+        try:
+            return future.result(DNS_STALE_DEADLINE), False
+        except Exception as ex:
+            logger.debug("No fresh answer for %s: %r" % (query.qname, ex))
+        record = self.stale_answers(query, key, dbdata)
+        if record is None:
+            return future.result(), False
+        return record, True
+
+    def relay_in_background(self, query, key, dbdata, future):
+        try:
+            record = self.relay_and_store(query, key, dbdata)
+        except Exception as ex:
+            relay_flight.finish(key, future, exception=ex)
+        else:
+            relay_flight.finish(key, future, record)
+        finally:
+            db_connection.close()
+
+    def refresh(self, query, key):
+        """
+        Resolves the query again skipping the cache, used by the prefetcher
+        """
+        dbdata, action, record = self.local_answers(query, key)
+        if action == RELAY:
+            relay_flight.do(key, self.relay_and_store, query, key, dbdata)
+
+    def relay_and_store(self, query, key, dbdata):
+        return self.relay_answers(query, key, dbdata, self.relay(query))
+
+    def cached_answers(self, key):
+        """
+        :return: (found, record) where record is None if the query must not be answered
+        """
+        cached = answer_cache.get(key)
+        if cached is None:
+            cached = negative_cache.get(key, count_miss=False)
+        if cached is None:
+            return False, None
+        if cached.locked:
+            return True, None
+        elapsed = cached.ttl - cached.remaining()
+        record = DNSRecord.parse(cached.packed)
+        for rr in record.rr + record.auth + record.ar:
+            if rr.rtype != QTYPE.OPT:
+                rr.ttl = max(0, rr.ttl - elapsed)
+        return True, record
+
+    def local_answers(self, query, key):
+        """
+        Answers the query from the database
+        :return: (dbdata, action, record), record is None if the query must not be answered
+            and empty when the action is RELAY
+        """
+        is_new = False
+        try:
+            dbdata = models.DNSRecord.objects.get(qname=query.qname, qtype=query.qtype, qclass=query.qclass)
+        except models.DNSRecord.DoesNotExist:
+            dbdata = models.DNSRecord(qname=query.qname, qtype=query.qtype, qclass=query.qclass)
+            is_new = True
+            if self.skip_random and is_random_name(query.qname):
+                logger.debug("Not saving random name %s" % query.qname)
+            else:
+                try:
+                    with transaction.atomic():
+                        dbdata.save(force_insert=True)
+                except IntegrityError:  # Created by a concurrent query
+                    dbdata = models.DNSRecord.objects.get(qname=query.qname, qtype=query.qtype,
+                                                          qclass=query.qclass)
+                    is_new = False
+        action = dbdata.policy
+        record = DNSRecord(DNSHeader(qr=1), q=query)
+        ttl = DNS_CACHE_DEFAULT_TTL
+        if not is_new:
+            touch_buffer.touch(dbdata.pk)  # Update last_query
+        if action == LOCKED:
+            if is_new and dbdata.pk:
+                dbdata.lock = True
+                dbdata.save(update_fields=['lock'])
+            self.cache_answers(key, None, ttl, dbdata.pk)
+            return dbdata, action, None
+        elif action == CACHE:
+            ttl = self.stored_answers(query, dbdata, record, ttl)
+            self.cache_answers(key, record, ttl, dbdata.pk)
+        return dbdata, action, record
+
+    @staticmethod
+    def stored_answers(query, dbdata, record, ttl):
+        """
+        Adds to record the RRs saved in dbdata
+        :return: TTL of the RRs
+        """
+        if dbdata.rrset:
+            record.add_answer(*RR.fromZone(dbdata.rrset))
+            if dbdata.additional:
+                record.add_ar(*RR.fromZone(dbdata.additional))
+            ttl = record_ttl(record, ttl)
+            logger.debug("RRset cached %s" % dbdata.qname)
+        elif dbdata.rdata:
+            if dns.QTYPE.get(query.qtype) == 'MX':
+                preference, label = dbdata.rdata.split(' ', 1)
+                record.add_answer(RR(query.qname, query.qtype, ttl=ttl,
+                                     rdata=MX(label, int(preference))))
+            elif dns.QTYPE.get(query.qtype) in RDMAP:
+                record.add_answer(RR(query.qname, query.qtype, ttl=ttl,
+                                     rdata=RDMAP[dns.QTYPE.get(query.qtype)](dbdata.rdata)))
+                logger.debug("Data cached %s" % dbdata.rdata)
+            else:
+                logger.warn("Not supported type %s" % query.qtype)
+        else:
+            logger.debug("No data in DB for %s" % dbdata.qname)
+        return ttl
+
+    def stale_answers(self, query, key, dbdata):
+        """
+        Answers with the last RRs saved in DB with DNS_STALE_TTL, they are also cached
+        for DNS_STALE_TTL so the next queries don't wait for the reply DNS server again.
+        :return: DNSRecord or None if there is not RRs or they are too old
+        """
+        if not (dbdata.rrset or dbdata.rdata):
+            return None
+        if dbdata.expires and timezone.now() - dbdata.expires > timedelta(seconds=DNS_STALE_MAX_AGE):
+            return None
+        record = DNSRecord(DNSHeader(qr=1), q=query)
+        self.stored_answers(query, dbdata, record, DNS_STALE_TTL)
+        if not record.rr:
+            return None
+        for rr in record.rr + record.ar:
+            rr.ttl = DNS_STALE_TTL
+        logger.warn("Serving stale answer for %s" % dbdata.qname)
+        metrics.inc('dns_stale_answers_total')
+        self.cache_answers(key, record, DNS_STALE_TTL, dbdata.pk)
+        return record
+
+    def relay(self, query):
+        """
+        :return: Raw answer of the reply DNS server
+        """
+        logger.debug("Asking to %s" % self.dns_reply)
+        q = DNSRecord.question(query.qname, dns.QTYPE.get(query.qtype), dns.CLASS.get(query.qclass))
+        return self.upstreams.query(q.pack())
+
+    def relay_answers(self, query, key, dbdata, raw_answer):
+        """
+        Saves and caches the answer of the reply DNS server, the NXDOMAIN and
+        NODATA answers are only cached in memory with the SOA negative TTL.
+        :return: DNSRecord with the answer, authority and additional RRs
+        """
+        query_answer = DNSRecord.parse(raw_answer)
+        record = DNSRecord(DNSHeader(qr=1, rcode=query_answer.header.rcode), q=query)
+        names = set([str(query.qname).lower()])
+        for response in query_answer.rr:  # The RRs of the query and its CNAME chain
+            logger.debug("Caching name=%s query=%s class=%s rdata=%s" %
+                         (response.rname, dns.QTYPE.get(response.rtype), dns.CLASS.get(response.rtype),
+                          response.rdata))
+            if str(response.rname).lower() not in names:
+                continue
+            if response.rtype == QTYPE.CNAME:
+                names.add(str(response.rdata.label).lower())
+            elif response.rtype != query.qtype:
+                continue
+            record.add_answer(response)
+        for response in query_answer.ar:
+            if response.rtype != QTYPE.OPT:
+                record.add_ar(response)
+        if record.rr:
+            ttl = record_ttl(record, 0)
+            self.store_rrset(dbdata, record, ttl)
+            self.cache_answers(key, record, ttl, dbdata.pk)
+        elif record.header.rcode in (RCODE.NOERROR, RCODE.NXDOMAIN):
+            record.add_auth(*[rr for rr in query_answer.auth if rr.rtype == QTYPE.SOA])
+            ttl = negative_ttl(record)
+            if ttl is not None:  # Without SOA the answer must not be cached
+                for rr in record.auth:
+                    rr.ttl = ttl
+                negative_cache.put(key, record.pack(), ttl, pk=dbdata.pk)
+        return record
+
+    @staticmethod
+    def store_rrset(dbdata, record, ttl):
+        """
+        Saves the RRs of the record in the DNSRecord with one UPDATE
+        """
+        for rr in record.rr:
+            if rr.rtype == dbdata.qtype:
+                dbdata.rdata = str(rr.rdata)
+                break
+        dbdata.rrset = '\n'.join(rr.toZone() for rr in record.rr)
+        dbdata.additional = '\n'.join(rr.toZone() for rr in record.ar) or None
+        dbdata.expires = timezone.now() + timedelta(seconds=ttl)
+        with transaction.atomic():
+            dbdata.save(update_fields=['rdata', 'rrset', 'additional', 'expires', 'last_query'])
+
+    @staticmethod
+    def cache_answers(key, record, ttl, pk=None):
+        """
+        :param record: DNSRecord with the answer or None if the query must not be answered
+        :param pk: DNSRecord pk, touched on the cache hits
+        """
+        packed = None
+        if record is not None:
+            packed = record.pack()
+        answer_cache.put(key, packed, ttl, pk=pk)
+
+    def shed_udp(self, sock, raw_query, addr):
+        """
+        Answers without resolving the query when the workers are busy
+        """
+        if self.overflow == SHED_DROP:
+            return
+        rcode = REFUSED if self.overflow == SHED_REFUSED else SERVFAIL
+        packed = error_response(raw_query, rcode)
+        if packed:
+            sock.sendto(packed, addr)
+
+    def pack_udp(self, emitter, max_size=DNS_UDP_PAYLOAD):
+        """
+        Packs the answer trimming it to max_size: first the additional RRs but OPT, then the
+        authority RRs and then whole answer RRsets from the end, with the TC flag if any answer
+        or authority RR does not fit.
+        :param max_size: UDP payload of the client
+        :return: Packed answer
+        """
+        packed = emitter.pack()
+        if len(packed) <= max_size:
+            return packed
+        opt = [rr for rr in emitter.ar if rr.rtype == QTYPE.OPT]
+        trimmed = DNSRecord(DNSHeader(id=emitter.header.id, bitmap=emitter.header.bitmap),
+                            questions=emitter.questions, rr=list(emitter.rr), auth=list(emitter.auth), ar=opt)
+        packed = trimmed.pack()
+        if len(packed) <= max_size:
+            return packed
+        trimmed.header.tc = 1
+        trimmed.auth = []
+        packed = trimmed.pack()
+        while len(packed) > max_size and trimmed.rr:
+            last = trimmed.rr[-1]
+            while trimmed.rr and trimmed.rr[-1].rname == last.rname and trimmed.rr[-1].rtype == last.rtype:
+                trimmed.rr.pop()
+            packed = trimmed.pack()
+        return packed
+
+    def wire_answer(self, raw_query, udp=False):
+        """
+        :return: (found, packed) answering from the cache without dnslib
+        """
+        if not self.wire_cache:
+            return False, None
+        start = time.time()
+        found, packed = answer_cache.wire_answer(raw_query, udp)
+        if not found:
+            found, packed = negative_cache.wire_answer(raw_query, udp)
+        if found:
+            self.measure(dns_metrics.WIRE if packed else dns_metrics.LOCKED, start)
+        return found, packed
 
     def response_udp(self, sock, raw_query, addr):
+        found, packed = self.wire_answer(raw_query, udp=True)
+        if found:
+            if packed:
+                sock.sendto(packed, addr)
+            return
         emitter = self.get_response(raw_query, addr)
         if emitter:
-            sock.sendto(emitter.pack(), addr)
-
-    def response_tcp(self, conn, addr):
-        raw_query = ''
-        data = conn.recv(1024)
-        while data:
-            raw_query += data
-            data = conn.recv(1024)
-        emitter = self.get_response(data, addr)
-        if emitter:
-            conn.sendall(emitter.pack())
-        conn.close()
+            sock.sendto(self.pack_udp(emitter, udp_payload(edns_payload(raw_query))), addr)
+
+    def response_tcp(self, conn, addr, connections=None):
+        conn.settimeout(DNS_TCP_IDLE_TIMEOUT)
+        try:
+            while True:  # Several queries can be sent in the same connection
+                size = recv_exactly(conn, 2)
+                if not size:
+                    break
+                raw_query = recv_exactly(conn, struct.unpack('!H', size)[0])
+                if not raw_query:
+                    break
+                found, packed = self.wire_answer(raw_query)
+                if not found:
+                    emitter = self.get_response(raw_query, addr)
+                    packed = emitter.pack() if emitter else None
+                if packed:
+                    conn.sendall(struct.pack('!H', len(packed)) + packed)
+        except socket.timeout:
+            pass
+        except socket.error as ex:
+            logger.debug("TCP connection %s:%s %s" % (addr[0], addr[1], ex))
+        finally:
+            conn.close()
+            if connections:
+                connections.release()
+
+
+def recv_exactly(conn, size):
+    """
+    :return: size bytes or None if the connection is closed before
+    """
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
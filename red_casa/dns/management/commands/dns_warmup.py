@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+
+from django.utils import timezone
+from django.core.management.base import BaseCommand, CommandError
+
+from red_casa.dns import models
+from red_casa.dns import snapshot
+from red_casa.dns.cache import AnswerCache, cache_key, DNS_CACHE_DEFAULT_TTL, DNS_CACHE_MAX_SIZE, \
+    DNS_NEGATIVE_CACHE_MAX_SIZE
+from red_casa.dns.policy import LOCKED, RELAY
+from red_casa.dns.management.commands.dns_server import Command as DNSServerCommand
+
+from dnslib import DNSRecord, DNSHeader, DNSQuestion
+import os
+
+
+class Command(BaseCommand):
+    help = 'Build the dns_server cache snapshot from the last queried records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--snapshot', action='store', dest='snapshot', default=snapshot.DNS_SNAPSHOT_FILE,
+                            help='Snapshot file loaded by dns_server on start.')
+        parser.add_argument('--limit', action='store', dest='limit', type=int, default=10000,
+                            help='Max records, the most recently queried first.')
+        parser.add_argument('--merge', action='store_true', dest='merge', default=False,
+                            help='Keep the entries of the current snapshot.')
+
+    def handle(self, *args, **options):
+        path = options.get('snapshot')
+        if not path:
+            raise CommandError('A snapshot file is needed, set --snapshot or DNS_SNAPSHOT_FILE.')
+        cache = AnswerCache(DNS_CACHE_MAX_SIZE)
+        caches = (cache, AnswerCache(DNS_NEGATIVE_CACHE_MAX_SIZE))
+        if options.get('merge') and os.path.exists(path):
+            self.stdout.write("Loaded %d entries from %s\n" % (snapshot.load(path, caches), path))
+        now = timezone.now()
+        warmed = 0
+        records = models.DNSRecord.objects.order_by('-last_query')[:options.get('limit')]
+        for dbdata in records.iterator():
+            key = cache_key(dbdata.qname, dbdata.qtype, dbdata.qclass)
+            if key in cache:
+                continue
+            action = dbdata.policy
+            if action == LOCKED:
+                cache.put(key, None, DNS_CACHE_DEFAULT_TTL)
+                warmed += 1
+                continue
+            remaining = None
+            if action == RELAY:
+                if not dbdata.rrset or not dbdata.expires or dbdata.expires <= now:
+                    continue  # Only the relayed RRs still valid
+                remaining = int((dbdata.expires - now).total_seconds())
+            elif not (dbdata.rrset or dbdata.rdata):
+                continue
+            query = DNSQuestion(dbdata.qname, dbdata.qtype, dbdata.qclass)
+            record = DNSRecord(DNSHeader(qr=1), q=query)
+            ttl = DNSServerCommand.stored_answers(query, dbdata, record, DNS_CACHE_DEFAULT_TTL)
+            if remaining is not None:
+                for rr in record.rr + record.ar:
+                    rr.ttl = min(rr.ttl, remaining)
+                ttl = min(ttl, remaining)
+            if record.rr and cache.put(key, record.pack(), ttl):
+                warmed += 1
+        written = snapshot.dump(path, caches)
+        self.stdout.write("Warmed %d records, %d entries saved in %s\n" % (warmed, written, path))
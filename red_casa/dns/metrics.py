@@ -0,0 +1,166 @@
+"""
+Counters and latency histograms of dns_server in Prometheus text format
+
+Nothing is recorded until the registry is enabled, so the hot path only pays
+an attribute check when the metrics are not exported.
+"""
+from django.conf import settings
+from django.utils.six.moves import BaseHTTPServer, socketserver
+
+from bisect import bisect_left
+import threading
+import logging
+
+logger = logging.getLogger('dns_server')
+
+DNS_METRICS_ADDR = None  # [addr:]port of the HTTP endpoint, None for disable it
+if hasattr(settings, 'DNS_METRICS_ADDR'):
+    DNS_METRICS_ADDR = settings.DNS_METRICS_ADDR
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# Query paths
+WIRE = 'wire'  # Answered from the cache without dnslib
+CACHE = 'cache'
+DB = 'db'
+UPSTREAM = 'upstream'
+STALE = 'stale'
+LOCKED = 'locked'
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+def format_labels(labels, extra=None):
+    labels = list(labels) + ([extra] if extra else [])
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in labels)
+
+
+class Metrics(object):
+    """
+    Registry of counters and histograms by name and labels, the collectors
+    are called on render and return [(name, labels dict, value)] gauges.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self.help = {}
+        self.mutex = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.mutex:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.mutex:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def register(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in self.help:
+                    lines.append('# HELP %s %s' % (name, self.help[name]))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        with self.mutex:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(histogram.counts), histogram.total, histogram.count))
+                                for key, histogram in self.histograms.items())
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), (counts, total, count) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket in zip(list(LATENCY_BUCKETS) + ['+Inf'], counts):
+                cumulative += bucket
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, ('le', bound)), cumulative))
+            lines.append('%s_sum%s %f' % (name, format_labels(labels), total))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+        for collector in self.collectors:
+            try:
+                gauges = collector()
+            except Exception as ex:
+                logger.error("Error collecting metrics: %s" % ex)
+                continue
+            for name, labels, value in gauges:
+                header(name, 'gauge')
+                lines.append('%s%s %s' % (name, format_labels(sorted(labels.items())), value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('dns_queries_total', 'Answered questions by path')
+metrics.describe('dns_query_seconds', 'Time resolving a question by path')
+metrics.describe('dns_upstream_rtt_seconds', 'Round trip time of the reply DNS servers')
+metrics.describe('dns_errors_total', 'Failed questions by kind')
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics %s" % (format % args))
+
+
+class MetricsServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(addr, port):
+    """
+    Enables the metrics and serves them in background
+    :return: The HTTP server
+    """
+    metrics.enabled = True
+    server = MetricsServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='dns-metrics')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dns', '0002_dnsrecord_always_reply'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RootFilter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('qname', models.CharField(max_length=512)),
+                ('always_reply', models.BooleanField(default=False, help_text="Don't use DNS cache")),
+                ('lock', models.BooleanField(default=False, help_text='Never response to this query')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='dnsrecord',
+            name='last_query',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='dnsrecord',
+            name='lock',
+            field=models.BooleanField(default=False, help_text='Never response to this query'),
+        ),
+        migrations.AlterField(
+            model_name='dnsrecord',
+            name='always_reply',
+            field=models.BooleanField(default=False, help_text="Don't use DNS cache"),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dns', '0003_rootfilter_lock_last_query'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dnsrecord',
+            name='additional',
+            field=models.TextField(blank=True, help_text='Additional RRs in zone file format', null=True),
+        ),
+        migrations.AddField(
+            model_name='dnsrecord',
+            name='expires',
+            field=models.DateTimeField(blank=True, help_text='When the TTL of the RRs expires', null=True),
+        ),
+        migrations.AddField(
+            model_name='dnsrecord',
+            name='rrset',
+            field=models.TextField(blank=True, help_text='Answer RRs in zone file format', null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dns', '0004_dnsrecord_rrset'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rootfilter',
+            name='qname',
+            field=models.CharField(db_index=True, max_length=512),
+        ),
+    ]
@@ -1,13 +1,22 @@
 from django.db import models
-from django.db.models.query import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from dnslib.dns import QTYPE, CLASS
 
+from red_casa.dns import policy as dns_policy
+from red_casa.dns import invalidation
+from red_casa.dns import cache as dns_cache
+from red_casa.dns.policy import get_policy, LOCKED, RELAY
+
 
 class DNSRecord(models.Model):
     qname = models.CharField(max_length=512)
     qtype = models.IntegerField()
     qclass = models.IntegerField()
     rdata = models.TextField(null=True, blank=True)
+    rrset = models.TextField(null=True, blank=True, help_text="Answer RRs in zone file format")
+    additional = models.TextField(null=True, blank=True, help_text="Additional RRs in zone file format")
+    expires = models.DateTimeField(null=True, blank=True, help_text="When the TTL of the RRs expires")
     always_reply = models.BooleanField(default=False, help_text="Don't use DNS cache")
     lock = models.BooleanField(default=False, help_text="Never response to this query")
     last_query = models.DateTimeField(auto_now=True)
@@ -19,44 +28,48 @@ class DNSRecord(models.Model):
         return "%s %s %s" % (self.qname, QTYPE.get(self.qtype), CLASS.get(self.qclass))
 
     def parent(self):
-        parts = str(self.qname).split('.')
-        dots = len(parts)
-        query = Q()
-        for i in range(dots):
-            query |= Q(qname='.'.join(parts[i:]))
-        return RootFilter.objects.filter(query)
+        parts = str(self.qname).strip('.').split('.')
+        names = ['.'.join(parts[i:]) for i in range(len(parts))]
+        return RootFilter.objects.filter(qname__in=names + [name + '.' for name in names])
+
+    @property
+    def policy(self):
+        """
+        :return: policy.LOCKED, policy.RELAY or policy.CACHE without asking to the database
+        """
+        return get_policy().decision(self.qname, self.lock, self.always_reply)
 
     @property
     def is_locked(self):
-        return self.lock or self.parent().filter(lock=True).exists()
+        return self.policy == LOCKED
 
     @property
     def is_relay(self):
-        relay = self.always_reply
-        if self.is_locked or not relay:
-            relay = False
-        else:
-            parent_replay = self.parent().filter(always_reply=True)
-            parent_no_replay = self.parent().filter(always_reply=False)
-            if parent_replay.exists():
-                if parent_no_replay.exists():
-                    max_yes = 0
-                    for parent in parent_replay.iterator():
-                        dots = parent.qname.count('.')
-                        if dots > max_yes:
-                            max_yes = dots
-                    max_no = 0
-                    for parent in parent_no_replay.iterator():
-                        dots = parent.qname.count('.')
-                        if dots > max_no:
-                            max_no = dots
-                    relay = max_yes > max_no
-            elif parent_no_replay.exists():
-                relay = False
-        return relay
+        return self.policy == RELAY
 
 
 class RootFilter(models.Model):
-    qname = models.CharField(max_length=512)
+    qname = models.CharField(max_length=512, db_index=True)
     always_reply = models.BooleanField(default=False, help_text="Don't use DNS cache")
     lock = models.BooleanField(default=False, help_text="Never response to this query")
+
+
+@receiver(post_save, sender=RootFilter)
+def root_filter_saved(sender, instance, **kwargs):
+    dns_policy.update(instance)
+    dns_cache.clear()
+    invalidation.publish(invalidation.ROOT_FILTER)
+
+
+@receiver(post_delete, sender=RootFilter)
+def root_filter_deleted(sender, instance, **kwargs):
+    dns_policy.discard(instance)
+    dns_cache.clear()
+    invalidation.publish(invalidation.ROOT_FILTER)
+
+
+@receiver(post_save, sender=DNSRecord)
+@receiver(post_delete, sender=DNSRecord)
+def dns_record_changed(sender, instance, **kwargs):
+    dns_cache.invalidate(dns_cache.cache_key(instance.qname, instance.qtype, instance.qclass))
+    invalidation.publish(invalidation.RECORD, instance.qname, instance.qtype, instance.qclass)
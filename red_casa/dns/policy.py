@@ -0,0 +1,256 @@
+from django.conf import settings
+
+from collections import Counter
+import threading
+import logging
+import math
+import time
+
+from red_casa.dns import cache as dns_cache
+
+logger = logging.getLogger('dns_server')
+
+LOCKED = 'locked'
+RELAY = 'relay'
+CACHE = 'cache'
+
+DNS_POLICY_REFRESH = 60
+if hasattr(settings, 'DNS_POLICY_REFRESH'):
+    DNS_POLICY_REFRESH = int(settings.DNS_POLICY_REFRESH)
+
+DNS_RANDOM_LABEL_SIZE = 12  # Min label length to look random
+if hasattr(settings, 'DNS_RANDOM_LABEL_SIZE'):
+    DNS_RANDOM_LABEL_SIZE = int(settings.DNS_RANDOM_LABEL_SIZE)
+
+DNS_RANDOM_ENTROPY = 3.6  # Min Shannon entropy, bits per char, of a random label
+if hasattr(settings, 'DNS_RANDOM_ENTROPY'):
+    DNS_RANDOM_ENTROPY = float(settings.DNS_RANDOM_ENTROPY)
+
+
+def split_labels(qname):
+    """
+    :param qname: Domain name, with or without the trailing dot
+    :return: Lower case labels from the TLD to the host
+    """
+    qname = str(qname).strip('.').lower()
+    if not qname:
+        return []
+    return list(reversed(qname.split('.')))
+
+
+def entropy(label):
+    """
+    :return: Shannon entropy of the label in bits per char
+    """
+    size = float(len(label))
+    return sum(count / size * math.log(size / count, 2) for count in Counter(label).values())
+
+
+def is_random_name(qname):
+    """
+    Tracker and DGA subdomains have a long label with high entropy or mixing letters and digits,
+    the last two labels (the registered domain) are not checked.
+    """
+    for label in split_labels(qname)[2:]:
+        if len(label) < DNS_RANDOM_LABEL_SIZE:
+            continue
+        digits = sum(1 for char in label if char.isdigit())
+        if entropy(label) >= DNS_RANDOM_ENTROPY or 0.25 <= digits / float(len(label)) < 1:
+            return True
+    return False
+
+
+class _Node(object):
+    __slots__ = ('children', 'lock', 'reply', 'no_reply')
+
+    def __init__(self):
+        self.children = {}
+        self.lock = 0
+        self.reply = 0
+        self.no_reply = 0
+
+    def is_empty(self):
+        return not (self.children or self.lock or self.reply or self.no_reply)
+
+
+class PolicyTrie(object):
+    """
+    Label reversed trie with all the RootFilter rows.
+
+    It answers the same questions than DNSRecord.parent() based lookups walking
+    only the labels of the name, so there are not SQL queries in the hot path.
+    Every node counts the rows on it, so rows can be added and removed one by
+    one when they are changed.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.entries = {}
+        self.mutex = threading.Lock()
+        self.loaded = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _node(self, labels, create=False):
+        node = self.root
+        path = [node]
+        for label in labels:
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None, path
+                child = node.children[label] = _Node()
+            node = child
+            path.append(node)
+        return node, path
+
+    def add(self, pk, qname, lock=False, always_reply=False):
+        with self.mutex:
+            self._remove(pk)
+            labels = split_labels(qname)
+            node, path = self._node(labels, create=True)
+            if lock:
+                node.lock += 1
+            if always_reply:
+                node.reply += 1
+            else:
+                node.no_reply += 1
+            self.entries[pk] = (labels, bool(lock), bool(always_reply))
+
+    def remove(self, pk):
+        with self.mutex:
+            self._remove(pk)
+
+    def _remove(self, pk):
+        entry = self.entries.pop(pk, None)
+        if entry is None:
+            return
+        labels, lock, always_reply = entry
+        node, path = self._node(labels)
+        if node is None:
+            return
+        if lock:
+            node.lock -= 1
+        if always_reply:
+            node.reply -= 1
+        else:
+            node.no_reply -= 1
+        for depth in range(len(labels), 0, -1):  # Prune the empty branch
+            if not path[depth].is_empty():
+                break
+            del path[depth - 1].children[labels[depth - 1]]
+
+    def load(self, rows):
+        """
+        :param rows: Iterable of (pk, qname, lock, always_reply)
+        :return: If the rows are not the loaded ones
+        """
+        trie = PolicyTrie()
+        for pk, qname, lock, always_reply in rows:
+            trie.add(pk, qname, lock, always_reply)
+        with self.mutex:
+            changed = trie.entries != self.entries
+            self.root, self.entries = trie.root, trie.entries
+            self.loaded = time.time()
+        return changed
+
+    def lookup(self, qname):
+        """
+        :param qname: Domain name asking for
+        :return: (locked, max_yes, max_no) where max_yes and max_no are the deepest
+            always_reply and no always_reply parents or None if there is not any.
+        """
+        locked = False
+        max_yes = max_no = None
+        node = self.root
+        labels = split_labels(qname)
+        for depth in range(len(labels) + 1):
+            if depth:
+                node = node.children.get(labels[depth - 1])
+                if node is None:
+                    break
+            if node.lock:
+                locked = True
+            if node.reply:
+                max_yes = depth
+            if node.no_reply:
+                max_no = depth
+        return locked, max_yes, max_no
+
+    def is_locked(self, qname, lock=False):
+        return lock or self.lookup(qname)[0]
+
+    def decision(self, qname, lock=False, always_reply=False):
+        """
+        Same rules than DNSRecord.is_locked and DNSRecord.is_relay
+        :return: LOCKED, RELAY or CACHE
+        """
+        locked, max_yes, max_no = self.lookup(qname)
+        if lock or locked:
+            return LOCKED
+        if not always_reply:
+            return CACHE
+        if max_no is not None and (max_yes is None or max_yes <= max_no):
+            return CACHE
+        return RELAY
+
+
+_policy = PolicyTrie()
+_policy_lock = threading.Lock()
+_refreshing = threading.Event()
+
+
+def rebuild():
+    """
+    :return: If the RootFilter rows changed since the last load
+    """
+    from red_casa.dns.models import RootFilter
+    rows = RootFilter.objects.values_list('pk', 'qname', 'lock', 'always_reply')
+    return _policy.load(rows.iterator())
+
+
+def refresh():
+    """
+    Rebuilds the trie in background, the queries keep using the loaded one until it's swapped.
+    The cached answers are dropped when a row changed, they could be locked now.
+    """
+    from django.db import connection
+    try:
+        if rebuild():
+            dns_cache.clear()
+    except Exception as ex:
+        logger.error("Error refreshing the RootFilter policy: %s" % ex)
+    finally:
+        connection.close()
+        _refreshing.clear()
+
+
+def get_policy():
+    """
+    :return: The process PolicyTrie, loading it from database the first time. When it is
+        older than DNS_POLICY_REFRESH seconds it's refreshed in background (changes made
+        by other processes without the invalidation channel are not notified by the signals)
+    """
+    if not _policy.loaded:
+        with _policy_lock:
+            if not _policy.loaded:
+                rebuild()
+    elif DNS_POLICY_REFRESH and time.time() - _policy.loaded > DNS_POLICY_REFRESH and not _refreshing.is_set():
+        with _policy_lock:
+            if not _refreshing.is_set():
+                _refreshing.set()
+                thread = threading.Thread(target=refresh, name='dns-policy')
+                thread.daemon = True
+                thread.start()
+    return _policy
+
+
+def update(instance):
+    if _policy.loaded:
+        _policy.add(instance.pk, instance.qname, instance.lock, instance.always_reply)
+
+
+def discard(instance):
+    if _policy.loaded:
+        _policy.remove(instance.pk)
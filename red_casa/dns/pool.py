@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.six.moves import queue
+
+import threading
+import logging
+
+logger = logging.getLogger('dns_server')
+
+DNS_WORKERS = 0  # 0 for one thread per query
+if hasattr(settings, 'DNS_WORKERS'):
+    DNS_WORKERS = int(settings.DNS_WORKERS)
+
+DNS_QUEUE_SIZE = 1024
+if hasattr(settings, 'DNS_QUEUE_SIZE'):
+    DNS_QUEUE_SIZE = int(settings.DNS_QUEUE_SIZE)
+
+SHED_SERVFAIL = 'servfail'
+SHED_REFUSED = 'refused'
+SHED_DROP = 'drop'
+SHED_MODES = [SHED_SERVFAIL, SHED_REFUSED, SHED_DROP]
+
+DNS_OVERFLOW = SHED_SERVFAIL
+if hasattr(settings, 'DNS_OVERFLOW'):
+    DNS_OVERFLOW = settings.DNS_OVERFLOW
+
+
+class WorkerPool(object):
+    """
+    Fixed number of threads fed by a bounded queue.
+
+    submit() never blocks, when the queue is full the job is rejected and
+    counted so the caller can shed the load.
+    """
+
+    def __init__(self, workers=DNS_WORKERS, queue_size=DNS_QUEUE_SIZE, name='dns-worker'):
+        self.workers = workers
+        self.name = name
+        self.queue = queue.Queue(queue_size)
+        self.threads = []
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def start(self):
+        for i in range(self.workers - len(self.threads)):
+            thread = threading.Thread(target=self.run, name='%s-%d' % (self.name, len(self.threads)))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args):
+        """
+        :return: False if the queue is full
+        """
+        try:
+            self.queue.put_nowait((func, args))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            func, args = job
+            try:
+                close_old_connections()
+                func(*args)
+            except Exception as ex:
+                self.errors += 1
+                logger.error("Error in %s: %s" % (threading.current_thread().name, ex))
+            self.processed += 1
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stats(self):
+        return {
+            'workers': len(self.threads),
+            'depth': self.depth,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
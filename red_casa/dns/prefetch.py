@@ -0,0 +1,79 @@
+"""
+Refreshes the popular cached answers before they expire
+
+The hits received in the last DNS_PREFETCH_WINDOW part of the TTL of an
+entry are counted, when they reach DNS_PREFETCH_HITS the query is resolved
+again in background so the next clients don't wait for the reply DNS server.
+"""
+from django.conf import settings
+
+from dnslib import DNSQuestion
+import logging
+
+from red_casa.dns.pool import WorkerPool
+
+logger = logging.getLogger('dns_server')
+
+DNS_PREFETCH_HITS = 3  # Hits near the expiration to refresh the entry, 0 for disable it
+if hasattr(settings, 'DNS_PREFETCH_HITS'):
+    DNS_PREFETCH_HITS = int(settings.DNS_PREFETCH_HITS)
+
+DNS_PREFETCH_WINDOW = 0.1  # Last part of the TTL where the hits are counted
+if hasattr(settings, 'DNS_PREFETCH_WINDOW'):
+    DNS_PREFETCH_WINDOW = float(settings.DNS_PREFETCH_WINDOW)
+
+DNS_PREFETCH_WORKERS = 2
+if hasattr(settings, 'DNS_PREFETCH_WORKERS'):
+    DNS_PREFETCH_WORKERS = int(settings.DNS_PREFETCH_WORKERS)
+
+DNS_PREFETCH_QUEUE = 256
+if hasattr(settings, 'DNS_PREFETCH_QUEUE'):
+    DNS_PREFETCH_QUEUE = int(settings.DNS_PREFETCH_QUEUE)
+
+
+class Prefetcher(object):
+    """
+    Hooked in AnswerCache.on_hit, the refresh is done by command.refresh(query, key)
+    """
+
+    def __init__(self, command, hits=DNS_PREFETCH_HITS, window=DNS_PREFETCH_WINDOW):
+        self.command = command
+        self.hits = hits
+        self.window = window
+        self.pool = WorkerPool(DNS_PREFETCH_WORKERS, DNS_PREFETCH_QUEUE, name='dns-prefetch')
+        self.scheduled = 0
+
+    def start(self):
+        self.pool.start()
+        return self
+
+    def hit(self, key, entry, now):
+        if entry.locked or entry.refreshing or entry.expires - now > entry.ttl * self.window:
+            return
+        entry.late_hits += 1
+        if entry.late_hits < self.hits:
+            return
+        entry.refreshing = True
+        try:
+            scheduled = self.pool.submit(self.refresh, key, entry)
+        except Exception as ex:
+            logger.error("Error scheduling the prefetch of %s: %s" % (key[0], ex))
+            scheduled = False
+        if scheduled:
+            self.scheduled += 1
+        else:
+            entry.refreshing = False  # Let a later hit try again
+
+    def refresh(self, key, entry):
+        qname, qtype, qclass = key
+        logger.debug("Prefetching %s" % qname)
+        try:
+            self.command.refresh(DNSQuestion(qname, qtype, qclass), key)
+        finally:
+            entry.refreshing = False  # Replaced by the new entry, or kept when nothing was stored
+            entry.late_hits = 0
+
+    def stats(self):
+        stats = self.pool.stats()
+        stats['scheduled'] = self.scheduled
+        return stats
@@ -0,0 +1,53 @@
+from concurrent.futures import Future
+import threading
+
+
+class SingleFlight(object):
+    """
+    Coalesces the concurrent calls with the same key: the first caller (the
+    leader) does the work and the rest wait for the same result.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.mutex = threading.Lock()
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.calls)
+
+    def begin(self, key):
+        """
+        :return: (future, leader), only the leader must call finish()
+        """
+        with self.mutex:
+            future = self.calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self.calls[key] = Future()
+            return future, True
+
+    def finish(self, key, future, result=None, exception=None):
+        with self.mutex:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func, *args):
+        future, leader = self.begin(key)
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args)
+        except Exception as ex:
+            self.finish(key, future, exception=ex)
+            raise
+        self.finish(key, future, result)
+        return result
+
+
+relay_flight = SingleFlight()  # Relayed queries by (qname, qtype, qclass)
@@ -0,0 +1,174 @@
+"""
+Binary snapshot of the answer caches
+
+The packed answers are dumped with their keys, TTL and expiration time so a
+restarted dns_server (or dns_warmup) starts with a warm cache. The expired
+entries are skipped on load, as the ones locked by the current policy or whose
+DNSRecord changed after the snapshot. The policy is not saved, it's rebuilt
+from the RootFilter table with one query.
+"""
+from django.conf import settings
+
+from dnslib import DNSRecord, RR
+import threading
+import logging
+import struct
+import time
+import os
+
+from red_casa.dns.cache import answer_cache, negative_cache, cache_key
+from red_casa.dns.policy import get_policy, LOCKED as POLICY_LOCKED
+
+logger = logging.getLogger('dns_server')
+
+DNS_SNAPSHOT_FILE = None  # Path of the snapshot, None for disable it
+if hasattr(settings, 'DNS_SNAPSHOT_FILE'):
+    DNS_SNAPSHOT_FILE = settings.DNS_SNAPSHOT_FILE
+
+DNS_SNAPSHOT_INTERVAL = 300  # Seconds between snapshots, 0 for only on shutdown
+if hasattr(settings, 'DNS_SNAPSHOT_INTERVAL'):
+    DNS_SNAPSHOT_INTERVAL = float(settings.DNS_SNAPSHOT_INTERVAL)
+
+MAGIC = b'RCDNS\x00\x01\n'
+ENTRY = struct.Struct('!BHHHIdI')  # Cache, qname size, qtype, qclass, ttl, expires, packed size
+LOCKED = 0xFFFFFFFF  # Packed size of the entries without answer
+BATCH = 500  # Names per query checking the entries, under the SQLite variables limit
+
+CACHES = (answer_cache, negative_cache)
+
+
+def dump(path, caches=CACHES):
+    """
+    Writes the not expired entries to path, atomically replacing it
+    :return: Number of entries written
+    """
+    now = time.time()
+    written = 0
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as snapshot:
+        snapshot.write(MAGIC)
+        for index, cache in enumerate(caches):
+            for (qname, qtype, qclass), entry in cache.items():
+                if entry.expires <= now:
+                    continue
+                name = qname.encode('utf-8')
+                size = LOCKED if entry.locked else len(entry.packed)
+                snapshot.write(ENTRY.pack(index, len(name), qtype, qclass, entry.ttl, entry.expires, size))
+                snapshot.write(name)
+                if not entry.locked:
+                    snapshot.write(entry.packed)
+                written += 1
+    os.rename(tmp_path, path)
+    return written
+
+
+def load(path, caches=CACHES, check=True):
+    """
+    Fills the caches with the not expired entries of the snapshot
+    :param check: Skip the entries no longer valid with the current policy and DNSRecords
+    :return: Number of entries loaded
+    """
+    with open(path, 'rb') as snapshot:
+        data = snapshot.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('%s is not a DNS cache snapshot' % path)
+    now = time.time()
+    entries = []
+    offset = len(MAGIC)
+    while offset < len(data):
+        index, name_size, qtype, qclass, ttl, expires, size = ENTRY.unpack_from(data, offset)
+        offset += ENTRY.size
+        qname = data[offset:offset + name_size].decode('utf-8')
+        offset += name_size
+        packed = None
+        if size != LOCKED:
+            packed = data[offset:offset + size]
+            offset += size
+        if expires > now and index < len(caches):
+            entries.append((index, (qname, qtype, qclass), packed, ttl, expires))
+    records = {}
+    if check:
+        records = stored_records(set(key[0] for index, key, packed, ttl, expires in entries))
+    loaded = 0
+    for index, key, packed, ttl, expires in entries:
+        dbdata = records.get(key)
+        if check and not is_valid(index, key, packed, dbdata):
+            continue
+        caches[index].put(key, packed, ttl, expires, pk=dbdata.pk if dbdata else None)
+        loaded += 1
+    return loaded
+
+
+def stored_records(names):
+    """
+    :return: {cache key: DNSRecord} of the names
+    """
+    from red_casa.dns.models import DNSRecord as DBRecord
+    names = list(names)
+    records = {}
+    for i in range(0, len(names), BATCH):
+        for dbdata in DBRecord.objects.filter(qname__in=names[i:i + BATCH]):
+            records[cache_key(dbdata.qname, dbdata.qtype, dbdata.qclass)] = dbdata
+    return records
+
+
+def answers(rrs):
+    return set((str(rr.rname).lower(), rr.rtype, str(rr.rdata)) for rr in rrs)
+
+
+def is_valid(index, key, packed, dbdata):
+    """
+    The entry is valid if the current policy gives the same decision and the RRs
+    are the ones saved in its DNSRecord, if any. The entries without DNSRecord
+    (random names not saved) only depend on the policy.
+    """
+    if dbdata is None:
+        return packed is None or get_policy().decision(key[0]) != POLICY_LOCKED
+    if (dbdata.policy == POLICY_LOCKED) != (packed is None):
+        return False
+    if packed is None:
+        return True
+    rrs = DNSRecord.parse(packed).rr
+    if index > 0:  # Negative answer, the name had no RRs
+        return not (rrs or dbdata.rrset or dbdata.rdata)
+    if dbdata.rrset:
+        return answers(rrs) == answers(RR.fromZone(dbdata.rrset))
+    if dbdata.rdata:
+        return set(str(rr.rdata) for rr in rrs if rr.rtype == dbdata.qtype) == set([dbdata.rdata])
+    return not rrs
+
+
+class Snapshotter(object):
+    """
+    Dumps the caches every interval seconds in background
+    """
+
+    def __init__(self, path, interval=DNS_SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.interval > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='dns-snapshot')
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.save()
+
+    def save(self):
+        try:
+            written = dump(self.path)
+            logger.debug("Saved %d cached answers in %s" % (written, self.path))
+            return written
+        except (IOError, OSError) as ex:
+            logger.error("Error saving the cache snapshot %s: %s" % (self.path, ex))
+            return 0
+
+    def stop(self):
+        self.stopped.set()
+        return self.save()
@@ -0,0 +1,1032 @@
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from dnslib import DNSRecord, DNSHeader, DNSQuestion, RR, A, NS, SOA, CNAME, EDNS0, QTYPE, RCODE
+from datetime import timedelta
+import threading
+import tempfile
+import shutil
+import socket
+import struct
+import time
+import os
+
+from red_casa.dns.wire import parse_query, name_end, rr_ttls, error_response, HEADER, HEADER_SIZE, TTL, \
+    SERVFAIL, REFUSED
+from red_casa.dns.policy import PolicyTrie, LOCKED, RELAY, CACHE, is_random_name
+from red_casa.dns.cache import CacheEntry, AnswerCache, ENTRY_OVERHEAD, DNS_CACHE_MAX_TTL, DNS_NEGATIVE_MAX_TTL, \
+    cache_key, answer_cache, negative_ttl
+from red_casa.dns.prefetch import Prefetcher
+from red_casa.dns.touch import TouchBuffer
+from red_casa.dns.upstream import UpstreamPool, UpstreamTimeout, parse_upstreams
+from red_casa.dns.singleflight import SingleFlight
+from red_casa.dns.pool import WorkerPool, SHED_SERVFAIL, SHED_REFUSED, SHED_DROP
+from red_casa.dns.management.commands import dns_server
+from red_casa.dns.management.commands.dns_import import normalize, blocklist_names
+from red_casa.dns.management.commands.dns_server import Command, recv_exactly, DNS_STALE_TTL, DNS_STALE_MAX_AGE
+from red_casa.dns import models
+from red_casa.dns import invalidation
+from red_casa.dns import snapshot
+from red_casa.dns.metrics import Metrics
+
+RD = 0x0100
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+
+def answer(qname='example.com', ttl=300, *ips):
+    record = DNSRecord(DNSHeader(qr=1), q=DNSQuestion(qname))
+    for ip in ips or ('10.0.0.1', ):
+        record.add_answer(RR(qname, QTYPE.A, ttl=ttl, rdata=A(ip)))
+    return record.pack()
+
+
+def header(qdcount=1, ancount=0, nscount=0, arcount=0, flags=RD, query_id=0x1234):
+    return HEADER.pack(query_id, flags, qdcount, ancount, nscount, arcount)
+
+
+def name(*labels):
+    return b''.join(struct.pack('!B', len(label)) + label for label in labels) + b'\x00'
+
+
+def question(qname=name(b'Example', b'COM'), qtype=1, qclass=1):
+    return qname + struct.pack('!HH', qtype, qclass)
+
+
+def opt(payload=4096, ttl=0):
+    return b'\x00' + struct.pack('!HHIH', 41, payload, ttl, 0)
+
+
+class ParseQueryTest(SimpleTestCase):
+
+    def test_table(self):
+        end = HEADER_SIZE + len(question())
+        cases = [
+            ('plain query', header() + question(), ('example.com.', 1, 1, end, None)),
+            ('EDNS query', header(arcount=1) + question() + opt(1232), ('example.com.', 1, 1, end, 1232)),
+            ('root name', header() + question(name(), 2), ('.', 2, 1, HEADER_SIZE + 5, None)),
+            ('short header', header()[:HEADER_SIZE - 1], None),
+            ('no question', header(qdcount=0), None),
+            ('two questions', header(qdcount=2) + question() + question(), None),
+            ('answer RR', header(ancount=1) + question(), None),
+            ('authority RR', header(nscount=1) + question(), None),
+            ('two additional RRs', header(arcount=2) + question() + opt() + opt(), None),
+            ('not query opcode', header(flags=0x2800) + question(), None),
+            ('response', header(flags=0x8000) + question(), None),
+            ('truncated label', header() + b'\x07Exam', None),
+            ('name without end', header() + b'\x07Example', None),
+            ('truncated qtype', header() + question()[:-3], None),
+            ('compression pointer', header() + b'\xc0\x0c' + struct.pack('!HH', 1, 1), None),
+            ('invalid label', header() + question(name(b'a b', b'com')), None),
+            ('truncated OPT', header(arcount=1) + question() + opt()[:5], None),
+            ('not OPT additional', header(arcount=1) + question() + b'\x00' + struct.pack('!HHIH', 1, 1, 0, 0),
+             None),
+            ('OPT with owner', header(arcount=1) + question() + b'\x01a' + opt(), None),
+            ('EDNS version 1', header(arcount=1) + question() + opt(ttl=0x00010000), None),
+        ]
+        for description, data, expected in cases:
+            self.assertEqual(parse_query(data), expected, description)
+
+    def test_dnslib_query(self):
+        query = DNSRecord.question('WWW.Example.com', 'AAAA')
+        query.add_ar(EDNS0(udp_len=4096))
+        packed = query.pack()
+        qname, qtype, qclass, end, payload = parse_query(packed)
+        self.assertEqual((qname, qtype, qclass, payload), ('www.example.com.', QTYPE.AAAA, 1, 4096))
+        self.assertEqual(packed[end:end + 3], b'\x00\x00\x29')  # OPT RR follows the question
+
+
+class NameEndTest(SimpleTestCase):
+
+    def test_table(self):
+        cases = [
+            ('root', b'\x00', 0, 1),
+            ('labels', name(b'a', b'bc'), 0, 6),
+            ('offset', b'xx' + name(b'a'), 2, 5),
+            ('pointer', b'\xc0\x0c', 0, 2),
+            ('labels and pointer', b'\x01a\xc0\x0c', 0, 4),
+        ]
+        for description, data, offset, expected in cases:
+            self.assertEqual(name_end(data, offset), expected, description)
+
+    def test_truncated(self):
+        for data in (b'', b'\x01a', b'\x05abc', b'\x01a\x01b'):
+            self.assertRaises(ValueError, name_end, data, 0)
+
+
+class RRTTLsTest(SimpleTestCase):
+
+    def test_sections(self):
+        record = DNSRecord(DNSHeader(qr=1), q=DNSQuestion('example.com'))
+        record.add_answer(RR('example.com', QTYPE.A, ttl=300, rdata=A('10.0.0.1')),
+                          RR('example.com', QTYPE.A, ttl=200, rdata=A('10.0.0.2')))
+        record.add_auth(RR('example.com', QTYPE.NS, ttl=3600, rdata=NS('ns.example.com')))
+        record.add_ar(RR('ns.example.com', QTYPE.A, ttl=60, rdata=A('10.0.0.53')), EDNS0(udp_len=4096))
+        packed = record.pack()
+        ttls = rr_ttls(packed)
+        self.assertEqual([ttl for offset, ttl in ttls], [300, 200, 3600, 60])  # Without the OPT RR
+        for offset, ttl in ttls:
+            self.assertEqual(TTL.unpack_from(packed, offset)[0], ttl)
+
+    def test_negative_answer(self):
+        record = DNSRecord(DNSHeader(qr=1, rcode=3), q=DNSQuestion('nx.example.com'))
+        record.add_auth(RR('example.com', QTYPE.SOA, ttl=900,
+                           rdata=SOA('ns.example.com', 'admin.example.com', (1, 2, 3, 4, 5))))
+        self.assertEqual([ttl for offset, ttl in rr_ttls(record.pack())], [900])
+
+    def test_truncated(self):
+        record = DNSRecord(DNSHeader(qr=1), q=DNSQuestion('example.com'))
+        record.add_answer(RR('example.com', QTYPE.A, ttl=300, rdata=A('10.0.0.1')))
+        packed = record.pack()
+        self.assertRaises((ValueError, struct.error), rr_ttls, packed[:-12])
+        self.assertRaises((ValueError, struct.error), rr_ttls, packed[:HEADER_SIZE + 5])
+
+
+class ErrorResponseTest(SimpleTestCase):
+
+    def test_table(self):
+        cases = [
+            ('query', header() + question(), SERVFAIL, header(flags=0x8182) + question()),
+            ('refused', header() + question(), REFUSED, header(flags=0x8185) + question()),
+            ('only the first question', header(qdcount=2) + question() + question(name(b'b')), SERVFAIL,
+             header(flags=0x8182) + question()),
+            ('additional RRs dropped', header(arcount=1) + question() + opt(), SERVFAIL,
+             header(flags=0x8182) + question()),
+            ('opcode kept', header(flags=0x2900) + question(), SERVFAIL, header(flags=0xA982) + question()),
+            ('no question', header(qdcount=0), SERVFAIL, header(qdcount=0, flags=0x8182)),
+            ('short header', header()[:5], SERVFAIL, None),
+            ('truncated name', header() + b'\x07Exam', SERVFAIL, None),
+            ('truncated qtype', header() + question()[:-2], SERVFAIL, None),
+        ]
+        for description, data, rcode, expected in cases:
+            self.assertEqual(error_response(data, rcode), expected, description)
+
+    def test_dnslib_parses_it(self):
+        query = DNSRecord.question('example.com', 'MX')
+        answer = DNSRecord.parse(error_response(query.pack()))
+        self.assertEqual(answer.header.id, query.header.id)
+        self.assertEqual(answer.header.rcode, SERVFAIL)
+        self.assertEqual(answer.q, query.q)
+
+
+class PolicyTrieTest(SimpleTestCase):
+    ROWS = [  # pk, qname, lock, always_reply
+        (1, 'ads.example', True, False),
+        (2, 'example', False, False),
+        (3, 'cdn.example', False, True),
+        (4, 'static.cdn.example', False, False),
+        (5, 'Tracker.NET.', True, False),
+        (6, 'same.test', False, True),
+        (7, 'same.test', False, False),
+    ]
+
+    def setUp(self):
+        self.trie = PolicyTrie()
+        self.trie.load(self.ROWS)
+
+    def test_decision(self):
+        cases = [  # qname, lock, always_reply, decision
+            ('www.ads.example.', False, False, LOCKED),
+            ('ads.example', False, True, LOCKED),
+            ('ADS.Example.', False, False, LOCKED),
+            ('bads.example', False, True, CACHE),  # Only the example no always_reply parent
+            ('x.cdn.example', False, True, RELAY),  # cdn.example is deeper than example
+            ('a.static.cdn.example', False, True, CACHE),
+            ('cdn.example', False, False, CACHE),  # The DNSRecord is not always_reply
+            ('x.same.test', False, True, CACHE),  # Both at the same depth
+            ('other.org', False, True, RELAY),
+            ('other.org', True, False, LOCKED),
+            ('x.tracker.net', False, True, LOCKED),
+            ('net', False, True, RELAY),  # The lock of tracker.net is not inherited by its parent
+            ('.', False, True, RELAY),
+        ]
+        for qname, lock, always_reply, decision in cases:
+            self.assertEqual(self.trie.decision(qname, lock, always_reply), decision,
+                             '%s lock=%s always_reply=%s' % (qname, lock, always_reply))
+
+    def test_lookup(self):
+        self.assertEqual(self.trie.lookup('a.static.cdn.example'), (False, 2, 3))
+        self.assertEqual(self.trie.lookup('www.ads.example'), (True, None, 2))
+        self.assertEqual(self.trie.lookup('other.org'), (False, None, None))
+
+    def test_add_and_remove(self):
+        self.trie.remove(1)
+        self.assertEqual(self.trie.decision('www.ads.example', always_reply=True), CACHE)
+        self.assertNotIn('ads', self.trie.root.children['example'].children)  # Empty branch pruned
+        self.trie.add(3, 'cdn.example', lock=True)  # Changed row
+        self.assertEqual(self.trie.decision('x.cdn.example'), LOCKED)
+        self.trie.add(3, 'cdn.other', always_reply=True)  # Moved row
+        self.assertEqual(self.trie.decision('x.cdn.example', always_reply=True), CACHE)
+        self.assertEqual(self.trie.decision('x.cdn.other', always_reply=True), RELAY)
+        self.trie.remove(99)  # Unknown rows are ignored
+        self.assertEqual(len(self.trie), len(self.ROWS) - 1)
+
+    def test_remove_shared_node(self):
+        self.trie.remove(6)
+        self.assertEqual(self.trie.decision('x.same.test', always_reply=True), CACHE)
+        self.trie.remove(7)
+        self.assertEqual(self.trie.decision('x.same.test', always_reply=True), RELAY)
+        self.assertNotIn('test', self.trie.root.children)
+
+    def test_load_changed(self):
+        self.assertFalse(self.trie.load(self.ROWS))
+        self.assertTrue(self.trie.load(self.ROWS[1:]))
+        self.assertEqual(self.trie.decision('www.ads.example'), CACHE)
+        self.assertTrue(self.trie.load([]))
+        self.assertEqual(len(self.trie), 0)
+        self.assertTrue(self.trie.root.is_empty())
+
+
+class PrefetcherTest(SimpleTestCase):
+
+    class Command(object):
+        def __init__(self, error=None):
+            self.error = error
+            self.refreshed = []
+
+        def refresh(self, query, key):
+            self.refreshed.append(key)
+            if self.error:
+                raise self.error
+
+    def entry(self):
+        return CacheEntry(DNSRecord.question('example.com').reply().pack(), 100, 1000.0)
+
+    def test_hit(self):
+        prefetcher = Prefetcher(self.Command(), hits=2, window=0.1)
+        entry = self.entry()
+        cases = [  # description, now, late_hits, refreshing
+            ('far from the expiration', 800.0, 0, False),
+            ('first late hit', 995.0, 1, False),
+            ('second late hit', 995.0, 2, True),
+            ('already refreshing', 995.0, 2, True),
+        ]
+        for description, now, late_hits, refreshing in cases:
+            prefetcher.hit(('example.com.', 1, 1), entry, now)
+            self.assertEqual((entry.late_hits, entry.refreshing), (late_hits, refreshing), description)
+        self.assertEqual(prefetcher.scheduled, 1)
+
+    def test_refresh_resets_the_entry(self):
+        cases = [
+            ('nothing stored', None),
+            ('error', ValueError('upstream')),
+        ]
+        for description, error in cases:
+            prefetcher = Prefetcher(self.Command(error))
+            entry = self.entry()
+            entry.refreshing, entry.late_hits = True, 3
+            try:
+                prefetcher.refresh(('example.com.', 1, 1), entry)
+            except ValueError:
+                pass
+            self.assertEqual((entry.refreshing, entry.late_hits), (False, 0), description)
+
+
+class TouchBufferTest(TestCase):
+
+    def records(self, count):
+        models.DNSRecord.objects.bulk_create(models.DNSRecord(qname='r%d.example.com.' % i, qtype=1, qclass=1)
+                                             for i in range(count))
+        return list(models.DNSRecord.objects.values_list('pk', flat=True))
+
+    def test_flush_batches(self):
+        when = timezone.now() + timedelta(days=1)
+        cases = [  # description, records, batch
+            ('batch of 2', 5, 2),
+            ('over the SQLite variables limit', 1001, 500),  # 333 records per UPDATE on SQLite
+        ]
+        for description, count, batch in cases:
+            models.DNSRecord.objects.all().delete()
+            buffer = TouchBuffer(interval=1, max_pending=count + 1, batch=batch)
+            for pk in self.records(count):
+                buffer.touch(pk, when)
+            self.assertEqual(len(buffer), count, description)
+            self.assertEqual(buffer.flush(), count, description)
+            self.assertEqual(models.DNSRecord.objects.filter(last_query=when).count(), count, description)
+            self.assertEqual(len(buffer), 0, description)
+
+    def test_max_pending(self):
+        when = timezone.now() + timedelta(days=1)
+        buffer = TouchBuffer(interval=1, max_pending=3)
+        pks = self.records(3)
+        for pk in pks[:2]:
+            buffer.touch(pk, when)
+        self.assertEqual(models.DNSRecord.objects.filter(last_query=when).count(), 0)
+        buffer.touch(pks[2], when)  # Flushed by the caller
+        self.assertEqual(models.DNSRecord.objects.filter(last_query=when).count(), 3)
+        self.assertEqual(buffer.flushed, 3)
+
+    def test_executor(self):
+        class Executor(object):
+            jobs = []
+
+            def submit(self, func, *args):
+                self.jobs.append((func, args))
+
+        when = timezone.now() + timedelta(days=1)
+        buffer = TouchBuffer(interval=1, max_pending=2)
+        buffer.executor = Executor()
+        pks = self.records(4)
+        for pk in pks:
+            buffer.touch(pk, when)
+        self.assertEqual(len(buffer.executor.jobs), 1)  # Only one flush scheduled while the records wait
+        self.assertEqual(models.DNSRecord.objects.filter(last_query=when).count(), 0)
+        func, args = buffer.executor.jobs.pop()
+        func(*args)
+        self.assertEqual(models.DNSRecord.objects.filter(last_query=when).count(), 4)
+        buffer.touch(pks[0], when)
+        buffer.touch(pks[1], when)
+        self.assertEqual(len(buffer.executor.jobs), 1)
+
+
+class ImportZoneTest(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.zone')
+        with os.fdopen(fd, 'w') as zone:
+            zone.write('$ORIGIN example.com.\n')
+            for i in range(1001):  # More names than a qname__in lookup takes
+                zone.write('h%d 300 IN A 10.0.%d.%d\n' % (i, i // 256, i % 256))
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_import_and_update(self):
+        cases = [
+            ('new zone', '1001 records added, 0 updated'),
+            ('same zone', '0 records added, 1001 updated'),
+        ]
+        for description, summary in cases:
+            output = StringIO()
+            call_command('dns_import', zones=[self.path], batch_size=5000, stdout=output)
+            self.assertIn(summary, output.getvalue(), description)
+        self.assertEqual(models.DNSRecord.objects.count(), 1001)
+        self.assertEqual(models.DNSRecord.objects.get(qname='h1000.example.com.').rdata, '10.0.3.232')
+
+
+class ParseUpstreamsTest(SimpleTestCase):
+
+    def test_table(self):
+        cases = [
+            ('IPv4', '8.8.8.8', [('8.8.8.8', 53)]),
+            ('IPv4 and port', '8.8.8.8:5353', [('8.8.8.8', 5353)]),
+            ('list', ' 8.8.8.8, 1.1.1.1:54 ,', [('8.8.8.8', 53), ('1.1.1.1', 54)]),
+            ('bare IPv6', '2001:db8::1', [('2001:db8::1', 53)]),
+            ('bracketed IPv6', '[2001:db8::1]', [('2001:db8::1', 53)]),
+            ('bracketed IPv6 and port', '[::1]:5353', [('::1', 5353)]),
+            ('list of tuples', ['[::1]:53', '127.0.0.1'], [('::1', 53), ('127.0.0.1', 53)]),
+        ]
+        for description, value, expected in cases:
+            self.assertEqual(parse_upstreams(value), expected, description)
+
+    def test_invalid(self):
+        for value in ('[::1', '[]:53', '[::1]53', '[::1]:', '[::1]:dns', '8.8.8.8:0', '8.8.8.8:70000'):
+            self.assertRaises(ValueError, parse_upstreams, value)
+
+
+class AnswerCacheTest(SimpleTestCase):
+    KEY = ('example.com.', 1, 1)
+
+    def test_get_and_expire(self):
+        cache = AnswerCache()
+        now = time.time()
+        cases = [  # description, ttl, expires, found
+            ('fresh', 300, None, True),
+            ('expired', 300, now - 1, False),
+            ('zero TTL', 0, None, False),
+        ]
+        for description, ttl, expires, found in cases:
+            cache.clear()
+            cache.put(self.KEY, answer(), ttl, expires)
+            self.assertEqual(cache.get(self.KEY) is not None, found, description)
+            self.assertEqual(self.KEY in cache, found, description)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(cache.size, 0)
+
+    def test_max_ttl(self):
+        entry = AnswerCache().put(self.KEY, answer(), DNS_CACHE_MAX_TTL * 2)
+        self.assertEqual(entry.ttl, DNS_CACHE_MAX_TTL)
+
+    def test_lru_eviction(self):
+        packed = answer()
+        cache = AnswerCache(max_size=3 * (ENTRY_OVERHEAD + len(packed)))
+        keys = [('%s.example.com.' % name, 1, 1) for name in 'abcd']
+        for key in keys[:3]:
+            cache.put(key, packed, 300)
+        cache.get(keys[0])  # Most recently used now
+        cache.put(keys[3], packed, 300)
+        self.assertEqual([key in cache for key in keys], [True, False, True, True])
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.size, 3 * (ENTRY_OVERHEAD + len(packed)))
+        self.assertIsNone(AnswerCache(max_size=ENTRY_OVERHEAD).put(keys[0], packed, 300))  # Bigger than the cache
+
+    def test_replace_and_invalidate(self):
+        cache = AnswerCache()
+        cache.put(self.KEY, answer(), 300)
+        cache.put(self.KEY, None, 300)  # Locked now
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(cache.get(self.KEY).locked)
+        self.assertEqual(cache.size, ENTRY_OVERHEAD)
+        cache.invalidate(self.KEY)
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_on_hit(self):
+        cache = AnswerCache()
+        hits = []
+        cache.on_hit = lambda key, entry, now: hits.append((key, entry.hits))
+        cache.put(self.KEY, answer(), 300)
+        cache.get(self.KEY)
+        cache.get(('other.com.', 1, 1))
+        self.assertEqual(hits, [(self.KEY, 1)])
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key('WWW.Example.COM.', QTYPE.A, 1), ('www.example.com.', 1, 1))
+
+
+class AnswerCacheInvalidationTest(TestCase):
+
+    def test_saved_record(self):
+        key = cache_key('example.com.', QTYPE.A, 1)
+        record = models.DNSRecord.objects.create(qname='example.com.', qtype=QTYPE.A, qclass=1)
+        answer_cache.put(key, answer(), 300)
+        record.rdata = '10.0.0.2'
+        record.save()
+        self.assertNotIn(key, answer_cache)
+
+
+class WorkerPoolTest(SimpleTestCase):
+
+    def test_full_queue(self):
+        pool = WorkerPool(workers=1, queue_size=2)
+        done = []
+        self.assertEqual([pool.submit(done.append, i) for i in range(3)], [True, True, False])
+        self.assertEqual((pool.depth, pool.dropped), (2, 1))
+        pool.start()
+        pool.stop()
+        self.assertEqual(done, [0, 1])
+        self.assertEqual(pool.stats()['processed'], 2)
+
+    def test_errors(self):
+        pool = WorkerPool(workers=1, queue_size=2)
+        pool.submit(int, 'not a number')
+        pool.start()
+        pool.stop()
+        self.assertEqual((pool.errors, pool.processed), (1, 1))
+
+    def test_shedding(self):
+        query = DNSRecord.question('example.com')
+        addr = ('127.0.0.1', 5300)
+        cases = [  # overflow, rcode of the answer or None if it's dropped
+            (SHED_SERVFAIL, SERVFAIL),
+            (SHED_REFUSED, REFUSED),
+            (SHED_DROP, None),
+        ]
+        for overflow, rcode in cases:
+            command = Command()
+            command.overflow = overflow
+            command.pool = WorkerPool(workers=1, queue_size=1)  # Not started, the queue gets full
+            sock = FakeSocket()
+            command.dispatch_udp(sock, query.pack(), addr, True)
+            command.dispatch_udp(sock, query.pack(), addr, True)
+            self.assertEqual(command.pool.depth, 1, overflow)
+            if rcode is None:
+                self.assertEqual(sock.sent, [], overflow)
+            else:
+                self.assertEqual(len(sock.sent), 1, overflow)
+                shed, to = sock.sent[0]
+                self.assertEqual(to, addr, overflow)
+                shed = DNSRecord.parse(shed)
+                self.assertEqual((shed.header.id, shed.header.rcode, shed.q), (query.header.id, rcode, query.q),
+                                 overflow)
+
+
+class TCPFramingTest(SimpleTestCase):
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        answer_cache.clear()
+
+    def test_recv_exactly(self):
+        self.client.sendall(b'\x00\x05ab')
+        self.client.sendall(b'cde\x00')
+        self.assertEqual(recv_exactly(self.server, 2), b'\x00\x05')
+        self.assertEqual(recv_exactly(self.server, 5), b'abcde')
+        self.client.close()
+        self.assertIsNone(recv_exactly(self.server, 2))  # Closed before the second byte
+
+    def test_pipelined_queries(self):
+        queries = [DNSRecord.question(qname) for qname in ('example.com', 'Example.ORG', 'example.com')]
+        for qname in ('example.com.', 'example.org.'):
+            answer_cache.put(cache_key(qname, QTYPE.A, 1), answer(qname), 300)
+        data = b''.join(struct.pack('!H', len(query.pack())) + query.pack() for query in queries)
+        thread = threading.Thread(target=Command().response_tcp, args=(self.server, ('127.0.0.1', 5300)))
+        thread.start()
+        self.client.sendall(data[:3])  # The length prefix split between segments
+        time.sleep(0.01)
+        self.client.sendall(data[3:])
+        for query in queries:
+            size = struct.unpack('!H', recv_exactly(self.client, 2))[0]
+            reply = DNSRecord.parse(recv_exactly(self.client, size))
+            self.assertEqual((reply.header.id, reply.q.qname, len(reply.rr)), (query.header.id, query.q.qname, 1))
+        self.client.shutdown(socket.SHUT_WR)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.client.recv(1), b'')  # Closed by the server
+
+
+def serve_answers(sock):
+    """
+    Answers every query received in sock with one A record until it's closed
+    """
+    while True:
+        try:
+            data, addr = sock.recvfrom(512)
+        except socket.error:
+            return
+        query = DNSRecord.parse(data)
+        reply = query.reply()
+        reply.add_answer(RR(query.q.qname, QTYPE.A, ttl=300, rdata=A('10.0.0.1')))
+        sock.sendto(reply.pack(), addr)
+
+
+class UpstreamPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        self.silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Receives and never answers
+        self.silent.bind(('127.0.0.1', 0))
+        self.answering = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.answering.bind(('127.0.0.1', 0))
+        thread = threading.Thread(target=serve_answers, args=(self.answering, ))
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.silent.close()
+        self.answering.close()
+
+    def servers(self, *sockets):
+        return ','.join('%s:%d' % sock.getsockname() for sock in sockets)
+
+    def test_hedged_failover(self):
+        pool = UpstreamPool(self.servers(self.silent, self.answering), timeout=2, hedge=0.05).start()
+        pool.upstreams[1].srtt = 1  # The silent upstream is ranked first
+        query = DNSRecord.question('example.com')
+        started = time.time()
+        reply = DNSRecord.parse(pool.query(query.pack()))
+        self.assertGreaterEqual(time.time() - started, 0.05)
+        self.assertEqual((reply.header.id, reply.q, len(reply.rr)), (query.header.id, query.q, 1))
+        self.silent.settimeout(1)
+        self.assertEqual(self.silent.recv(512)[2:], query.pack()[2:])  # Asked first, only the ID changes
+        stats = pool.stats()
+        self.assertEqual([(stat['sent'], stat['answered']) for stat in stats], [(1, 0), (1, 1)])
+
+    def test_ranking(self):
+        pool = UpstreamPool(self.servers(self.silent, self.answering), timeout=2, hedge=0.05)
+        now = time.time()
+        cases = [  # description, srtt of each upstream, failed_at of the first one, expected first
+            ('Fastest first', (0.01, 0.02), 0, 0),
+            ('Slowest last', (0.02, 0.01), 0, 1),
+            ('Recently failed last', (0.01, 0.02), now, 1),
+            ('Failed long ago trusted again', (0.01, 0.02), now - 3600, 0),
+        ]
+        for description, srtts, failed_at, expected in cases:
+            for upstream, srtt in zip(pool.upstreams, srtts):
+                upstream.srtt = srtt
+            pool.upstreams[0].failed_at = failed_at
+            self.assertIs(pool.ranked()[0], pool.upstreams[expected], description)
+
+    def test_timeout_servfail(self):
+        pool = UpstreamPool(self.servers(self.silent), timeout=0.1).start()
+        query = DNSRecord.question('example.com')
+        self.assertRaises(UpstreamTimeout, pool.query, query.pack())
+        self.assertEqual(pool.stats()[0]['timeouts'], 1)
+        self.assertTrue(pool.upstreams[0].failed_at)
+        emitter = query.reply()
+        Command.servfail(emitter, UpstreamTimeout('No answer'))
+        self.assertEqual(emitter.header.rcode, RCODE.SERVFAIL)
+
+
+class SingleFlightTest(SimpleTestCase):
+
+    def test_coalescing(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def work(key):
+            calls.append(key)
+            release.wait(5)
+            return key.upper()
+
+        results = []
+        threads = [threading.Thread(target=lambda key: results.append(flight.do(key, work, key)), args=(key, ))
+                   for key in ('a', 'a', 'a', 'b')]
+        threads[0].start()
+        while not calls:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        while flight.coalesced < 2 or len(calls) < 2:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(sorted(calls), ['a', 'b'])
+        self.assertEqual(sorted(results), ['A', 'A', 'A', 'B'])
+        self.assertEqual((flight.coalesced, len(flight)), (2, 0))
+
+    def test_exception(self):
+        flight = SingleFlight()
+        future, leader = flight.begin('key')
+        waiter, follower = flight.begin('key')
+        self.assertEqual((waiter is future, leader, follower), (True, True, False))
+        flight.finish('key', future, exception=UpstreamTimeout('No answer'))
+        self.assertRaises(UpstreamTimeout, waiter.result)
+        self.assertEqual(len(flight), 0)
+        self.assertRaises(ValueError, flight.do, 'key', int, 'not a number')  # The leader gets its error too
+        self.assertEqual(len(flight), 0)
+
+
+class StoreRRsetTest(TestCase):
+
+    def test_round_trip(self):
+        query = DNSQuestion('www.example.com.')
+        record = DNSRecord(DNSHeader(qr=1), q=query)
+        record.add_answer(RR('www.example.com.', QTYPE.CNAME, ttl=600, rdata=CNAME('web.example.com.')),
+                          RR('web.example.com.', QTYPE.A, ttl=120, rdata=A('10.0.0.1')),
+                          RR('web.example.com.', QTYPE.A, ttl=120, rdata=A('10.0.0.2')))
+        record.add_ar(RR('ns.example.com.', QTYPE.A, ttl=300, rdata=A('10.0.0.53')))
+        dbdata = models.DNSRecord.objects.create(qname='www.example.com.', qtype=QTYPE.A, qclass=1)
+        Command.store_rrset(dbdata, record, 120)
+
+        dbdata = models.DNSRecord.objects.get(pk=dbdata.pk)
+        self.assertEqual(dbdata.rdata, '10.0.0.1')  # First RR of the queried type
+        self.assertAlmostEqual((dbdata.expires - timezone.now()).total_seconds(), 120, delta=5)
+        stored = DNSRecord(DNSHeader(qr=1), q=query)
+        self.assertEqual(Command.stored_answers(query, dbdata, stored, 300), 120)
+        self.assertEqual([(rr.rname, rr.rtype, rr.ttl, str(rr.rdata)) for rr in stored.rr + stored.ar],
+                         [(rr.rname, rr.rtype, rr.ttl, str(rr.rdata)) for rr in record.rr + record.ar])
+
+    def test_without_additional(self):
+        query = DNSQuestion('example.com.')
+        dbdata = models.DNSRecord.objects.create(qname='example.com.', qtype=QTYPE.A, qclass=1,
+                                                 additional='stale')
+        Command.store_rrset(dbdata, DNSRecord.parse(answer('example.com.', 60)), 60)
+        dbdata = models.DNSRecord.objects.get(pk=dbdata.pk)
+        self.assertEqual((dbdata.rdata, dbdata.additional), ('10.0.0.1', None))
+        stored = DNSRecord(DNSHeader(qr=1), q=query)
+        self.assertEqual(Command.stored_answers(query, dbdata, stored, 300), 60)
+        self.assertEqual((len(stored.rr), len(stored.ar)), (1, 0))
+
+
+class WireAnswerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = AnswerCache()
+        self.cache.put(cache_key('example.com.', QTYPE.A, 1), answer('example.com.', 300, '10.0.0.1', '10.0.0.2'),
+                       300, expires=time.time() + 290)  # Cached 10 seconds ago
+        self.cache.put(cache_key('locked.example.com.', QTYPE.A, 1), None, 300)
+        big = answer('big.example.com.', 300, *['10.0.0.%d' % i for i in range(40)])  # Over 512 bytes
+        self.cache.put(cache_key('big.example.com.', QTYPE.A, 1), big, 300)
+
+    def test_patching(self):
+        cases = [  # description, query, EDNS echoed
+            ('Plain', header(query_id=0xBEEF) + question(), False),
+            ('EDNS', header(arcount=1, query_id=0x0102) + question() + opt(), True),
+        ]
+        for description, raw_query, edns in cases:
+            found, packed = self.cache.wire_answer(raw_query)
+            self.assertTrue(found, description)
+            reply = DNSRecord.parse(packed)
+            self.assertEqual(reply.header.id, HEADER.unpack_from(raw_query)[0], description)
+            self.assertEqual((reply.header.qr, reply.header.aa, reply.header.rd, reply.header.ra), (1, 1, 1, 1),
+                             description)
+            self.assertEqual(str(reply.q.qname), 'Example.COM.', description)  # Case of the query
+            self.assertEqual([str(rr.rdata) for rr in reply.rr], ['10.0.0.1', '10.0.0.2'], description)
+            for rr in reply.rr:
+                self.assertTrue(288 <= rr.ttl <= 290, description)
+            self.assertEqual([rr.rtype for rr in reply.ar], [QTYPE.OPT] if edns else [], description)
+
+    def test_not_answered(self):
+        cases = [  # description, query, expected
+            ('Locked', header() + question(name(b'locked', b'example', b'com')), (True, None)),
+            ('Not cached', header() + question(name(b'other', b'com')), (False, None)),
+            ('Other type', header() + question(qtype=QTYPE.AAAA), (False, None)),
+            ('Malformed', header() + b'\x07example', (False, None)),
+            ('Bigger than the UDP payload', header() + question(name(b'big', b'example', b'com')), (False, None)),
+        ]
+        for description, raw_query, expected in cases:
+            self.assertEqual(self.cache.wire_answer(raw_query, udp=True), expected, description)
+        found, packed = self.cache.wire_answer(header() + question(name(b'big', b'example', b'com')))
+        self.assertEqual(len(DNSRecord.parse(packed).rr), 40)  # Whole over TCP
+
+
+class InvalidationTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'run', 'dns.sock')
+        self.key = cache_key('example.com.', QTYPE.A, 1)
+        answer_cache.put(self.key, answer('example.com.'), 300)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        answer_cache.clear()
+
+    def wait(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.005)
+        return condition()
+
+    def test_apply(self):
+        cases = [  # description, message, key still cached
+            ('Other record', 'record\tother.example.com.\t1\t1', True),
+            ('Unknown', 'unknown', True),
+            ('Record', 'record\tExample.COM.\t1\t1', False),
+        ]
+        for description, message, cached in cases:
+            invalidation.apply(message.encode('utf-8'))
+            self.assertEqual(self.key in answer_cache, cached, description)
+        answer_cache.put(self.key, answer('example.com.'), 300)
+        invalidation.apply(invalidation.ROOT_FILTER.encode('utf-8'))
+        self.assertEqual(len(answer_cache), 0)
+
+    def test_publish_and_forward(self):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock = invalidation.listen(followers=[parent], local=True, path=self.path, group=None)
+        self.assertIsNotNone(sock)
+        self.assertEqual(os.stat(os.path.dirname(self.path)).st_mode & 0o777, 0o750)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o660)
+        published = invalidation.DNS_INVALIDATION_SOCKET
+        invalidation.DNS_INVALIDATION_SOCKET = self.path
+        try:
+            invalidation.publish(invalidation.RECORD, 'example.com.', QTYPE.A, 1)
+        finally:
+            invalidation.DNS_INVALIDATION_SOCKET = published
+        child.settimeout(5)
+        self.assertEqual(child.recv(4096), b'record\texample.com.\t1\t1')  # Forwarded to the workers
+        self.assertTrue(self.wait(lambda: self.key not in answer_cache))
+        for closed in (sock, parent, child):
+            closed.close()
+
+    def test_world_writable(self):
+        os.chmod(self.dir, 0o777)
+        self.assertIsNone(invalidation.listen(path=os.path.join(self.dir, 'dns.sock'), group=None))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'dns.sock')))
+
+
+class PackUDPTest(SimpleTestCase):
+
+    def setUp(self):
+        self.emitter = DNSRecord.question('www.example.com').reply()
+        self.cname = RR('www.example.com.', QTYPE.CNAME, ttl=300, rdata=CNAME('web.example.com.'))
+        self.emitter.add_answer(self.cname, *[RR('web.example.com.', QTYPE.A, ttl=300, rdata=A('10.0.0.%d' % i))
+                                              for i in range(20)])
+        self.emitter.add_auth(*[RR('example.com.', QTYPE.NS, ttl=300, rdata=NS('ns%d.example.com.' % i))
+                                for i in range(2)])
+        self.emitter.add_ar(*[RR('ns%d.example.com.' % i, QTYPE.A, ttl=300, rdata=A('10.0.1.%d' % i))
+                              for i in range(2)])
+        self.emitter.add_ar(EDNS0(udp_len=1232))
+
+    def size(self, rr, auth, ar):
+        return len(DNSRecord(self.emitter.header, questions=self.emitter.questions, rr=rr, auth=auth, ar=ar).pack())
+
+    def test_trimming(self):
+        opt = self.emitter.ar[-1:]
+        cases = [  # description, max size, TC, answer RRs, authority RRs, additional RRs
+            ('Fits', len(self.emitter.pack()), 0, 21, 2, 3),
+            ('Without additional', self.size(self.emitter.rr, self.emitter.auth, opt), 0, 21, 2, 1),
+            ('Without authority', self.size(self.emitter.rr, [], opt), 1, 21, 0, 1),
+            ('Whole RRset dropped', self.size(self.emitter.rr, [], opt) - 1, 1, 1, 0, 1),
+            ('Only the question', self.size([self.cname], [], opt) - 1, 1, 0, 0, 1),
+        ]
+        for description, max_size, tc, answers, authority, additional in cases:
+            packed = Command().pack_udp(self.emitter, max_size)
+            self.assertLessEqual(len(packed), max_size, description)
+            reply = DNSRecord.parse(packed)
+            self.assertEqual((reply.header.id, reply.q), (self.emitter.header.id, self.emitter.q), description)
+            self.assertEqual((reply.header.tc, len(reply.rr), len(reply.auth), len(reply.ar)),
+                             (tc, answers, authority, additional), description)
+            if additional == 1:
+                self.assertEqual(reply.ar[0].rtype, QTYPE.OPT, description)
+        self.assertEqual(len(self.emitter.rr + self.emitter.auth + self.emitter.ar), 26)  # Not modified
+
+
+class NegativeAnswerTest(SimpleTestCase):
+
+    def test_negative_ttl(self):
+        cases = [  # description, (SOA TTL, MINIMUM) of the authority RRs, expected
+            ('No SOA', [], None),
+            ('MINIMUM lower', [(3600, 60)], 60),
+            ('SOA TTL lower', [(30, 300)], 30),
+            ('Lowest SOA', [(600, 600), (120, 600)], 120),
+            ('Capped', [(86400, 86400)], DNS_NEGATIVE_MAX_TTL),
+        ]
+        for description, soas, expected in cases:
+            record = DNSRecord.question('nx.example.com').reply()
+            for ttl, minimum in soas:
+                record.add_auth(RR('example.com.', QTYPE.SOA, ttl=ttl,
+                                   rdata=SOA('ns.example.com.', 'admin.example.com.', (1, 3600, 600, 86400, minimum))))
+            self.assertEqual(negative_ttl(record), expected, description)
+
+    def test_is_random_name(self):
+        cases = [  # description, qname, expected
+            ('Short labels', 'www.example.com', False),
+            ('Long words', 'cdn-static-images.example.com', False),
+            ('Only digits', '1234567890123456.example.com', False),
+            ('High entropy', 'xkqzjvwpmbnlrtyh.tracker.net', True),
+            ('Letters and digits', 'abab1212abab1212.example.com', True),
+            ('Random label deeper', 'sub.abcdefghijklmnop.example.com', True),
+            ('Registered domain not checked', 'mail.x9k2m4p7q1z8.com', False),
+        ]
+        for description, qname, expected in cases:
+            self.assertEqual(is_random_name(qname), expected, description)
+
+
+class StaleAnswerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.query = DNSQuestion('example.com.')
+        self.key = cache_key('example.com.', QTYPE.A, 1)
+        self.deadline = dns_server.DNS_STALE_DEADLINE
+        dns_server.DNS_STALE_DEADLINE = 0.05
+
+    def tearDown(self):
+        dns_server.DNS_STALE_DEADLINE = self.deadline
+        answer_cache.clear()
+
+    def dbdata(self, expired, rrset=True):
+        dbdata = models.DNSRecord(qname='example.com.', qtype=QTYPE.A, qclass=1,
+                                  expires=timezone.now() - timedelta(seconds=expired))
+        if rrset:
+            dbdata.rrset = DNSRecord.parse(answer('example.com.', 300)).rr[0].toZone()
+        return dbdata
+
+    def test_stale_answers(self):
+        cases = [  # description, dbdata, answered
+            ('Just expired', self.dbdata(60), True),
+            ('Almost too old', self.dbdata(DNS_STALE_MAX_AGE - 60), True),
+            ('Too old', self.dbdata(DNS_STALE_MAX_AGE + 60), False),
+            ('Without RRs', self.dbdata(60, rrset=False), False),
+        ]
+        for description, dbdata, answered in cases:
+            answer_cache.clear()
+            record = Command().stale_answers(self.query, self.key, dbdata)
+            self.assertEqual(record is not None, answered, description)
+            self.assertEqual(self.key in answer_cache, answered, description)
+            if answered:
+                self.assertEqual([(str(rr.rdata), rr.ttl) for rr in record.rr], [('10.0.0.1', DNS_STALE_TTL)],
+                                 description)
+                self.assertEqual(answer_cache.get(self.key).ttl, DNS_STALE_TTL, description)
+
+    def test_deadline(self):
+        future, leader = dns_server.relay_flight.begin(self.key)  # A slow relay already asking
+        try:
+            started = time.time()
+            record, stale = Command().relay_or_stale(self.query, self.key, self.dbdata(60))
+            self.assertGreaterEqual(time.time() - started, 0.05)
+            self.assertEqual((stale, str(record.rr[0].rdata)), (True, '10.0.0.1'))
+        finally:
+            dns_server.relay_flight.finish(self.key, future, 'fresh')
+        future, leader = dns_server.relay_flight.begin(self.key)
+        threading.Timer(0.01, dns_server.relay_flight.finish, args=(self.key, future, 'fresh')).start()
+        self.assertEqual(Command().relay_or_stale(self.query, self.key, self.dbdata(60)), ('fresh', False))
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(fd)
+        self.caches = (AnswerCache(), AnswerCache())
+        now = time.time()
+        for qname, ttl, expires in (('example.com.', 300, now + 200), ('changed.example.com.', 300, now + 200),
+                                    ('expiring.example.com.', 1, now + 0.05)):
+            self.caches[0].put(cache_key(qname, QTYPE.A, 1), answer(qname, ttl), ttl, expires)
+        self.caches[0].put(cache_key('locked.example.com.', QTYPE.A, 1), None, 300)
+        negative = DNSRecord.question('nx.example.com').reply()
+        self.caches[1].put(cache_key('nx.example.com.', QTYPE.A, 1), negative.pack(), 60)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_dump_and_load(self):
+        self.assertEqual(snapshot.dump(self.path, self.caches), 5)
+        time.sleep(0.1)  # expiring.example.com. is expired when loaded
+        caches = (AnswerCache(), AnswerCache())
+        self.assertEqual(snapshot.load(self.path, caches, check=False), 4)
+        self.assertEqual(sorted(key[0] for key, entry in caches[0].items()),
+                         ['changed.example.com.', 'example.com.', 'locked.example.com.'])
+        self.assertEqual([key[0] for key, entry in caches[1].items()], ['nx.example.com.'])
+        for key, entry in caches[0].items():
+            original = self.caches[0].get(key)
+            self.assertEqual((entry.packed, entry.ttl, entry.expires),
+                             (original.packed, original.ttl, original.expires), key[0])
+
+    def test_check(self):
+        stored = DNSRecord.parse(answer('example.com.', 300))
+        models.DNSRecord.objects.create(qname='example.com.', qtype=QTYPE.A, qclass=1,
+                                        rrset='\n'.join(rr.toZone() for rr in stored.rr))
+        models.DNSRecord.objects.create(qname='changed.example.com.', qtype=QTYPE.A, qclass=1, rdata='10.9.9.9')
+        snapshot.dump(self.path, self.caches)
+        caches = (AnswerCache(), AnswerCache())
+        self.assertEqual(snapshot.load(self.path, caches), 4)
+        self.assertNotIn(cache_key('changed.example.com.', QTYPE.A, 1), caches[0])  # Its RRs changed
+        self.assertEqual(caches[0].get(cache_key('example.com.', QTYPE.A, 1)).pk,
+                         models.DNSRecord.objects.get(qname='example.com.').pk)
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as other:
+            other.write(b'not a snapshot')
+        self.assertRaises(ValueError, snapshot.load, self.path, self.caches)
+
+
+class BlocklistTest(SimpleTestCase):
+
+    def test_normalize(self):
+        cases = [  # description, name, expected
+            ('Lower case', 'Ads.Example.COM', 'ads.example.com'),
+            ('Trailing dot', 'ads.example.com.', 'ads.example.com'),
+            ('Spaces', ' ads.example.com\n', 'ads.example.com'),
+            ('Underscore', '_dmarc.example.com', '_dmarc.example.com'),
+            ('Localhost', 'localhost', None),
+            ('IPv4', '0.0.0.0', None),
+            ('IPv6', '::1', None),
+            ('Wildcard', '*.example.com', None),
+            ('Empty', '.', None),
+        ]
+        for description, name, expected in cases:
+            self.assertEqual(normalize(name), expected, description)
+
+    def test_blocklist_names(self):
+        lines = [
+            '# Hosts file\n',
+            '127.0.0.1 localhost\n',
+            '0.0.0.0 ads.example.com tracker.example.com # Two names\n',
+            '::1 ip6-localhost\n',
+            'Domain.Example.org\n',
+            'two words\n',
+            '[Adblock Plus 2.0]\n',
+            '! Comment\n',
+            '||Adblock.example.net^\n',
+            '||path.example.net^$third-party\n',
+            '\n',
+        ]
+        self.assertEqual(list(blocklist_names(lines)), ['ads.example.com', 'tracker.example.com', 'domain.example.org',
+                                                        'adblock.example.net', 'path.example.net'])
+
+
+class MetricsTest(SimpleTestCase):
+
+    def test_disabled(self):
+        registry = Metrics()
+        registry.inc('dns_queries_total', path='cache')
+        registry.observe('dns_query_seconds', 0.001, path='cache')
+        self.assertEqual(registry.render(), '\n')
+
+    def test_render(self):
+        registry = Metrics()
+        registry.enabled = True
+        registry.describe('dns_queries_total', 'Answered questions by path')
+        registry.inc('dns_queries_total', path='cache')
+        registry.inc('dns_queries_total', 2, path='cache')
+        registry.inc('dns_queries_total', path='wire')
+        registry.inc('dns_errors_total', kind='say "hi"')
+        registry.observe('dns_query_seconds', 0.0003)
+        registry.observe('dns_query_seconds', 10)
+        registry.register(lambda: [('dns_cache_entries', {'cache': 'answer'}, 7)])
+        registry.register(lambda: 1 / 0)  # Logged and skipped
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:6], [
+            '# TYPE dns_errors_total counter',
+            'dns_errors_total{kind="say \\"hi\\""} 1',
+            '# HELP dns_queries_total Answered questions by path',
+            '# TYPE dns_queries_total counter',
+            'dns_queries_total{path="cache"} 3',
+            'dns_queries_total{path="wire"} 1',
+        ])
+        self.assertEqual(lines[6], '# TYPE dns_query_seconds histogram')
+        self.assertIn('dns_query_seconds_bucket{le="0.00025"} 0', lines)
+        self.assertIn('dns_query_seconds_bucket{le="0.0005"} 1', lines)
+        self.assertIn('dns_query_seconds_bucket{le="5"} 1', lines)
+        self.assertIn('dns_query_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertEqual(lines[-4:], [
+            'dns_query_seconds_sum 10.000300',
+            'dns_query_seconds_count 2',
+            '# TYPE dns_cache_entries gauge',
+            'dns_cache_entries{cache="answer"} 7',
+        ])
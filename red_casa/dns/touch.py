@@ -0,0 +1,108 @@
+from django.conf import settings
+from django.db import connections, close_old_connections
+from django.db.models import Case, When, Value, DateTimeField
+from django.utils import timezone
+
+import threading
+import logging
+
+logger = logging.getLogger('dns_server')
+
+DNS_TOUCH_INTERVAL = 5  # Seconds between flushes
+if hasattr(settings, 'DNS_TOUCH_INTERVAL'):
+    DNS_TOUCH_INTERVAL = float(settings.DNS_TOUCH_INTERVAL)
+
+DNS_TOUCH_MAX_PENDING = 10000
+if hasattr(settings, 'DNS_TOUCH_MAX_PENDING'):
+    DNS_TOUCH_MAX_PENDING = int(settings.DNS_TOUCH_MAX_PENDING)
+
+DNS_TOUCH_BATCH = 500  # Max records per UPDATE, lowered to the bulk_batch_size of the database
+if hasattr(settings, 'DNS_TOUCH_BATCH'):
+    DNS_TOUCH_BATCH = int(settings.DNS_TOUCH_BATCH)
+
+
+class TouchBuffer(object):
+    """
+    Write-behind buffer for DNSRecord.last_query.
+
+    Every query only records (pk -> last timestamp) in memory, a background
+    thread writes them with one UPDATE per interval (per batch records).
+    When max_pending records are waiting the caller flushes them itself, or
+    the executor if it's set.
+    """
+
+    def __init__(self, interval=DNS_TOUCH_INTERVAL, max_pending=DNS_TOUCH_MAX_PENDING, batch=DNS_TOUCH_BATCH):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.batch = batch
+        self.executor = None  # Runs the flushes of touch() apart from the caller, as the asyncio event loop
+        self.scheduled = False
+        self.pending = {}
+        self.mutex = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.flushed = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def touch(self, pk, when=None):
+        with self.mutex:
+            self.pending[pk] = when or timezone.now()
+            full = (len(self.pending) >= self.max_pending or self.interval <= 0) and not self.scheduled
+            executor = self.executor
+            if full and executor is not None:
+                self.scheduled = True
+        if full:
+            if executor is not None:
+                executor.submit(self.flush_scheduled)
+            else:
+                self.flush()
+
+    def flush_scheduled(self):
+        close_old_connections()
+        try:
+            self.flush()
+        except Exception as ex:
+            logger.error("Error updating last_query: %s" % ex)
+
+    def flush(self):
+        from red_casa.dns.models import DNSRecord
+        with self.mutex:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+        items = list(pending.items())
+        # Every record takes 3 query parameters: the pk and the value of its WHEN plus the pk of the IN
+        size = connections[DNSRecord.objects.db].ops.bulk_batch_size(['pk', 'when', 'pk__in'], items)
+        size = max(1, min(self.batch, size))
+        for i in range(0, len(items), size):
+            batch = items[i:i + size]
+            whens = [When(pk=pk, then=Value(when)) for pk, when in batch]
+            DNSRecord.objects.filter(pk__in=[pk for pk, when in batch]).update(
+                last_query=Case(*whens, output_field=DateTimeField()))
+        self.flushed += len(items)
+        return len(items)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.error("Error updating last_query: %s" % ex)
+
+    def start(self):
+        if self.thread is None and self.interval > 0:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='dns-touch')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.flush()
+
+
+touch_buffer = TouchBuffer()
@@ -0,0 +1,311 @@
+"""
+Client for the reply DNS servers
+
+One connected UDP socket per upstream is shared by all the queries, the
+answers are matched by query ID in a single I/O thread. Every query has a
+deadline and is hedged to the second fastest upstream when the first one is
+slow, the RTT of every upstream is tracked to rank them.
+"""
+from django.conf import settings
+
+from concurrent.futures import Future
+import threading
+import logging
+import random
+import select
+import socket
+import struct
+import heapq
+import time
+
+from red_casa.dns.wire import HEADER_SIZE, question_end, is_truncated
+from red_casa.dns.metrics import metrics
+
+logger = logging.getLogger('dns_server')
+
+DNS_UPSTREAM_TIMEOUT = 3  # Seconds for each query
+if hasattr(settings, 'DNS_UPSTREAM_TIMEOUT'):
+    DNS_UPSTREAM_TIMEOUT = float(settings.DNS_UPSTREAM_TIMEOUT)
+
+DNS_UPSTREAM_HEDGE = 0.3  # Max seconds before asking to the next upstream
+if hasattr(settings, 'DNS_UPSTREAM_HEDGE'):
+    DNS_UPSTREAM_HEDGE = float(settings.DNS_UPSTREAM_HEDGE)
+
+DNS_UPSTREAM_RETRY = 30  # Seconds before trusting again in a failed upstream
+if hasattr(settings, 'DNS_UPSTREAM_RETRY'):
+    DNS_UPSTREAM_RETRY = float(settings.DNS_UPSTREAM_RETRY)
+
+DNS_STALE_DEADLINE = 1.8  # Seconds waiting for the reply DNS server, RFC 8767 client response timer
+if hasattr(settings, 'DNS_STALE_DEADLINE'):
+    DNS_STALE_DEADLINE = float(settings.DNS_STALE_DEADLINE)
+
+DNS_UPSTREAM_PORT = 53
+MAX_PACKET_SIZE = 65535
+RTT_ALPHA = 0.3
+INITIAL_RTT = 0.05
+
+
+class UpstreamTimeout(Exception):
+    pass
+
+
+def parse_upstreams(value):
+    """
+    :param value: Comma separated host[:port], [IPv6][:port] or bare IPv6 list, or list of them
+    :return: List of (host, port)
+    :raise ValueError: If a server is not valid
+    """
+    if not isinstance(value, (list, tuple)):
+        value = str(value).split(',')
+    servers = []
+    for server in value:
+        server = server.strip()
+        if not server:
+            continue
+        host, port = server, DNS_UPSTREAM_PORT
+        if server.startswith('['):
+            host, bracket, port = server[1:].partition(']')
+            if not bracket or not host or (port and not port.startswith(':')):
+                raise ValueError('"%s" is not a valid [IPv6]:port DNS server' % server)
+            port = port[1:] if port else DNS_UPSTREAM_PORT
+        elif server.count(':') == 1:  # Not IPv6
+            host, port = server.split(':')
+        if not str(port).isdigit() or not 0 < int(port) < 65536:
+            raise ValueError('"%s" has not a valid port' % server)
+        servers.append((host, int(port)))
+    return servers
+
+
+def recv_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise socket.error('Connection closed')
+        data += chunk
+    return data
+
+
+def tcp_query(address, packet, timeout=DNS_UPSTREAM_TIMEOUT):
+    """
+    :return: Raw answer of the query sent over TCP
+    """
+    conn = socket.create_connection(address, timeout)
+    try:
+        conn.sendall(struct.pack('!H', len(packet)) + packet)
+        size = struct.unpack('!H', recv_exactly(conn, 2))[0]
+        return recv_exactly(conn, size)
+    finally:
+        conn.close()
+
+
+class Upstream(object):
+
+    def __init__(self, address):
+        self.address = address
+        self.sock = socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(address)
+        self.sock.setblocking(False)
+        self.srtt = INITIAL_RTT
+        self.failed_at = 0
+        self.sent = 0
+        self.answered = 0
+        self.timeouts = 0
+
+    def __str__(self):
+        return "%s:%s" % self.address
+
+    def score(self, now):
+        if self.failed_at and now - self.failed_at < DNS_UPSTREAM_RETRY:
+            return self.srtt + DNS_UPSTREAM_TIMEOUT
+        return self.srtt
+
+    def answer(self, rtt):
+        self.answered += 1
+        self.failed_at = 0
+        self.srtt += RTT_ALPHA * (rtt - self.srtt)
+
+    def timeout(self, now):
+        self.timeouts += 1
+        self.failed_at = now
+
+
+class PendingQuery(object):
+    __slots__ = ('future', 'packet', 'question', 'sent', 'deadline')
+
+    def __init__(self, packet, deadline):
+        self.future = Future()
+        self.packet = packet
+        self.question = packet[HEADER_SIZE:question_end(packet)].lower()
+        self.sent = {}  # upstream -> (wire id, sent time)
+        self.deadline = deadline
+
+
+class UpstreamPool(object):
+
+    def __init__(self, servers, timeout=DNS_UPSTREAM_TIMEOUT, hedge=DNS_UPSTREAM_HEDGE):
+        self.upstreams = [Upstream(address) for address in parse_upstreams(servers)]
+        if not self.upstreams:
+            raise ValueError('At least one reply DNS server is needed')
+        self.by_fileno = dict((upstream.sock.fileno(), upstream) for upstream in self.upstreams)
+        self.timeout = timeout
+        self.hedge = hedge
+        self.pending = {}  # (upstream, wire id) -> PendingQuery
+        self.timers = []
+        self.sequence = 0
+        self.mutex = threading.Lock()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='dns-upstream')
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def ranked(self):
+        now = time.time()
+        return sorted(self.upstreams, key=lambda upstream: upstream.score(now))
+
+    def submit(self, packet, timeout=None):
+        """
+        :param packet: Raw query
+        :return: Future with the raw answer, the query ID is the same than the packet one
+        """
+        now = time.time()
+        pending = PendingQuery(packet, now + (timeout or self.timeout))
+        upstreams = self.ranked()
+        with self.mutex:
+            self._send(pending, upstreams[0], now)
+            if len(upstreams) > 1:
+                if self.hedge > 0:
+                    hedge = max(0.01, min(self.hedge, upstreams[0].srtt * 3))
+                    self._schedule(now + hedge, self._hedge, pending, upstreams[1])
+                else:  # Race both from the start
+                    self._send(pending, upstreams[1], now)
+            self._schedule(pending.deadline, self._expire, pending)
+        self.wake_w.send(b'\0')
+        return pending.future
+
+    def query(self, packet, timeout=None):
+        """
+        :return: Raw answer
+        :raise UpstreamTimeout: If no upstream answers in time
+        """
+        return self.submit(packet, timeout).result()
+
+    def _schedule(self, when, action, *args):
+        self.sequence += 1
+        heapq.heappush(self.timers, (when, self.sequence, action, args))
+
+    def _send(self, pending, upstream, now):
+        wire_id = random.randint(0, 0xFFFF)
+        while (upstream, wire_id) in self.pending:
+            wire_id = random.randint(0, 0xFFFF)
+        self.pending[(upstream, wire_id)] = pending
+        pending.sent[upstream] = (wire_id, now)
+        upstream.sent += 1
+        try:
+            upstream.sock.send(struct.pack('!H', wire_id) + pending.packet[2:])
+        except socket.error as ex:
+            logger.warn("Error sending to %s: %s" % (upstream, ex))
+
+    def _hedge(self, pending, upstream):
+        if not pending.future.done() and upstream not in pending.sent:
+            logger.debug("Hedging query to %s" % upstream)
+            self._send(pending, upstream, time.time())
+
+    def _expire(self, pending):
+        if pending.future.done():
+            return
+        now = time.time()
+        for upstream in self._forget(pending):
+            upstream.timeout(now)
+        self._resolve(pending, exception=UpstreamTimeout('No answer from %s' % ', '.join(
+            str(upstream) for upstream in pending.sent)))
+
+    def _forget(self, pending):
+        for upstream, (wire_id, sent) in pending.sent.items():
+            self.pending.pop((upstream, wire_id), None)
+        return list(pending.sent)
+
+    def _received(self, upstream, data):
+        if len(data) < HEADER_SIZE:
+            return
+        wire_id = struct.unpack('!H', data[:2])[0]
+        with self.mutex:
+            pending = self.pending.get((upstream, wire_id))
+            if pending is None:
+                return
+            try:
+                if data[HEADER_SIZE:question_end(data)].lower() != pending.question:
+                    return  # Not the answer of our query
+            except ValueError:
+                return
+            rtt = time.time() - pending.sent[upstream][1]
+            upstream.answer(rtt)
+            metrics.observe('dns_upstream_rtt_seconds', rtt, upstream=str(upstream))
+            self._forget(pending)
+            answer = pending.packet[:2] + data[2:]
+            if not is_truncated(answer):
+                self._resolve(pending, answer)
+                return
+        thread = threading.Thread(target=self._retry_tcp, args=(pending, upstream))
+        thread.daemon = True
+        thread.start()
+
+    def _retry_tcp(self, pending, upstream):
+        try:
+            answer = tcp_query(upstream.address, pending.packet, max(0.1, pending.deadline - time.time()))
+        except Exception as ex:
+            with self.mutex:
+                self._resolve(pending, exception=ex)
+        else:
+            with self.mutex:
+                self._resolve(pending, answer)
+
+    @staticmethod
+    def _resolve(pending, answer=None, exception=None):
+        if pending.future.done():
+            return
+        if exception is not None:
+            pending.future.set_exception(exception)
+        else:
+            pending.future.set_result(answer)
+
+    def run(self):
+        sockets = [upstream.sock for upstream in self.upstreams] + [self.wake_r]
+        while True:
+            with self.mutex:
+                now = time.time()
+                while self.timers and self.timers[0][0] <= now:
+                    when, sequence, action, args = heapq.heappop(self.timers)
+                    action(*args)
+                wait = self.timers[0][0] - now if self.timers else None
+            readable, _, _ = select.select(sockets, [], [], wait)
+            for sock in readable:
+                if sock is self.wake_r:
+                    try:
+                        while self.wake_r.recv(512):
+                            pass
+                    except socket.error:
+                        pass
+                    continue
+                upstream = self.by_fileno[sock.fileno()]
+                while True:
+                    try:
+                        data = sock.recv(MAX_PACKET_SIZE)
+                    except socket.error:
+                        break
+                    self._received(upstream, data)
+
+    def stats(self):
+        return [{
+            'upstream': str(upstream),
+            'srtt': upstream.srtt,
+            'sent': upstream.sent,
+            'answered': upstream.answered,
+            'timeouts': upstream.timeouts,
+        } for upstream in self.upstreams]
@@ -0,0 +1,187 @@
+"""
+Minimal DNS wire format helpers for the paths that can not pay a dnslib parse
+"""
+from django.conf import settings
+
+import struct
+import re
+
+HEADER = struct.Struct('!HHHHHH')
+HEADER_SIZE = HEADER.size
+QUESTION = struct.Struct('!HH')
+RR_HEADER = struct.Struct('!HHIH')
+TTL = struct.Struct('!I')
+LABEL_RE = re.compile(b'^[A-Za-z0-9_-]+$')
+
+OPT = 41
+DNS_UDP_PAYLOAD = 512  # According RFC 1035, for clients without EDNS
+OPT_RR = struct.Struct('!BHHIH')  # Root name and RR header
+
+DNS_EDNS_MAX_PAYLOAD = 1232  # Max UDP answer for EDNS clients, advertised in our OPT RR
+if hasattr(settings, 'DNS_EDNS_MAX_PAYLOAD'):
+    DNS_EDNS_MAX_PAYLOAD = max(DNS_UDP_PAYLOAD, int(settings.DNS_EDNS_MAX_PAYLOAD))
+
+DNS_TCP_IDLE_TIMEOUT = 10  # Seconds waiting for the next length-prefixed query of a TCP connection
+if hasattr(settings, 'DNS_TCP_IDLE_TIMEOUT'):
+    DNS_TCP_IDLE_TIMEOUT = float(settings.DNS_TCP_IDLE_TIMEOUT)
+
+NOERROR = 0
+SERVFAIL = 2
+REFUSED = 5
+
+
+def name_end(data, offset=HEADER_SIZE):
+    """
+    :param data: Raw DNS message
+    :param offset: Where the name starts
+    :return: Offset after the name
+    """
+    length = len(data)
+    while True:
+        if offset >= length:
+            raise ValueError('Truncated name')
+        size = data[offset]
+        if not isinstance(size, int):  # Python 2 str
+            size = ord(size)
+        if size == 0:
+            return offset + 1
+        if size & 0xC0:  # Compression pointer
+            return offset + 2
+        offset += size + 1
+
+
+def question_end(data, offset=HEADER_SIZE):
+    """
+    :param data: Raw DNS message
+    :param offset: Where the question starts
+    :return: Offset after the QTYPE and QCLASS of the question
+    """
+    offset = name_end(data, offset) + 4
+    if offset > len(data):
+        raise ValueError('Truncated question')
+    return offset
+
+
+def parse_query(data):
+    """
+    Parses the question of a plain query: opcode QUERY, only one question and without any RR but OPT.
+    :param data: Raw DNS query
+    :return: (qname, qtype, qclass, question end, EDNS payload) with the qname in lower case and the
+        payload None without OPT RR or None for other queries
+    """
+    if len(data) < HEADER_SIZE:
+        return None
+    query_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data)
+    if flags & 0xF800 or qdcount != 1 or ancount or nscount or arcount > 1:
+        return None
+    labels = []
+    offset = HEADER_SIZE
+    length = len(data)
+    while True:
+        if offset >= length:
+            return None
+        size = bytearray(data[offset:offset + 1])[0]
+        if size == 0:
+            offset += 1
+            break
+        if size & 0xC0 or offset + size + 1 > length:
+            return None
+        label = bytes(data[offset + 1:offset + size + 1])
+        if not LABEL_RE.match(label):
+            return None
+        labels.append(label.lower().decode('ascii'))
+        offset += size + 1
+    if offset + 4 > length:
+        return None
+    qtype, qclass = QUESTION.unpack_from(data, offset)
+    payload = None
+    if arcount:
+        if offset + 4 + OPT_RR.size > length:
+            return None
+        root, rtype, payload, ttl, rdlength = OPT_RR.unpack_from(data, offset + 4)
+        if root or rtype != OPT or ttl & 0x00FF0000:  # Only EDNS version 0
+            return None
+    return '.'.join(labels) + '.', qtype, qclass, offset + 4, payload
+
+
+def rr_ttls(data):
+    """
+    :param data: Raw DNS message
+    :return: List of (offset, ttl) of every RR but OPT
+    """
+    query_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data)
+    offset = HEADER_SIZE
+    for i in range(qdcount):
+        offset = question_end(data, offset)
+    ttls = []
+    for i in range(ancount + nscount + arcount):
+        offset = name_end(data, offset)
+        rtype, rclass, ttl, rdlength = RR_HEADER.unpack_from(data, offset)
+        if rtype != OPT:
+            ttls.append((offset + 4, ttl))
+        offset += RR_HEADER.size + rdlength
+    return ttls
+
+
+def edns_payload(data):
+    """
+    :param data: Raw DNS message
+    :return: UDP payload size of the OPT RR or None if the message has not it
+    """
+    try:
+        query_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data)
+        offset = HEADER_SIZE
+        for i in range(qdcount):
+            offset = question_end(data, offset)
+        for i in range(ancount + nscount + arcount):
+            offset = name_end(data, offset)
+            rtype, rclass, ttl, rdlength = RR_HEADER.unpack_from(data, offset)
+            if rtype == OPT:
+                return rclass
+            offset += RR_HEADER.size + rdlength
+    except (ValueError, struct.error):
+        pass
+    return None
+
+
+def udp_payload(payload):
+    """
+    :param payload: UDP payload size of the client OPT RR or None without EDNS
+    :return: Max size of the UDP answer for the client
+    """
+    if payload is None:
+        return DNS_UDP_PAYLOAD
+    return min(max(payload, DNS_UDP_PAYLOAD), DNS_EDNS_MAX_PAYLOAD)
+
+
+def opt_rr():
+    """
+    :return: Raw OPT RR advertising DNS_EDNS_MAX_PAYLOAD
+    """
+    return OPT_RR.pack(0, OPT, DNS_EDNS_MAX_PAYLOAD, 0, 0)
+
+
+def is_truncated(data):
+    """
+    :return: If the TC flag is set in the raw message
+    """
+    return len(data) >= HEADER_SIZE and bool(HEADER.unpack_from(data)[1] & 0x0200)
+
+
+def error_response(raw_query, rcode=SERVFAIL):
+    """
+    :param raw_query: Raw DNS query
+    :param rcode: Response code
+    :return: Raw answer with the rcode and the first question echoed or None if the query is not valid
+    """
+    if len(raw_query) < HEADER_SIZE:
+        return None
+    query_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(raw_query)
+    flags = 0x8000 | (flags & 0x7900) | 0x0080 | rcode  # QR, OPCODE and RD from the query, RA
+    question = b''
+    if qdcount:
+        try:
+            question = raw_query[HEADER_SIZE:question_end(raw_query)]
+        except ValueError:
+            return None
+    return HEADER.pack(query_id, flags, 1 if question else 0, 0, 0, 0) + bytes(question)
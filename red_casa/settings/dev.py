@@ -13,3 +13,6 @@ DATABASES = {
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
     }
 }
+
+DNS_INVALIDATION_DIR = os.path.join(BASE_DIR, 'run')
+DNS_INVALIDATION_GROUP = None